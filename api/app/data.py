@@ -1,8 +1,11 @@
 import ast
+import bisect
+import gzip
+import hashlib
 import json
 import os
+import threading
 import time
-from copy import deepcopy
 
 import falcon
 import redis
@@ -33,18 +36,47 @@ class Info(object):
         resp.status = falcon.HTTP_200
 
 
-class Nodes():
+# macs read from Redis at a time when streaming endpoints
+STREAM_BATCH = 500
+MEDIA_NDJSON = 'application/x-ndjson'
 
-    def __init__(self, fields, ip=None):
-        self.nodes = []
-        self.node = {}
-        self.ip = ip
+
+class Snapshot():
+    '''
+    Materialized view of the endpoints in Redis, shared by every request
+    this worker serves.
+
+    Serving a request only reads p_endpoints_version, which Poseidon bumps
+    whenever it stores endpoints. The endpoints are read again when that
+    changes, or after max_age seconds so that ML and p0f results written
+    by other tools show up too. A rebuild fetches everything in a handful
+    of pipelined round trips and only re-parses the endpoints whose Redis
+    records changed. Rendered responses are kept until the next rebuild.
+
+    A response's ETag is a digest of the Redis records and the query, so it
+    only changes when the endpoints do. The first and last seen durations in
+    a body are relative to when it was rendered, hence the ETag is weak.
+    '''
+
+    def __init__(self, max_age=30):
+        self.max_age = max_age
         self.r = None
-        for field in fields:
-            self.node[field] = fields[field]
+        self.lock = threading.Lock()
+        self.version = None
+        self.built = 0
+        # mac -> (raw Redis records, parsed node)
+        self.records = {}
+        # macs in the order we serve them, and filter -> value -> macs
+        self.order = []
+        self.indexes = {}
+        # digest of the records, the same in every worker for the same records
+        self.digest = ''
+        # view key -> (body, etag, gzipped body)
+        self.rendered = {}
 
     def connect_redis(self):
-        self.r = None
+        if self.r:
+            return (True, 'connected')
         try:
             self.r = redis.StrictRedis(host='redis',
                                        port=6379,
@@ -54,130 +86,427 @@ class Nodes():
             return (False, 'unable to connect to redis because: ' + str(e))
         return (True, 'connected')
 
-    def build_nodes(self):
-        status = self.connect_redis()
-        if status[0] and self.r:
-            mac_addresses = []
+    def refresh(self):
+        ''' rebuild the snapshot if Redis may have changed since '''
+        with self.lock:
+            status = self.connect_redis()
+            if not status[0]:  # pragma: no cover
+                return
             try:
-                mac_addresses = self.r.smembers('mac_addresses')
+                version = self.r.get('p_endpoints_version')
             except Exception as e:  # pragma: no cover
                 print(
-                    'Unable to retrieve any endpoints because: {0}'.format(str(e)))
+                    'Unable to retrieve the endpoints version because: {0}'.format(str(e)))
+                return
+            if self.built and version == self.version and time.time() - self.built < self.max_age:
+                return
+            if self.rebuild():
+                self.version = version
+                self.built = time.time()
+
+    def rebuild(self):
+        try:
+            mac_addresses = sorted(self.r.smembers('mac_addresses'))
+            fetched = self.fetch(mac_addresses)
+        except Exception as e:  # pragma: no cover
+            print(
+                'Unable to retrieve any endpoints because: {0}'.format(str(e)))
+            return False
+
+        records = {}
+        changed = mac_addresses != self.order
+        for mac, raw in zip(mac_addresses, fetched):
+            old = self.records.get(mac, None)
+            if old is not None and old[0] == raw:
+                records[mac] = old
+            else:
+                records[mac] = (raw, build_node(mac, *raw))
+                changed = True
+        if changed or not self.digest:
+            self.digest = hashlib.sha1(json.dumps(
+                list(zip(mac_addresses, fetched)), sort_keys=True).encode('utf-8')).hexdigest()
+        self.records = records
+        self.order = mac_addresses
+        self.indexes = build_indexes(records)
+        self.rendered = {}
+        return True
+
+    def fetch(self, mac_addresses):
+        '''
+        the raw Redis records of each of the macs, in three pipelined round
+        trips however many macs there are.
+        '''
+        pipe = self.r.pipeline(transaction=False)
+        for mac in mac_addresses:
+            pipe.hgetall(mac)
+        mac_infos = pipe.execute()
+
+        pipe = self.r.pipeline(transaction=False)
+        for mac, mac_info in zip(mac_addresses, mac_infos):
+            pipe.hgetall(mac_info.get('poseidon_hash', ''))
+            pipe.hgetall(self.ml_key(mac, mac_info))
+        results = pipe.execute()
+        poseidon_infos = results[0::2]
+        ml_infos = results[1::2]
+
+        pipe = self.r.pipeline(transaction=False)
+        for poseidon_info in poseidon_infos:
+            ipv4, ipv6 = self.endpoint_addresses(poseidon_info)
+            pipe.hgetall(ipv4 or '')
+            pipe.hgetall(ipv6 or '')
+        results = pipe.execute()
+        return list(zip(mac_infos, poseidon_infos, ml_infos,
+                        results[0::2], results[1::2]))
+
+    def stream(self, fields, filters=None, batch=STREAM_BATCH):
+        '''
+        yield the endpoints matching filters with just the given fields,
+        straight from Redis a batch of macs at a time, so memory does not
+        grow with the number of endpoints.
+        '''
+        status = self.connect_redis()
+        if not status[0]:  # pragma: no cover
+            return
+        # like any SCAN, a mac added or removed meanwhile may or may not show
+        mac_addresses = []
+        for mac in self.r.sscan_iter('mac_addresses', count=batch):
+            mac_addresses.append(mac)
+            if len(mac_addresses) >= batch:
+                yield from self.stream_batch(mac_addresses, fields, filters)
+                mac_addresses = []
+        yield from self.stream_batch(mac_addresses, fields, filters)
+
+    def stream_batch(self, mac_addresses, fields, filters):
+        if not mac_addresses:
+            return
+        for mac, raw in zip(mac_addresses, self.fetch(mac_addresses)):
+            node = build_node(mac, *raw)
+            if node_matches(node, filters):
+                yield project_node(node, fields)
 
-            for mac in mac_addresses:
-                node = deepcopy(self.node)
-                # special cases
-                if 'mac' in node:
-                    node['mac'] = mac
+    @staticmethod
+    def ml_key(mac, mac_info):
+        if 'timestamps' in mac_info:
+            try:
+                timestamps = ast.literal_eval(mac_info['timestamps'])
+                return mac+'_'+str(timestamps[-1])
+            except Exception as e:  # pragma: no cover
+                print(
+                    'Failed to parse ML timestamps because: {0}'.format(str(e)))
+        return ''
 
-                # grab from mac info
-                mac_info = {}
+    @staticmethod
+    def endpoint_addresses(poseidon_info):
+        ipv4 = ipv6 = None
+        if 'endpoint_data' in poseidon_info:
+            try:
+                endpoint_data = ast.literal_eval(
+                    poseidon_info['endpoint_data'])
+                ipv4 = endpoint_data.get('ipv4', None)
+                ipv6 = endpoint_data.get('ipv6', None)
+            except Exception as e:  # pragma: no cover
+                print(
+                    'Failed to parse endpoint data because: {0}'.format(str(e)))
+        if not isinstance(ipv4, str) or ipv4 == 'None':
+            ipv4 = None
+        if not isinstance(ipv6, str) or ipv6 == 'None':
+            ipv6 = None
+        return ipv4, ipv6
+
+    def select(self, ip=None, filters=None):
+        '''
+        the macs of the endpoints with the address ip that match every
+        filter, where a filter matches any of its values.
+        '''
+        indexes = self.indexes
+        matches = []
+        if ip is not None:
+            matches.append(indexes.get('ip', {}).get(ip, set()))
+        for name, values in (filters or {}).items():
+            matched = set()
+            for value in values:
+                matched |= indexes.get(name, {}).get(value, set())
+            matches.append(matched)
+        if not matches:
+            return list(self.order)
+        matches.sort(key=len)
+        selected = set(matches[0]).intersection(*matches[1:])
+        return sorted(selected)
+
+    def nodes(self, fields, ip=None, filters=None, cursor=None, offset=0, limit=None):
+        '''
+        the endpoints with just the given fields, optionally by address and
+        filters, and a page at a time after the mac cursor or from offset.
+        returns the nodes and the cursor to the next page, if there is one.
+        '''
+        records = self.records
+        macs = self.select(ip, filters)
+        if cursor is not None:
+            macs = macs[bisect.bisect_right(macs, cursor):]
+        macs = macs[offset:]
+        next_cursor = None
+        if limit is not None and len(macs) > limit:
+            macs = macs[:limit]
+            next_cursor = macs[-1]
+        nodes = [project_node(records[mac][1], fields) for mac in macs]
+        return nodes, next_cursor
+
+    def etag(self, key):
+        ''' the ETag of a view of the current snapshot, without rendering it '''
+        return hashlib.sha1(
+            (self.digest + repr(key)).encode('utf-8')).hexdigest()
+
+    def render(self, key, build):
+        '''
+        the body, its ETag and its gzipped form for a view of the current
+        snapshot, building them at most once per snapshot.
+        '''
+        # a rebuild meanwhile swaps in a new dict, dropping what we render
+        renders = self.rendered
+        rendered = renders.get(key, None)
+        if rendered is None:
+            body = json.dumps(build(), separators=(',', ':')).encode('utf-8')
+            rendered = (body, self.etag(key), gzip.compress(body))
+            if len(renders) >= MAX_RENDERED:
+                renders.clear()
+            renders[key] = rendered
+        return rendered
+
+
+def build_node(mac, mac_info, poseidon_info, ml_info, ipv4_info, ipv6_info):
+    ''' parse the Redis records of an endpoint into every field we serve '''
+    node = {'mac': mac, 'addresses': set()}
+    # grab from endpoint data
+    if 'poseidon_hash' in mac_info:
+        node['id'] = mac_info['poseidon_hash']
+        try:
+            for key in ALL_FIELDS:
+                if key in poseidon_info:
+                    node[key] = poseidon_info[key]
+
+            if 'ignore' in poseidon_info:
+                node['ignored'] = poseidon_info['ignore']
+
+            if 'prev_states' in poseidon_info:
+                prev_states = ast.literal_eval(
+                    poseidon_info['prev_states'])
+                node['seen'] = (prev_states[0][1], prev_states[-1][1])
+
+            if 'endpoint_data' in poseidon_info:
+                endpoint_data = ast.literal_eval(
+                    poseidon_info['endpoint_data'])
+                for key in ALL_FIELDS:
+                    if key in endpoint_data:
+                        node[key] = endpoint_data[key]
                 try:
-                    mac_info = self.r.hgetall(mac)
+                    ipv4 = endpoint_data['ipv4']
+                    node['addresses'].add(ipv4)
+                    if isinstance(ipv4, str) and ipv4 != 'None':
+                        if '.' in ipv4:
+                            node['ipv4_subnet'] = '.'.join(
+                                ipv4.split('.')[:-1])+'.0/24'
+                        else:
+                            node['ipv4_subnet'] = NO_DATA
+                        if ipv4_info and 'short_os' in ipv4_info:
+                            node['ipv4_os'] = ipv4_info['short_os']
                 except Exception as e:  # pragma: no cover
                     print(
-                        'Unable to retrieve endpoint metadata because: {0}'.format(str(e)))
-
-                should_append = self.ip is None
-                # grab from endpoint data
-                if 'poseidon_hash' in mac_info:
-                    if 'id' in node:
-                        node['id'] = mac_info['poseidon_hash']
-                    try:
-                        poseidon_info = self.r.hgetall(
-                            mac_info['poseidon_hash'])
-
-                        for key in node:
-                            if key in poseidon_info:
-                                node[key] = poseidon_info[key]
-
-                        if 'ignored' in node and 'ignore' in poseidon_info:
-                            node['ignored'] = poseidon_info['ignore']
-
-                        if 'prev_states' in poseidon_info:
-                            prev_states = ast.literal_eval(
-                                poseidon_info['prev_states'])
-                            if 'first_seen' in node:
-                                node['first_seen'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(
-                                    prev_states[0][1])) + ' (' + duration(prev_states[0][1]) + ')'
-                            if 'last_seen' in node:
-                                node['last_seen'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(
-                                    prev_states[-1][1])) + ' (' + duration(prev_states[-1][1]) + ')'
-
-                        if 'endpoint_data' in poseidon_info:
-                            endpoint_data = ast.literal_eval(
-                                poseidon_info['endpoint_data'])
-                            for key in node:
-                                if key in endpoint_data:
-                                    node[key] = endpoint_data[key]
-                            if 'ipv4' in node:
-                                try:
-                                    ipv4 = endpoint_data['ipv4']
-                                    should_append = ipv4 == self.ip or should_append
-                                    if isinstance(ipv4, str) and ipv4 != 'None':
-                                        if 'ipv4_subnet' in node:
-                                            if '.' in ipv4:
-                                                node['ipv4_subnet'] = '.'.join(
-                                                    ipv4.split('.')[:-1])+'.0/24'
-                                            else:
-                                                node['ipv4_subnet'] = NO_DATA
-                                        ipv4_info = self.r.hgetall(ipv4)
-                                        if ipv4_info and 'short_os' in ipv4_info:
-                                            node['ipv4_os'] = ipv4_info['short_os']
-                                except Exception as e:  # pragma: no cover
-                                    print(
-                                        'Failed to set IPv4 info because: {0}'.format(str(e)))
-                            if 'ipv6' in node:
-                                try:
-                                    ipv6 = endpoint_data['ipv6']
-                                    should_append = ipv6 == self.ip or should_append
-                                    if isinstance(ipv6, str) and ipv6 != 'None':
-                                        if 'ipv6_subnet' in node:
-                                            if ':' in ipv6:
-                                                node['ipv6_subnet'] = ':'.join(
-                                                    ipv6.split(':')[0:4])+'::0/64'
-                                            else:
-                                                node['ipv6_subnet'] = NO_DATA
-                                        ipv6_info = self.r.hgetall(ipv6)
-                                        if ipv6_info and 'short_os' in ipv6_info:
-                                            node['ipv6_os'] = ipv6_info['short_os']
-                                except Exception as e:  # pragma: no cover
-                                    print(
-                                        'Failed to set IPv6 info because: {0}'.format(str(e)))
-                    except Exception as e:  # pragma: no cover
-                        print(
-                            'Failed to set all poseidon info because: {0}'.format(str(e)))
-
-                # grab ml results
-                if 'role' in node:
-                    if 'timestamps' in mac_info:
-                        try:
-                            timestamps = ast.literal_eval(
-                                mac_info['timestamps'])
-                            ml_info = self.r.hgetall(
-                                mac+'_'+str(timestamps[-1]))
-                            if 'labels' in ml_info:
-                                labels = ast.literal_eval(
-                                    ml_info['labels'])
-                                node['role'] = labels[0]
-                            if 'confidences' in ml_info:
-                                confidences = ast.literal_eval(
-                                    ml_info['confidences'])
-                                node['role_confidence'] = int(
-                                    confidences[0]*100)
-                            if 'behavior' in node and 'poseidon_hash' in mac_info and mac_info['poseidon_hash'] in ml_info:
-                                results = ast.literal_eval(
-                                    ml_info[mac_info['poseidon_hash']])
-                                node['behavior'] = 1
-                                if results['decisions']['behavior'] == 'normal':
-                                    node['behavior'] = 0
-                        except Exception as e:  # pragma: no cover
-                            print(
-                                'Failed to set all ML info because: {0}'.format(str(e)))
-                if should_append:
-                    self.nodes.append(node)
+                        'Failed to set IPv4 info because: {0}'.format(str(e)))
+                try:
+                    ipv6 = endpoint_data['ipv6']
+                    node['addresses'].add(ipv6)
+                    if isinstance(ipv6, str) and ipv6 != 'None':
+                        if ':' in ipv6:
+                            node['ipv6_subnet'] = ':'.join(
+                                ipv6.split(':')[0:4])+'::0/64'
+                        else:
+                            node['ipv6_subnet'] = NO_DATA
+                        if ipv6_info and 'short_os' in ipv6_info:
+                            node['ipv6_os'] = ipv6_info['short_os']
+                except Exception as e:  # pragma: no cover
+                    print(
+                        'Failed to set IPv6 info because: {0}'.format(str(e)))
+        except Exception as e:  # pragma: no cover
+            print(
+                'Failed to set all poseidon info because: {0}'.format(str(e)))
+
+    # grab ml results
+    try:
+        if 'labels' in ml_info:
+            labels = ast.literal_eval(
+                ml_info['labels'])
+            node['role'] = labels[0]
+        if 'confidences' in ml_info:
+            confidences = ast.literal_eval(
+                ml_info['confidences'])
+            node['role_confidence'] = int(
+                confidences[0]*100)
+        if 'poseidon_hash' in mac_info and mac_info['poseidon_hash'] in ml_info:
+            results = ast.literal_eval(
+                ml_info[mac_info['poseidon_hash']])
+            node['behavior'] = 1
+            if results['decisions']['behavior'] == 'normal':
+                node['behavior'] = 0
+    except Exception as e:  # pragma: no cover
+        print(
+            'Failed to set all ML info because: {0}'.format(str(e)))
+    return node
+
+
+def project_node(node, fields):
+    ''' a parsed endpoint with just the given fields '''
+    projected = {field: node.get(field, fields[field]) for field in fields}
+    if 'seen' in node:
+        # durations are relative to now, so they are not cached
+        for field, seen in zip(('first_seen', 'last_seen'), node['seen']):
+            if field in fields:
+                projected[field] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(
+                    seen)) + ' (' + duration(seen) + ')'
+    return projected
+
+
+def node_matches(node, filters):
+    ''' the unindexed counterpart of Snapshot.select for a single endpoint '''
+    for name, values in (filters or {}).items():
+        if not any(str(node.get(field, DEFAULTS[field])) in values for field in FILTERS[name]):
+            return False
+    return True
+
+
+def build_indexes(records):
+    ''' filter -> value -> macs of the endpoints with that value '''
+    indexes = {name: {} for name in FILTERS}
+    indexes['ip'] = {}
+    for mac, (_, node) in records.items():
+        for address in node['addresses']:
+            indexes['ip'].setdefault(address, set()).add(mac)
+        for name, node_fields in FILTERS.items():
+            for field in node_fields:
+                value = str(node.get(field, DEFAULTS[field]))
+                indexes[name].setdefault(value, set()).add(mac)
+    return indexes
+
+
+# distinct queries rendered per snapshot before we start over
+MAX_RENDERED = 256
+SNAPSHOT = Snapshot(max_age=int(os.environ.get('SNAPSHOT_MAX_AGE', 30)))
+
+
+class Nodes():
 
+    def __init__(self, fields, ip=None):
+        self.nodes = []
+        self.node = {}
+        self.ip = ip
+        for field in fields:
+            self.node[field] = fields[field]
+
+    def build_nodes(self):
+        SNAPSHOT.refresh()
+        self.nodes = SNAPSHOT.nodes(self.node, self.ip)[0]
+
+
+def send_snapshot(req, resp, key, build):
+    '''
+    answer from the snapshot, gzipped if the client takes it, or with 304
+    if the client has it already.
+    '''
+    SNAPSHOT.refresh()
+    etag = SNAPSHOT.etag(key)
+    compress = 'gzip' in (req.get_header('Accept-Encoding') or '')
+    if compress:
+        etag += '-gzip'
+    resp.etag = 'W/"{0}"'.format(etag)
+    resp.vary = ('Accept-Encoding',)
+    if etag in parse_etags(req.get_header('If-None-Match')):
+        resp.status = falcon.HTTP_304
         return
+    body, _, gzipped = SNAPSHOT.render(key, build)
+    resp.content_type = falcon.MEDIA_JSON
+    if compress:
+        resp.set_header('Content-Encoding', 'gzip')
+        resp.data = gzipped
+    else:
+        resp.data = body
+    resp.status = falcon.HTTP_200
+
+
+def send_stream(req, resp, query):
+    ''' answer with one JSON endpoint per line, as they are read '''
+    def lines():
+        for node in SNAPSHOT.stream(query['fields'], query['filters']):
+            yield json.dumps(node, separators=(',', ':')).encode('utf-8') + b'\n'
+
+    resp.content_type = MEDIA_NDJSON
+    resp.stream = lines()
+    resp.status = falcon.HTTP_200
+
+
+def get_param_list(req, name):
+    ''' a repeated or comma separated query parameter as a list '''
+    values = req.get_param_as_list(name) or []
+    return [value for item in values for value in item.split(',') if value]
+
+
+def parse_query(req, fields):
+    '''
+    the fields, filters and page asked for in the query string, so views
+    of the same query share one rendering.
+    '''
+    query = {'fields': fields, 'filters': {}, 'cursor': None,
+             'offset': 0, 'limit': None, 'format': 'json'}
+    requested = get_param_list(req, 'fields')
+    if requested:
+        unknown = [field for field in requested if field not in fields]
+        if unknown:
+            raise falcon.HTTPBadRequest(
+                'Unknown fields', 'Unknown fields: {0}'.format(', '.join(unknown)))
+        query['fields'] = {field: fields[field] for field in requested}
+    for name in FILTERS:
+        values = get_param_list(req, name)
+        if values:
+            query['filters'][name] = values
+    query['format'] = req.get_param('format') or 'json'
+    if query['format'] not in ('json', 'ndjson'):
+        raise falcon.HTTPBadRequest(
+            'Unknown format', 'format must be json or ndjson')
+    query['cursor'] = req.get_param('cursor')
+    query['limit'] = req.get_param_as_int('limit', min_value=1)
+    page = req.get_param_as_int('page', min_value=1)
+    if page is not None:
+        if query['limit'] is None:
+            raise falcon.HTTPBadRequest(
+                'Missing limit', 'page needs a limit to size the pages')
+        query['offset'] = (page - 1) * query['limit']
+    return query
+
+
+def query_key(view, query):
+    return (view, tuple(query['fields']),
+            tuple(sorted((name, tuple(values)) for name, values in query['filters'].items())),
+            query['cursor'], query['offset'], query['limit'])
+
+
+def query_dataset(network, query, ip=None):
+    ''' add the nodes for a parsed query to a response, and its next page '''
+    nodes, next_cursor = SNAPSHOT.nodes(
+        query['fields'], ip=ip, filters=query['filters'], cursor=query['cursor'],
+        offset=query['offset'], limit=query['limit'])
+    network['dataset'] = nodes
+    if query['limit'] is not None:
+        network['next_cursor'] = next_cursor
+    return network
+
+
+def parse_etags(header):
+    etags = set()
+    if header:
+        for etag in header.split(','):
+            etag = etag.strip()
+            if etag.startswith('W/'):
+                etag = etag[2:]
+            etags.add(etag.strip('"'))
+    return etags
 
 
 class NetworkFull(object):
@@ -206,13 +535,15 @@ class NetworkFull(object):
         return n.nodes
 
     def on_get(self, req, resp):
-        network = {}
-        dataset = NetworkFull.get_dataset()
-        network['dataset'] = dataset
+        query = parse_query(req, NetworkFull.get_fields())
+        if query['format'] == 'ndjson':
+            send_stream(req, resp, query)
+            return
 
-        resp.body = json.dumps(network, indent=2)
-        resp.content_type = falcon.MEDIA_JSON
-        resp.status = falcon.HTTP_200
+        def build():
+            return query_dataset({}, query)
+
+        send_snapshot(req, resp, query_key('network_full', query), build)
 
 
 class Network(object):
@@ -253,23 +584,32 @@ class Network(object):
         return n.nodes
 
     @staticmethod
-    def get_configuration():
+    def get_configuration(fields=None):
         configuration = {'fields': []}
-        for field in Network.get_fields():
+        for field in fields or Network.get_fields():
             configuration['fields'].append(
                 {'path': [field], 'displayName': Network.field_mapping()[field], 'groupable': 'true'})
         return configuration
 
     def on_get(self, req, resp):
-        network = {}
-        dataset = Network.get_dataset()
-        configuration = Network.get_configuration()
-
-        network['dataset'] = dataset
-        network['configuration'] = configuration
-        resp.body = json.dumps(network, indent=2)
-        resp.content_type = falcon.MEDIA_JSON
-        resp.status = falcon.HTTP_200
+        query = parse_query(req, Network.get_fields())
+        if query['format'] == 'ndjson':
+            send_stream(req, resp, query)
+            return
+
+        def build():
+            return query_dataset(
+                {'configuration': Network.get_configuration(query['fields'])}, query)
+
+        send_snapshot(req, resp, query_key('network', query), build)
+
+
+ALL_FIELDS = set(NetworkFull.get_fields()) | set(Network.get_fields())
+DEFAULTS = dict(NetworkFull.get_fields(), **Network.get_fields())
+# query parameter -> the fields it filters on
+FILTERS = {'state': ('state',), 'role': ('role',),
+           'os': ('ipv4_os', 'ipv6_os'), 'segment': ('segment',),
+           'vlan': ('vlan',), 'subnet': ('ipv4_subnet', 'ipv6_subnet')}
 
 
 class NetworkByIp(object):
@@ -282,20 +622,18 @@ class NetworkByIp(object):
         return n.nodes
 
     @staticmethod
-    def get_configuration():
+    def get_configuration(fields=None):
         configuration = {'fields': []}
-        for field in Network.get_fields():
+        for field in fields or Network.get_fields():
             configuration['fields'].append(
                 {'path': [field], 'displayName': Network.field_mapping()[field], 'groupable': 'true'})
         return configuration
 
     def on_get(self, req, resp, ip):
-        network = {}
-        dataset = NetworkByIp.get_dataset(ip)
-        configuration = NetworkByIp.get_configuration()
-
-        network['dataset'] = dataset
-        network['configuration'] = configuration
-        resp.body = json.dumps(network, indent=2)
-        resp.content_type = falcon.MEDIA_JSON
-        resp.status = falcon.HTTP_200
+        query = parse_query(req, Network.get_fields())
+
+        def build():
+            return query_dataset(
+                {'configuration': NetworkByIp.get_configuration(query['fields'])}, query, ip=ip)
+
+        send_snapshot(req, resp, query_key(('network', ip), query), build)
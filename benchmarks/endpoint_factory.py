@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark endpoint construction time and memory.
+
+If the transitions package is installed the same endpoints are also built
+with a transitions.Machine per state machine per endpoint for comparison.
+
+Usage:
+    PYTHONPATH=. python benchmarks/endpoint_factory.py [count ...]
+
+Created on 16 October 2026
+"""
+import sys
+import time
+import tracemalloc
+
+from poseidon.helpers.endpoint import Endpoint
+from poseidon.helpers.endpoint import endpoint_factory
+
+try:
+    from transitions import Machine
+except ImportError:  # pragma: no cover
+    Machine = None
+
+DEFAULT_COUNTS = (1000, 10000, 50000)
+
+
+class MachineEndpoint(Endpoint):
+    ''' an Endpoint with a __dict__, for transitions to bind its methods on '''
+
+
+def machine_factory(hashed_val):
+    ''' endpoint_factory as it was with one transitions.Machine per machine '''
+    endpoint = MachineEndpoint(hashed_val)
+    machine = Machine(
+        model=endpoint,
+        states=Endpoint.states,
+        transitions=Endpoint.transitions,
+        initial='unknown',
+        send_event=True)
+    machine.name = endpoint.name[:8]+' '
+    endpoint.machine = machine
+    copro_machine = Machine(
+        model=endpoint,
+        states=Endpoint.copro_states,
+        transitions=Endpoint.copro_transitions,
+        initial='unknown',
+        send_event=True)
+    copro_machine.name = endpoint.name[:8]+' '
+    endpoint.copro_machine = copro_machine
+    return endpoint
+
+
+def measure(factory, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    endpoints = [factory('bench{0:08d}'.format(i)) for i in range(count)]
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del endpoints
+    return elapsed, size / count
+
+
+def main(counts):
+    factories = [('table', endpoint_factory)]
+    if Machine:
+        factories.append(('transitions', machine_factory))
+    print('{0:>12} {1:>8} {2:>12} {3:>14}'.format(
+        'factory', 'count', 'build (s)', 'bytes/endpoint'))
+    for name, factory in factories:
+        for count in counts:
+            elapsed, per_endpoint = measure(factory, count)
+            print('{0:>12} {1:>8} {2:>12.3f} {3:>14.0f}'.format(
+                name, count, elapsed, per_endpoint))
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or DEFAULT_COUNTS)
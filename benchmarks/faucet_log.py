@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the per-scan cost of parsing the FAUCET log as it grows.
+
+Each scan appends a few new lines. 'full' parses the whole log with a new
+Parser each scan, as every scan did before the log was tailed. 'tail'
+keeps one Parser, so it only parses the appended lines.
+
+Usage:
+    PYTHONPATH=. python benchmarks/faucet_log.py [lines ...]
+
+Created on 16 October 2026
+"""
+import os
+import sys
+import tempfile
+import time
+
+from poseidon.controllers.faucet.parser import Parser
+
+DEFAULT_LINES = (10000, 100000, 1000000)
+NEW_LINES = 100
+LEARN = ('Nov 19 18:52:31 faucet.valve INFO     DPID 123917682135854 (0x70b3d56cd32e) '
+         'L2 learned {0} (L2 type 0x0800, L3 src 192.168.{1}.{2}) on Port {3} on VLAN 200 '
+         '(2 hosts total)\n')
+
+
+def write_lines(path, start, count):
+    with open(path, 'a') as f:
+        for i in range(start, start + count):
+            mac = '0e:00:00:00:{0:02x}:{1:02x}'.format(i >> 8 & 0xff, i & 0xff)
+            f.write(LEARN.format(mac, i >> 8 & 0xff, i & 0xff, i % 48))
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main(counts):
+    print('{0:>10} {1:>12} {2:>12} {3:>12}'.format(
+        'lines', 'size (MB)', 'full (s)', 'tail (s)'))
+    for count in counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'faucet.log')
+            write_lines(path, 0, count)
+            tail_parser = Parser()
+            tail_parser.log(path)
+            write_lines(path, count, NEW_LINES)
+            full = timed(lambda: Parser().log(path))
+            tail = timed(lambda: tail_parser.log(path))
+            print('{0:>10} {1:>12.1f} {2:>12.4f} {3:>12.4f}'.format(
+                count, os.path.getsize(path) / 1e6, full, tail))
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or DEFAULT_LINES)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark MAC vendor lookup throughput.
+
+'scan' reads the prefixes file line by line for every MAC, as
+get_ether_vendor did before the prefixes were indexed. 'index' is
+get_ether_vendor with its OuiIndex.
+
+Usage:
+    PYTHONPATH=. python benchmarks/oui_lookup.py [lookups ...]
+
+Created on 16 October 2026
+"""
+import random
+import sys
+import time
+
+from poseidon.helpers.metadata import get_ether_vendor
+
+DEFAULT_LOOKUPS = (100, 1000, 10000)
+LOOKUP_PATH = 'poseidon/metadata/nmap-mac-prefixes.txt'
+
+
+def scan_ether_vendor(mac, lookup_path):
+    ''' get_ether_vendor as it was, reading the whole file each time '''
+    mac = ''.join(mac.split(':'))[:6].upper()
+    with open(lookup_path, 'r') as f:
+        for line in f:
+            if line.startswith(mac):
+                return line.split()[1].strip()
+
+
+def make_macs(count):
+    with open(LOOKUP_PATH, 'r') as f:
+        prefixes = [line.split()[0] for line in f if line.strip()]
+    rng = random.Random(0)
+    macs = []
+    for _ in range(count):
+        prefix = rng.choice(prefixes)[:6] if rng.random() < 0.9 else '{0:06X}'.format(rng.getrandbits(24))
+        macs.append(':'.join([prefix[0:2], prefix[2:4], prefix[4:6], 'aa', 'bb', 'cc']).lower())
+    return macs
+
+
+def measure(lookup, macs):
+    start = time.perf_counter()
+    for mac in macs:
+        lookup(mac, LOOKUP_PATH)
+    return time.perf_counter() - start
+
+
+def main(counts):
+    # load the index before timing, as it is at startup
+    get_ether_vendor('00:00:00:00:00:00', LOOKUP_PATH)
+    print('{0:>8} {1:>8} {2:>12} {3:>14}'.format(
+        'lookup', 'count', 'total (s)', 'lookups/s'))
+    for count in counts:
+        macs = make_macs(count)
+        for name, lookup in (('scan', scan_ether_vendor), ('index', get_ether_vendor)):
+            if name == 'scan' and count > 1000:
+                # takes minutes, time a sample and scale it
+                elapsed = measure(lookup, macs[:1000]) * count / 1000
+            else:
+                elapsed = measure(lookup, macs)
+            print('{0:>8} {1:>8} {2:>12.4f} {3:>14.0f}'.format(
+                name, count, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or DEFAULT_LOOKUPS)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark SDNConnect.store_endpoints as the number of endpoints grows.
+
+Needs a Redis reachable at the host 'redis' (as in the test setup) and
+POSEIDON_CONFIG pointing at a Poseidon config. THE REDIS DB IS FLUSHED.
+
+Usage:
+    PYTHONPATH=. POSEIDON_CONFIG=config/poseidon.config \
+        python benchmarks/store_endpoints.py [count ...]
+
+Created on 16 October 2026
+"""
+import sys
+import time
+
+from poseidon.helpers.config import Config
+from poseidon.helpers.endpoint import endpoint_factory
+from poseidon.main import SDNConnect
+
+DEFAULT_COUNTS = (1000, 5000, 10000, 20000, 50000)
+
+
+def make_endpoints(count):
+    endpoints = {}
+    for i in range(count):
+        name = 'bench{0:08d}'.format(i)
+        endpoint = endpoint_factory(name)
+        mac = ':'.join(['0e'] + ['{0:02x}'.format((i >> shift) & 0xff)
+                                 for shift in (32, 24, 16, 8, 0)])
+        endpoint.endpoint_data = {
+            'tenant': 'VLAN100', 'mac': mac, 'segment': 'switch1',
+            'port': str(i % 48), 'active': 1,
+            'ipv4': '10.{0}.{1}.{2}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+            'ipv6': 0}
+        endpoints[name] = endpoint
+    return endpoints
+
+
+def seed_ml_results(r, endpoints):
+    ''' fake two NetworkML results for every endpoint '''
+    pipe = r.pipeline(transaction=False)
+    for endpoint in endpoints.values():
+        mac = endpoint.endpoint_data['mac']
+        pipe.hset(mac, 'timestamps', str(['1551805502.0', '1551805602.0']))
+        for timestamp in ('1551805502.0', '1551805602.0'):
+            pipe.hmset('_'.join((mac, timestamp)), {
+                'labels': str(['Developer workstation', 'Unknown', 'Smartphone']),
+                'confidences': str([0.6, 0.3, 0.1]),
+                endpoint.name: str({'decisions': {'behavior': 'normal'}})})
+    pipe.execute()
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main(counts):
+    controller = Config().get_config()
+    controller['TYPE'] = 'None'
+    print('{0:>8} {1:>12} {2:>12} {3:>12}'.format(
+        'count', 'first (s)', 'ml (s)', 'idle (s)'))
+    for count in counts:
+        s = SDNConnect(controller, first_time=False)
+        s.r.flushdb()
+        s.endpoints = make_endpoints(count)
+        # everything is new
+        first = timed(s.store_endpoints)
+        # ML results arrive for every endpoint, read at the next metadata refresh
+        seed_ml_results(s.r, s.endpoints)
+        s.metadata_refreshed = 0
+        ml = timed(s.store_endpoints)
+        # nothing changed
+        idle = timed(s.store_endpoints)
+        print('{0:>8} {1:>12.3f} {2:>12.3f} {3:>12.3f}'.format(
+            count, first, ml, idle))
+    s.r.flushdb()
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or DEFAULT_COUNTS)
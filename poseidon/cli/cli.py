@@ -31,7 +31,7 @@ class GetData():
 
     @staticmethod
     def _get_name(endpoint):
-        return endpoint.machine.name.strip()
+        return endpoint.name[:8]
 
     @staticmethod
     def _get_mac(endpoint):
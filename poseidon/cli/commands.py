@@ -22,8 +22,8 @@ class Commands:
         self.sdnc.get_stored_endpoints()
 
     def _publish_action(self, address, payload):
-        if payload:
-            self.sdnc.publish_action(address, json.dumps(payload))
+        if payload and not self.sdnc.publish_action(address, json.dumps(payload)):
+            raise RuntimeError('Unable to publish {0}'.format(address))
 
     def _get_endpoints(self, args, idx, match_all=False):
         ''' get endpoints that match '''
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Plans the acls_in changes the ACL rules call for.
+
+Created on 16 October 2026
+"""
+from collections import namedtuple
+
+AclPlan = namedtuple('AclPlan', ['changes', 'status', 'recomputed', 'skipped', 'locations', 'matches'])
+
+
+class AclPlanner:
+    '''
+    Works out the acls_in each (switch, port) should have from the rules
+    the endpoints on it match, and the difference from what it has now.
+
+    Only ports with a changed endpoint on them, now or at the last
+    committed plan, or with an endpoint that now matches different rules,
+    are recomputed. ACLs that no rule mentions are left alone.
+    '''
+
+    def __init__(self):
+        # endpoint name -> (switch, port) at the last committed plan
+        self.locations = {}
+        # endpoint name -> rules it matched at the last committed plan
+        self.matches = {}
+        # ports of committed plans since take_counts() was last called
+        self.recomputed = 0
+        self.skipped = 0
+
+    @staticmethod
+    def _location(endpoint):
+        data = endpoint.endpoint_data or {}
+        try:
+            return (data['segment'], int(data['port']))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def rule_acls(rules_doc):
+        ''' rule name -> ACLs it applies '''
+        rule_acls = {}
+        for name, sub_rules in (rules_doc.get('rules', None) or {}).items():
+            acls = []
+            for sub_rule in sub_rules:
+                for acl in sub_rule.get('rule', {}).get('acls', []):
+                    if acl not in acls:
+                        acls.append(acl)
+            rule_acls[name] = acls
+        return rule_acls
+
+    def plan(self, obj_doc, rules_doc, rule_engine, endpoints, changed=None,
+             force_apply_rules=None, force_remove_rules=None):
+        '''
+        the acls_in changes needed for the ports of the changed endpoints
+        (all endpoints if changed is None). nothing is modified.
+        '''
+        rule_acls = self.rule_acls(rules_doc)
+        managed = set(acl for acls in rule_acls.values() for acl in acls)
+        force_apply_rules = set(force_apply_rules or [])
+        force_remove_rules = set(force_remove_rules or [])
+        dps = obj_doc.get('dps', None) or {}
+
+        by_port = {}
+        locations = {}
+        for endpoint in endpoints:
+            location = self._location(endpoint)
+            if location and location[0] in dps:
+                by_port.setdefault(location, []).append(endpoint)
+                locations[endpoint.name] = location
+        located = [endpoint for port_endpoints in by_port.values() for endpoint in port_endpoints]
+        matched = rule_engine.match_all(located)
+        if changed is None:
+            affected = set(by_port)
+        else:
+            affected = set()
+            for endpoint in changed:
+                for location in (self._location(endpoint), self.locations.get(endpoint.name, None)):
+                    if location and location[0] in dps:
+                        affected.add(location)
+            # endpoints whose metadata now matches different rules
+            for endpoint in located:
+                if matched[endpoint.name] != self.matches.get(endpoint.name, None):
+                    affected.add(locations[endpoint.name])
+
+        changes = []
+        status = []
+        for switch, port in sorted(affected, key=str):
+            interfaces = dps[switch].get('interfaces', None) or {}
+            current = list((interfaces.get(port, None) or {}).get('acls_in', None) or [])
+            on_port = by_port.get((switch, port), [])
+            endpoint_rules = {}
+            desired_managed = set()
+            for endpoint in on_port:
+                rules = [rule for rule in rule_acls
+                         if rule in matched[endpoint.name] or rule in force_apply_rules]
+                endpoint_rules[endpoint.name] = rules
+                for rule in rules:
+                    desired_managed.update(rule_acls[rule])
+            removed = [acl for acl in current if acl in managed and
+                       (acl not in desired_managed or acl in force_remove_rules)]
+            added = sorted(acl for acl in desired_managed
+                           if acl not in current and acl not in force_remove_rules)
+            if not removed and not added:
+                continue
+            desired = [acl for acl in current if acl not in removed] + added
+            changes.append({'switch': switch, 'port': port, 'current': current,
+                            'desired': desired, 'added': added, 'removed': removed})
+            for endpoint in on_port:
+                mac = endpoint.endpoint_data['mac']
+                for rule in endpoint_rules[endpoint.name]:
+                    rule_added = [acl for acl in rule_acls[rule] if acl in added]
+                    if rule_added:
+                        status.append(['added acls', mac, switch, str(port), rule_added, rule])
+                if removed:
+                    status.append(['removed acls', mac, switch, str(port), removed, None])
+        skipped = len(set(by_port) - affected)
+        return AclPlan(changes, status, len(affected), skipped, locations, matched)
+
+    @staticmethod
+    def apply(obj_doc, plan):
+        ''' write a plan's changes into obj_doc, true if there were any '''
+        for change in plan.changes:
+            interfaces = obj_doc['dps'][change['switch']].setdefault('interfaces', {})
+            if interfaces.get(change['port'], None) is None:
+                interfaces[change['port']] = {}
+            interfaces[change['port']]['acls_in'] = change['desired']
+        return bool(plan.changes)
+
+    def commit(self, plan):
+        '''
+        remember where endpoints were and what they matched, once the
+        config a plan was applied to has been written
+        '''
+        self.recomputed += plan.recomputed
+        self.skipped += plan.skipped
+        self.locations.update(plan.locations)
+        self.matches.update(plan.matches)
+
+    def take_counts(self):
+        ''' (recomputed, skipped) port counts since the last call '''
+        counts = (self.recomputed, self.skipped)
+        self.recomputed = 0
+        self.skipped = 0
+        return counts
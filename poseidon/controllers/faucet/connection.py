@@ -3,13 +3,48 @@
 Created on 18 November 2017
 @author: Charlie Lewis
 """
+import functools
 import logging
 import os
+import time
 
 from paramiko import AutoAddPolicy
 from paramiko import SSHClient
+from paramiko import SSHException
 from scp import SCPClient
 
+# seconds between keepalives on the shared SSH connection
+SSH_KEEPALIVE = 30
+# leading bytes of the remote log compared between fetches to spot rotation
+LOG_HEAD_BYTES = 1024
+
+
+def ssh_timed(function):
+    """
+    A decorator for controller operations that logs how long the operation
+    took and how many SSH handshakes it needed, and keeps a running total
+    per operation in ssh_stats
+    """
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        handshakes = self.handshakes
+        handshake_time = self.handshake_time
+        start = time.time()
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            if self.host:
+                stats = self.ssh_stats.setdefault(function.__name__, {
+                    'calls': 0, 'time': 0.0, 'handshakes': 0, 'handshake_time': 0.0})
+                stats['calls'] += 1
+                stats['time'] += time.time() - start
+                stats['handshakes'] += self.handshakes - handshakes
+                stats['handshake_time'] += self.handshake_time - handshake_time
+                self.logger.debug('{0} took {1:.3f}s with {2} SSH handshakes ({3:.3f}s)'.format(
+                    function.__name__, time.time() - start,
+                    self.handshakes - handshakes, self.handshake_time - handshake_time))
+    return wrapper
+
 
 class Connection:
 
@@ -28,6 +63,12 @@ class Connection:
         self.config_file = config_file
         self.log_file = log_file
         self.ssh = None
+        self.handshakes = 0
+        self.handshake_time = 0.0
+        self.ssh_stats = {}
+        # how much of the remote log is in the local copy
+        self.log_fetched = 0
+        self.log_head = b''
         if self.host:
             # ensure directories exist
             self.config_dir = '/etc/faucet'
@@ -48,53 +89,85 @@ class Connection:
                     os.makedirs(self.log_dir)
 
     def _connect(self):
+        ''' open the shared SSH connection, unless it is still up '''
+        if self.ssh:
+            transport = self.ssh.get_transport()
+            if transport and transport.is_active():
+                return
+            self._disconnect()
         # TODO better logging
         try:
+            start = time.time()
             ssh = SSHClient()
             ssh.set_missing_host_key_policy(AutoAddPolicy())
             ssh.load_system_host_keys()
             ssh.connect(self.host, username=self.user, password=self.pw,
                         timeout=10, auth_timeout=10, banner_timeout=10)
+            ssh.get_transport().set_keepalive(SSH_KEEPALIVE)
             self.ssh = ssh
+            self.handshakes += 1
+            self.handshake_time += time.time() - start
         except Exception as e:  # pragma: no cover
             self.logger.error('failed to connect because: {0}'.format(e))
 
     def _disconnect(self):
         if self.ssh:
             self.ssh.close()
+            self.ssh = None
+
+    def _with_ssh(self, action):
+        '''
+        run action on the shared SSH connection. if the connection turns
+        out to have dropped it is reopened and action is tried once more.
+        '''
+        self._connect()
+        try:
+            return action()
+        except (SSHException, EOFError, ConnectionError) as e:
+            self.logger.warning(
+                'SSH connection lost, reconnecting because: {0}'.format(e))
+            self._disconnect()
+            self._connect()
+            return action()
 
     def exec_command(self, command):
-        pass
+        if self.host:
+            try:
+                def run():
+                    _, stdout, _ = self.ssh.exec_command(command, timeout=10)
+                    return stdout.read()
+                return self._with_ssh(run)
+            except Exception as e:  # pragma: no cover
+                self.logger.error(
+                    'failed to run {0} because: {1}'.format(command, e))
+        return None
 
     def receive_file(self, f_type):
         # TODO option to receive other files (config can be multiple files)
         if self.host:
-            self._connect()
             # TODO better logging
-            try:
-                scp = SCPClient(self.ssh.get_transport())
+            def receive():
                 if f_type == 'config':
+                    scp = SCPClient(self.ssh.get_transport())
                     scp.get(self.config_file,
                             local_path=os.path.join(self.config_dir,
                                                     'faucet.yaml'))
+                    scp.close()
                 elif f_type == 'log':
-                    scp.get(self.log_file,
-                            local_path=os.path.join(self.log_dir,
-                                                    'faucet.log'))
+                    self._receive_log()
                 else:
                     pass
-                scp.close()
+            try:
+                self._with_ssh(receive)
             except Exception as e:  # pragma: no cover
                 self.logger.error(
                     'failed to receive file {0} because: {1}'.format(f_type, e))
-            self._disconnect()
 
     def send_file(self, f_type):
         # TODO option to send other files (config can be multiple files)
         if self.host:
-            self._connect()
             # TODO better logging
-            try:
+            def send():
                 scp = SCPClient(self.ssh.get_transport())
                 if f_type == 'config':
                     scp.put(os.path.join(self.config_dir, 'faucet.yaml'),
@@ -105,7 +178,44 @@ class Connection:
                 else:
                     pass
                 scp.close()
+            try:
+                self._with_ssh(send)
             except Exception as e:  # pragma: no cover
                 self.logger.error(
                     'failed to send file {0} because: {1}'.format(f_type, e))
-            self._disconnect()
+
+    def _receive_log(self):
+        '''
+        append what was added to the remote log since the last fetch to the
+        local copy. if the remote log shrank or its first bytes changed it
+        was truncated or rotated, and the local copy is replaced instead.
+        '''
+        local_log = os.path.join(self.log_dir, 'faucet.log')
+        sftp = self.ssh.open_sftp()
+        try:
+            size = sftp.stat(self.log_file).st_size
+            with sftp.open(self.log_file, 'rb') as remote:
+                if size < self.log_fetched or remote.read(len(self.log_head)) != self.log_head:
+                    self.log_fetched = 0
+                    self.log_head = b''
+                if self.log_fetched:
+                    local_path = local_log
+                else:
+                    # a new file, so a tail of the local copy sees a rotation
+                    local_path = local_log + '.tmp'
+                remote.seek(self.log_fetched)
+                with open(local_path, 'ab' if self.log_fetched else 'wb') as local:
+                    while self.log_fetched < size:
+                        data = remote.read(min(size - self.log_fetched, 32768))
+                        if not data:
+                            break
+                        local.write(data)
+                        self.log_fetched += len(data)
+                if local_path != local_log:
+                    os.replace(local_path, local_log)
+                if len(self.log_head) < LOG_HEAD_BYTES:
+                    remote.seek(0)
+                    self.log_head = remote.read(
+                        min(LOG_HEAD_BYTES, self.log_fetched))
+        finally:
+            sftp.close()
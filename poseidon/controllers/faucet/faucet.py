@@ -6,8 +6,14 @@ Created on 17 November 2017
 import ipaddress
 import json
 import logging
+import threading
+from contextlib import contextmanager
+from copy import deepcopy
 
+from poseidon.controllers.faucet.acl_planner import AclPlanner
 from poseidon.controllers.faucet.connection import Connection
+from poseidon.controllers.faucet.connection import ssh_timed
+from poseidon.controllers.faucet.mac_table import MacTable
 from poseidon.controllers.faucet.parser import Parser
 from poseidon.volos.volos import Volos
 from poseidon.volos.coprocessor import Coprocessor
@@ -68,7 +74,18 @@ class FaucetProxy(Connection, Parser):
             self.ignore_ports,
             self.trunk_ports, *args, **kwargs)
         self.logger = logging.getLogger('faucet')
-        self.mac_table = {}
+        self.mac_table = MacTable(controller['mac_history_size'])
+        self.log_tail = None
+        self.rule_engine = None
+        self.acl_planner = AclPlanner()
+        self.pending_includes = {}
+        self.pending_plans = []
+        # the config being edited while a config_transaction() is open,
+        # by the thread holding config_lock until it is written out
+        self.config_lock = threading.RLock()
+        self.in_transaction = False
+        self.config_doc = None
+        self.config_original = None
 
     @staticmethod
     def format_endpoints(data, controller):
@@ -136,151 +153,165 @@ class FaucetProxy(Connection, Parser):
             if self.host:
                 self.receive_file('log')
             self.log(self.log_file)
+        # copies, format_endpoints() rewrites what it is given
         for mac in self.mac_table:
             if self.learn_pub_adds:
-                retval.append(self.mac_table[mac])
+                retval.append(self.mac_table.history(mac))
             else:
                 # only allow private addresses
                 if 'ip-address' in self.mac_table[mac][0] and (self.mac_table[mac][0]['ip-address'] == 'None' or
                                                                self.mac_table[mac][0]['ip-address'] is None or
                                                                not ipaddress.ip_address(self.mac_table[mac][0]['ip-address']).is_global):
-                    retval.append(self.mac_table[mac])
+                    retval.append(self.mac_table.history(mac))
         return retval
 
-    def update_acls(self, rules_file=None, endpoints=None, force_apply_rules=None, force_remove_rules=None):
+    @contextmanager
+    def config_transaction(self):
+        '''
+        batch config edits: inside the block mirror_mac, unmirror_mac,
+        update_acls and the other edits change one copy of the FAUCET
+        config, fetched at the first edit and, if it changed, written and
+        sent back once when the block ends, along with any ACL include
+        files. if the block raises, none of its edits are written. other
+        threads wait to edit the config until then.
+        '''
+        with self.config_lock:
+            if self.in_transaction:
+                yield
+                return
+            self.in_transaction = True
+            try:
+                yield
+                if self.config_doc and self.config_doc != self.config_original:
+                    if self.flush_config(self.get_config_file(self.config_file),
+                                         self.config_doc) and self.host:
+                        self.send_file('config')
+                else:
+                    self.flush_config()
+            finally:
+                self.discard_config()
+                self.in_transaction = False
+                self.config_doc = None
+                self.config_original = None
+
+    def _transaction_doc(self):
+        if self.config_doc is None:
+            if self.host:
+                self.receive_file('config')
+            self.config_doc = self.yaml_in(
+                self.get_config_file(self.config_file))
+            self.config_original = deepcopy(self.config_doc)
+        return self.config_doc
+
+    def _edit_config(self, action, port, switch, **kwargs):
+        ''' apply one config edit, as part of the open transaction if any '''
+        with self.config_lock:
+            if self.in_transaction:
+                return self.config(self.config_file, action, port, switch,
+                                   obj_doc=self._transaction_doc(), **kwargs)
+            if self.host:
+                self.receive_file('config')
+                status = self.config(self.config_file, action, port, switch, **kwargs)
+                if status:
+                    self.send_file('config')
+                # TODO check if config was successfully updated
+                return status
+            return self.config(self.config_file, action, port, switch, **kwargs)
+
+    @ssh_timed
+    def update_acls(self, rules_file=None, endpoints=None, force_apply_rules=None, force_remove_rules=None,
+                    coprocess_rules_files=None, changed_endpoints=None):
         self.logger.debug('updating acls')
-        status = None
-        if self.host:
-            self.receive_file('config')
-            if self.config(self.config_file,
-                           'apply_acls', None, None, rules_file=rules_file, endpoints=endpoints, force_apply_rules=force_apply_rules, force_remove_rules=force_remove_rules):
-                self.send_file('config')
-                status = True
-        else:
-            status = self.config(self.config_file, 'apply_acls',
-                                 None, None, rules_file=rules_file, endpoints=endpoints, force_apply_rules=force_apply_rules, force_remove_rules=force_remove_rules)
-        # TODO check if config was successfully updated
-        return status
+        return self._edit_config('apply_acls', None, None, rules_file=rules_file, endpoints=endpoints,
+                                 force_apply_rules=force_apply_rules, force_remove_rules=force_remove_rules,
+                                 coprocess_rules_files=coprocess_rules_files,
+                                 changed_endpoints=changed_endpoints)
+
+    def dry_run_acls(self, rules_file=None, endpoints=None, changed_endpoints=None,
+                     force_apply_rules=None, force_remove_rules=None):
+        '''
+        the acls_in changes update_acls would make, as a list of
+        {switch, port, current, desired, added, removed}, without
+        changing the FAUCET config
+        '''
+        with self.config_lock:
+            if self.in_transaction:
+                obj_doc = deepcopy(self._transaction_doc())
+            else:
+                obj_doc = self.yaml_in(self.get_config_file(self.config_file))
+        if not obj_doc or not endpoints:
+            return []
+        rules_doc = self.parse_rules(rules_file)
+        if not rules_doc or 'rules' not in rules_doc:
+            return []
+        plan = self.plan_acls(obj_doc, rules_doc, endpoints,
+                              changed_endpoints=changed_endpoints,
+                              force_apply_rules=force_apply_rules,
+                              force_remove_rules=force_remove_rules)
+        return plan.changes
 
+    @ssh_timed
     def shutdown_ip(self, ip_addr, shutdown=True, mac_addr=None):
         shutdowns = []
         port = 0
         switch = None
-        if self.host:
-            self.receive_file('config')
-            if self.config(self.config_file,
-                           'shutdown', int(port), switch):
-                self.send_file('config')
-        else:
-            self.config(self.config_file, 'shutdown', int(port), switch)
-        # TODO check if config was successfully updated
+        self._edit_config('shutdown', int(port), switch)
         return shutdowns
 
+    @ssh_timed
     def shutdown_endpoint(self):
         port = 0
         switch = None
-        if self.host:
-            self.receive_file('config')
-            if self.config(self.config_file,
-                           'shutdown', int(port), switch):
-                self.send_file('config')
-        else:
-            self.config(self.config_file, 'shutdown', int(port), switch)
-        # TODO check if config was successfully updated
+        self._edit_config('shutdown', int(port), switch)
 
+    @ssh_timed
     def mirror_mac(self, my_mac, my_switch, my_port):
         self.logger.debug('mirroring mac')
-        port = None
-        switch = None
         status = None
-        for mac in self.mac_table:
-            if my_mac == mac:
-                port = self.mac_table[mac][0]['port']
-                switch = self.mac_table[mac][0]['segment']
+        switch, port = self.mac_table.location(my_mac)
         if port and switch:
-            if self.host:
-                self.receive_file('config')
-                if self.config(self.config_file,
-                               'mirror', int(port), switch):
-                    self.send_file('config')
-                    # TODO check if this is actually True
-                    status = True
-            else:
-                status = self.config(
-                    self.config_file, 'mirror', int(port), switch)
+            status = self._edit_config('mirror', int(port), switch)
         else:
             status = False
         self.logger.debug('mirror status: ' + str(status))
         return status
 
+    @ssh_timed
     def unmirror_mac(self, my_mac, my_switch, my_port):
-        port = 0
-        switch = None
         status = None
-        for mac in self.mac_table:
-            if my_mac == mac:
-                port = self.mac_table[mac][0]['port']
-                switch = self.mac_table[mac][0]['segment']
+        switch, port = self.mac_table.location(my_mac)
         if port and switch:
             trunk = False
             for sw in self.trunk_ports:
                 if sw == switch and self.trunk_ports[sw].split(',')[1] == str(port):
                     trunk = True
             if not trunk:
-                if self.host:
-                    self.receive_file('config')
-                    if self.config(self.config_file,
-                                   'unmirror', int(port), switch):
-                        self.send_file('config')
-                        # TODO check if config was successfully updated
-                        status = True
-                else:
-                    status = self.config(
-                        self.config_file, 'unmirror', int(port), switch)
+                status = self._edit_config('unmirror', int(port), switch)
             else:
                 self.logger.debug('not unmirroring a trunk port')
         self.logger.debug('unmirror status: ' + str(status))
         return status
 
+    @ssh_timed
     def coprocess_mac(self, my_mac):
         self.logger.debug('coprocess mac: {0}'.format(my_mac))
-        for mac in self.mac_table:
-            if my_mac == mac:
-                port = self.mac_table[mac][0]['port']
-                switch = self.mac_table[mac][0]['segment']
-        if self.host:
-            self.receive_file('config')
-            if self.config(self.config_file,
-                           'coprocess', int(port), switch):
-                self.send_file('config')
-                # TODO check if this is actually True
-                status = True
+        status = None
+        switch, port = self.mac_table.location(my_mac)
+        if port and switch:
+            status = self._edit_config('coprocess', int(port), switch)
         else:
-            status = self.config(
-                self.config_file, 'coprocess', int(port), switch)
+            status = False
 
         self.logger.debug('coprocess status: ' + str(status))
         return status
 
+    @ssh_timed
     def uncoprocess_mac(self, my_mac):
         self.logger.debug('uncoprocess mac: {0}'.format(my_mac))
-        port = 0
-        for mac in self.mac_table:
-            if my_mac == mac:
-                port = self.mac_table[mac][0]['port']
-                switch = self.mac_table[mac][0]['segment']
-
-                if self.host:
-                    self.receive_file('config')
-                    if self.config(self.config_file,
-                                   'uncoprocess', int(port), switch):
-                        self.send_file('config')
-                        # TODO check if config was successfully updated
-                        status = True
-                else:
-                    status = self.config(
-                        self.config_file, 'uncoprocess', int(port), switch)
+        status = None
+        switch, port = self.mac_table.location(my_mac)
+        if port and switch:
+            status = self._edit_config('uncoprocess', int(port), switch)
 
         self.logger.debug('uncoprocess status: ' + str(status))
         return status
-
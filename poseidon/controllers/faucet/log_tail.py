@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental reader for the FAUCET log.
+
+Created on 16 October 2026
+"""
+import os
+
+
+class LogTail:
+    '''
+    Returns the complete lines appended to a file since the last read.
+
+    The file stays open between reads and its inode and offset are
+    remembered. If the path now names a different file (rotation), what is
+    left of the old file is read before switching. If the file shrank
+    (truncation), reading starts again from the beginning. A trailing line
+    without a newline is held back until it is finished.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.inode = None
+        self.offset = 0
+        self.partial = b''
+
+    def _open(self):
+        try:
+            self.f = open(self.path, 'rb')
+        except FileNotFoundError:
+            self.f = None
+            return
+        self.inode = os.fstat(self.f.fileno()).st_ino
+        self.offset = 0
+        self.partial = b''
+
+    def _lines(self, final=False):
+        data = self.f.read()
+        self.offset += len(data)
+        data = self.partial + data
+        if final:
+            self.partial = b''
+            if data.endswith(b'\n'):
+                data = data[:-1]
+        else:
+            data, _, self.partial = data.rpartition(b'\n')
+        if not data:
+            return []
+        return data.decode('utf-8', 'replace').split('\n')
+
+    def read_lines(self):
+        lines = []
+        if self.f is not None:
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                st = None
+            if st is None or st.st_ino != self.inode:
+                # rotated, finish what is left of the old file first
+                lines = self._lines(final=True)
+                self.close()
+            elif st.st_size < self.offset:
+                # truncated
+                self.f.seek(0)
+                self.offset = 0
+                self.partial = b''
+        if self.f is None:
+            self._open()
+        if self.f is not None:
+            lines.extend(self._lines())
+        return lines
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Learned host table for FAUCET, indexed by MAC, by the (switch, port) each
+host was last seen on and by VLAN.
+
+Created on 16 October 2026
+"""
+
+
+class MacTable:
+    '''
+    mac -> list of learned records, newest first, capped at max_history
+    records per MAC. The location and VLAN indexes follow the newest record
+    of each MAC, so finding the hosts on a port or in a VLAN only touches
+    those hosts.
+    '''
+
+    def __init__(self, max_history=10):
+        self.max_history = max_history
+        self.hosts = {}
+        self.by_location = {}
+        self.by_vlan = {}
+
+    @staticmethod
+    def _location(data):
+        return (data.get('segment', None), data.get('port', None))
+
+    def _unindex(self, mac):
+        head = self.hosts[mac][0]
+        for index, key in ((self.by_location, self._location(head)),
+                           (self.by_vlan, head.get('tenant', None))):
+            macs = index.get(key, None)
+            if macs is not None:
+                macs.discard(mac)
+                if not macs:
+                    del index[key]
+
+    def _index(self, mac):
+        head = self.hosts[mac][0]
+        self.by_location.setdefault(self._location(head), set()).add(mac)
+        self.by_vlan.setdefault(head.get('tenant', None), set()).add(mac)
+
+    def learn(self, mac, data):
+        ''' record data as the newest record for mac, moving a repeat to the front '''
+        history = self.hosts.get(mac, None)
+        if history is None:
+            self.hosts[mac] = [data]
+        else:
+            self._unindex(mac)
+            if data in history:
+                history.remove(data)
+            history.insert(0, data)
+            del history[self.max_history:]
+        self._index(mac)
+
+    def expire(self, mac):
+        ''' mark the newest record of mac inactive '''
+        if mac in self.hosts:
+            self.hosts[mac][0]['active'] = 0
+
+    def port_down(self, segment, port):
+        ''' mark every host last seen on (segment, port) inactive '''
+        for mac in self.by_location.get((segment, port), ()):
+            self.hosts[mac][0]['active'] = 0
+
+    def macs_on_port(self, segment, port):
+        return set(self.by_location.get((segment, port), ()))
+
+    def macs_in_vlan(self, vlan):
+        return set(self.by_vlan.get(vlan, ()))
+
+    def location(self, mac):
+        ''' (segment, port) mac was last seen on, or (None, None) '''
+        history = self.hosts.get(mac, None)
+        if not history:
+            return (None, None)
+        return self._location(history[0])
+
+    def history(self, mac):
+        ''' a copy of the records of mac, safe for callers to modify '''
+        return [dict(data) for data in self.hosts.get(mac, [])]
+
+    def get(self, mac, default=None):
+        return self.hosts.get(mac, default)
+
+    def __contains__(self, mac):
+        return mac in self.hosts
+
+    def __getitem__(self, mac):
+        return self.hosts[mac]
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def __eq__(self, other):
+        if isinstance(other, MacTable):
+            return self.hosts == other.hosts
+        return self.hosts == other
@@ -3,18 +3,76 @@
 Created on 19 November 2017
 @author: Charlie Lewis
 """
+import hashlib
 import logging
+import os
+import threading
 from copy import deepcopy
 
 import yaml
 
+from poseidon.controllers.faucet.acl_planner import AclPlanner
+from poseidon.controllers.faucet.log_tail import LogTail
+from poseidon.controllers.faucet.mac_table import MacTable
+from poseidon.controllers.faucet.rules import RuleEngine
 from poseidon.helpers.exception_decor import exception
 
 
+# use libyaml when it is available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, 'CDumper', yaml.Dumper)
+
+
 def represent_none(dumper, _):
     return dumper.represent_scalar('tag:yaml.org,2002:null', '')
 
 
+yaml.add_representer(type(None), represent_none, Dumper=YAML_DUMPER)
+
+
+class YamlCache:
+    '''
+    Parsed YAML documents by path. A cached document is reused while the
+    file's mtime and size are unchanged, or when they changed but the
+    content hash did not. Callers get a copy they are free to change.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        st = os.stat(path)
+        with self.lock:
+            cached = self.docs.get(path, None)
+            if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+                self.hits += 1
+                return deepcopy(cached[3])
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        with self.lock:
+            cached = self.docs.get(path, None)
+            if cached and cached[2] == digest:
+                self.docs[path] = (st.st_mtime_ns, st.st_size, digest, cached[3])
+                self.hits += 1
+                return deepcopy(cached[3])
+        obj_doc = yaml.load(content, Loader=YAML_LOADER)
+        with self.lock:
+            self.misses += 1
+            self.docs[path] = (st.st_mtime_ns, st.st_size, digest, obj_doc)
+        return deepcopy(obj_doc)
+
+    def invalidate(self, path):
+        with self.lock:
+            self.docs.pop(path, None)
+
+
+YAML_CACHE = YamlCache()
+
+
 class Parser:
 
     def __init__(self,
@@ -31,6 +89,14 @@ class Parser:
         self.ignore_vlans = ignore_vlans
         self.copro_port = copro_port
         self.copro_vlan = copro_vlan
+        self.mac_table = MacTable()
+        self.log_tail = None
+        self.rule_engine = None
+        self.acl_planner = AclPlanner()
+        # include files and ACL plans of config() edits not yet written
+        # out, see flush_config()
+        self.pending_includes = {}
+        self.pending_plans = []
 
     @staticmethod
     @exception
@@ -45,9 +111,7 @@ class Parser:
     @exception
     def yaml_in(config_file):
         try:
-            stream = open(config_file, 'r')
-            obj_doc = yaml.safe_load(stream)
-            stream.close()
+            obj_doc = YAML_CACHE.load(config_file)
         except Exception as e:  # pragma: no cover
             return False
         return obj_doc
@@ -55,9 +119,10 @@ class Parser:
     @staticmethod
     @exception
     def yaml_out(config_file, obj_doc):
-        stream = open(config_file, 'w')
-        yaml.add_representer(type(None), represent_none)
-        yaml.dump(obj_doc, stream, default_flow_style=False)
+        YAML_CACHE.invalidate(config_file)
+        with open(config_file, 'w') as stream:
+            yaml.dump(obj_doc, stream, Dumper=YAML_DUMPER,
+                      default_flow_style=False)
         return True
 
     @staticmethod
@@ -86,11 +151,43 @@ class Parser:
         obj_doc = Parser().yaml_in(config_file)
         return obj_doc
 
-    def config(self, config_file, action, port, switch, rules_file=None, endpoints=None, force_apply_rules=None, force_remove_rules=None, coprocess_rules_files=None):
+    def flush_config(self, config_file=None, obj_doc=None):
+        '''
+        write the include files and, given obj_doc, the config that the
+        edits since the last flush or discard call for, then commit their
+        ACL plans. nothing is committed if a write fails.
+        '''
+        includes, self.pending_includes = self.pending_includes, {}
+        plans, self.pending_plans = self.pending_plans, []
+        for include_file, include_doc in includes.items():
+            if not self.yaml_out(include_file, include_doc):
+                return False
+        if obj_doc is not None and not self.yaml_out(config_file, obj_doc):
+            return False
+        for plan in plans:
+            self.acl_planner.commit(plan)
+        return True
+
+    def discard_config(self):
+        ''' drop the include files and ACL plans of edits not written out '''
+        self.pending_includes = {}
+        self.pending_plans = []
+
+    def config(self, config_file, action, port, switch, rules_file=None, endpoints=None, force_apply_rules=None, force_remove_rules=None, coprocess_rules_files=None, obj_doc=None, changed_endpoints=None):
+        '''
+        apply one action to the FAUCET config. given obj_doc, that already
+        loaded config is changed in place and writing it, and the include
+        files the edit calls for, is left to the caller's flush_config().
+        otherwise the config is loaded from and written back to
+        config_file.
+        '''
         status = [True, []]
         switch_found = None
         config_file = Parser().get_config_file(config_file)
-        obj_doc = Parser().yaml_in(config_file)
+        write = obj_doc is None
+        if write:
+            self.discard_config()
+            obj_doc = Parser().yaml_in(config_file)
 
         if not obj_doc:
             return False
@@ -203,7 +300,7 @@ class Parser:
                                 acls_doc = Parser().yaml_in(f)
                             else:
                                 acls_doc = Parser().yaml_in(rules_path+'/'+f)
-                            Parser().yaml_out(config_path+'/poseidon_'+acls_filename, acls_doc)
+                            self.pending_includes[config_path+'/poseidon_'+acls_filename] = acls_doc
                             rewrite = True
                             self.logger.info(
                                 'Adding {0} to config'.format(acls_filename))
@@ -222,7 +319,7 @@ class Parser:
                                 'Include file {0} was not found, ACLs may not be working as expected'.format(f))
                         else:
                             obj_doc['include'] = ['poseidon_'+acls_filename]
-                            Parser().yaml_out(config_path+'/poseidon_'+acls_filename, acls_doc)
+                            self.pending_includes[config_path+'/poseidon_'+acls_filename] = acls_doc
                             rewrite = True
                             self.logger.info(
                                 'Adding {0} to config'.format(acls_filename))
@@ -254,124 +351,25 @@ class Parser:
                             self.logger.info(
                                 'Using named ACL: {0}, but it was not found in included ACL files, assuming ACL name exists in Faucet config'.format(acl))
 
-                for endpoint in endpoints:
-                    if endpoint.endpoint_data['segment'] in obj_doc['dps'] and 'acls_in' in obj_doc['dps'][endpoint.endpoint_data['segment']]['interfaces'][int(
-                            endpoint.endpoint_data['port'])]:
-                        existing_acls = obj_doc['dps'][endpoint.endpoint_data['segment']]['interfaces'][int(
-                            endpoint.endpoint_data['port'])]['acls_in']
-                    else:
-                        existing_acls = []
-                    all_rule_acls = []
-                    for rule in rules:
-                        matches = 0
-                        for r in rules[rule]:
-                            if('rule' in r and 'device_key' in r['rule'] and
-                                    r['rule']['device_key'] == 'os'):
-                                match = False
-                                if 'ipv4_addresses' in endpoint.metadata:
-                                    for ip in endpoint.metadata['ipv4_addresses']:
-                                        if 'os' in endpoint.metadata['ipv4_addresses'][ip] and endpoint.metadata['ipv4_addresses'][ip]['os'] == r['rule']['value']:
-                                            self.logger.info('IPv4 os match: {0} {1}, rule: {2}'.format(
-                                                ip, r['rule']['value'], rule))
-                                            match = True
-                                if 'ipv6_addresses' in endpoint.metadata:
-                                    for ip in endpoint.metadata['ipv6_addresses']:
-                                        if 'os' in endpoint.metadata['ipv6_addresses'][ip] and endpoint.metadata['ipv6_addresses'][ip]['os'] == r['rule']['value']:
-                                            self.logger.info('IPv6 os match: {0} {1}, rule: {2}'.format(
-                                                ip, r['rule']['value'], rule))
-                                            match = True
-                                if match:
-                                    matches += 1
-                            elif('rule' in r and 'device_key' in r['rule'] and
-                                 r['rule']['device_key'] == 'role'):
-                                match = False
-                                if 'mac_addresses' in endpoint.metadata:
-                                    for mac in endpoint.metadata['mac_addresses']:
-                                        most_recent = 0
-                                        for record in endpoint.metadata['mac_addresses'][mac]:
-                                            if float(record) > most_recent:
-                                                most_recent = float(record)
-                                        most_recent = str(most_recent)
-                                        if most_recent != '0' and most_recent in endpoint.metadata['mac_addresses'][mac] and 'labels' in endpoint.metadata['mac_addresses'][mac][most_recent] and 'confidences' in endpoint.metadata['mac_addresses'][mac][most_recent]:
-                                            # check top three
-                                            for i in range(3):
-                                                if endpoint.metadata['mac_addresses'][mac][most_recent]['labels'][i] == r['rule']['value']:
-                                                    if 'min_confidence' in r['rule']['value']:
-                                                        if float(endpoint.metadata['mac_addresses'][mac][most_recent]['confidences'][i])*100 >= r['rule']['min_confidence']:
-                                                            self.logger.info('Confidence match: {0} {1}, rule: {2}'.format(mac, float(
-                                                                endpoint.metadata['mac_addresses'][mac][most_recent]['confidences'][i])*100, rule))
-                                                            match = True
-                                                    else:
-                                                        self.logger.info('Role match: {0} {1}, rule: {2}'.format(
-                                                            mac, r['rule']['value'], rule))
-                                                        match = True
-                                if match:
-                                    matches += 1
-                            elif('rule' in r and 'device_key' in r['rule'] and
-                                 r['rule']['device_key'] == 'behavior'):
-                                match = False
-                                if 'mac_addresses' in endpoint.metadata:
-                                    for mac in endpoint.metadata['mac_addresses']:
-                                        most_recent = 0
-                                        for record in endpoint.metadata['mac_addresses'][mac]:
-                                            if float(record) > most_recent:
-                                                most_recent = float(record)
-                                        most_recent = str(most_recent)
-                                        if most_recent != '0' and most_recent in endpoint.metadata['mac_addresses'][mac] and 'behavior' in endpoint.metadata['mac_addresses'][mac][most_recent] and endpoint.metadata['mac_addresses'][mac][most_recent]['behavior'] == r['rule']['value']:
-                                            self.logger.info('Behavior match: {0} {1}, rule: {2}'.format(
-                                                mac, r['rule']['value'], rule))
-                                            match = True
-                                if match:
-                                    matches += 1
-                        if matches == len(rules[rule]) or (force_apply_rules and rule in force_apply_rules):
-                            rule_acls = []
-                            for r in rules[rule]:
-                                rule_acls += r['rule']['acls']
-                                all_rule_acls += r['rule']['acls']
-                            rule_acls = list(set(rule_acls))
-                            if rule_acls:
-                                if int(endpoint.endpoint_data['port']) not in obj_doc['dps'][endpoint.endpoint_data['segment']]['interfaces']:
-                                    obj_doc['dps'][endpoint.endpoint_data['segment']]['interfaces'][int(
-                                        endpoint.endpoint_data['port'])] = {}
-                            if 'acls_in' not in obj_doc['dps'][endpoint.endpoint_data['segment']]['interfaces'][int(endpoint.endpoint_data['port'])]:
-                                self.logger.info('All rules met for: {0} on switch: {1} and port: {2}; applying ACLs: {3}'.format(
-                                    endpoint.endpoint_data['mac'], endpoint.endpoint_data['segment'], endpoint.endpoint_data['port'], rule_acls))
-                                obj_doc['dps'][endpoint.endpoint_data['segment']]['interfaces'][int(
-                                    endpoint.endpoint_data['port'])]['acls_in'] = rule_acls
-                                status[1].append(['added acls', endpoint.endpoint_data['mac'],
-                                                  endpoint.endpoint_data['segment'], endpoint.endpoint_data['port'], rule_acls, rule])
-                                rewrite = True
-                            else:
-                                # add new ACLs
-                                orig_rule_acls = rule_acls
-                                rule_acls += obj_doc['dps'][endpoint.endpoint_data['segment']]['interfaces'][int(
-                                    endpoint.endpoint_data['port'])]['acls_in']
-                                rule_acls = list(set(rule_acls))
-                                if obj_doc['dps'][endpoint.endpoint_data['segment']]['interfaces'][int(
-                                        endpoint.endpoint_data['port'])]['acls_in'] != rule_acls:
-                                    obj_doc['dps'][endpoint.endpoint_data['segment']]['interfaces'][int(
-                                        endpoint.endpoint_data['port'])]['acls_in'] = rule_acls
-                                    self.logger.info('All rules met for: {0} on switch: {1} and port: {2}; applying ACLs: {3}'.format(
-                                        endpoint.endpoint_data['mac'], endpoint.endpoint_data['segment'], endpoint.endpoint_data['port'], orig_rule_acls))
-                                    status[1].append(['added acls', endpoint.endpoint_data['mac'],
-                                                      endpoint.endpoint_data['segment'], endpoint.endpoint_data['port'], orig_rule_acls, rule])
-                                    rewrite = True
-                        # remove ACLs that were previously applied
-                        all_rule_acls = list(set(all_rule_acls))
-                        removed_acls = []
-                        for acl in existing_acls:
-                            if acl in acls and (acl not in all_rule_acls or acl in force_remove_rules):
-                                obj_doc['dps'][endpoint.endpoint_data['segment']]['interfaces'][int(
-                                    endpoint.endpoint_data['port'])]['acls_in'].remove(acl)
-                                self.logger.info('Removing no longer needed ACL: {0} for: {1} on switch: {2} and port: {3}'.format(
-                                    acl, endpoint.endpoint_data['mac'], endpoint.endpoint_data['segment'], endpoint.endpoint_data['port']))
-                                removed_acls.append(acl)
-                                rewrite = True
-                        if removed_acls:
-                            status[1].append(['removed acls', endpoint.endpoint_data['mac'],
-                                              endpoint.endpoint_data['segment'], endpoint.endpoint_data['port'], removed_acls])
+                plan = self.plan_acls(obj_doc, rules_doc, endpoints,
+                                      changed_endpoints=changed_endpoints,
+                                      force_apply_rules=force_apply_rules,
+                                      force_remove_rules=force_remove_rules)
+                for change in plan.changes:
+                    if change['added']:
+                        self.logger.info('Rules met on switch: {0} and port: {1}; applying ACLs: {2}'.format(
+                            change['switch'], change['port'], change['added']))
+                    if change['removed']:
+                        self.logger.info('Removing no longer needed ACLs: {0} on switch: {1} and port: {2}'.format(
+                            change['removed'], change['switch'], change['port']))
+                if self.acl_planner.apply(obj_doc, plan):
+                    rewrite = True
+                self.pending_plans.append(plan)
+                status[1].extend(plan.status)
 
             if not rewrite:
+                if write:
+                    self.flush_config()
                 return True
 
             if 'include' not in rules_doc:
@@ -407,9 +405,23 @@ class Parser:
                 self.logger.warning(
                     'Unable to remove empty mirror list because: {0}'.format(str(e)))
 
-        Parser().yaml_out(config_file, obj_doc)
+        if write and not self.flush_config(config_file, obj_doc):
+            return False
         return status
 
+    def plan_acls(self, obj_doc, rules_doc, endpoints, changed_endpoints=None,
+                  force_apply_rules=None, force_remove_rules=None):
+        '''
+        the acls_in changes rules_doc calls for on the ports of
+        changed_endpoints (of all endpoints if None), without applying them
+        '''
+        if self.rule_engine is None or self.rule_engine.rules_doc != rules_doc:
+            self.rule_engine = RuleEngine(rules_doc)
+        return self.acl_planner.plan(obj_doc, rules_doc, self.rule_engine, endpoints,
+                                     changed=changed_endpoints,
+                                     force_apply_rules=force_apply_rules,
+                                     force_remove_rules=force_remove_rules)
+
     def event(self, message):
         data = {}
         if 'L2_LEARN' in message:
@@ -433,87 +445,107 @@ class Parser:
                 data['vlan'] = 'VLAN'+str(message['L2_LEARN']['vid'])
                 data['tenant'] = 'VLAN'+str(message['L2_LEARN']['vid'])
                 data['active'] = 1
-                if message['L2_LEARN']['eth_src'] in self.mac_table:
-                    dup = False
-                    for d in self.mac_table[message['L2_LEARN']['eth_src']]:
-                        if data == d:
-                            dup = True
-                    if dup:
-                        self.mac_table[message['L2_LEARN']
-                                       ['eth_src']].remove(data)
-                    self.mac_table[message['L2_LEARN']
-                                   ['eth_src']].insert(0, data)
-                else:
-                    self.mac_table[message['L2_LEARN']['eth_src']] = [data]
+                self.mac_table.learn(message['L2_LEARN']['eth_src'], data)
             else:
                 self.logger.debug(
                     'ignoring endpoint because it belongs to the ignore_vlans or ignore_ports list')
         elif 'L2_EXPIRE' in message:
             self.logger.debug(
                 'got faucet message for l2_expire: {0}'.format(message))
-            if message['L2_EXPIRE']['eth_src'] in self.mac_table:
-                self.mac_table[message['L2_EXPIRE']
-                               ['eth_src']][0]['active'] = 0
+            self.mac_table.expire(message['L2_EXPIRE']['eth_src'])
         elif 'PORT_CHANGE' in message:
             self.logger.debug(
                 'got faucet message for port_change: {0}'.format(message))
             if not message['PORT_CHANGE']['status']:
-                m_table = self.mac_table.copy()
-                for mac in m_table:
-                    for data in m_table[mac]:
-                        if (str(message['PORT_CHANGE']['port_no']) == data['port'] and
-                                str(message['dp_name']) == data['segment']):
-                            if mac in self.mac_table:
-                                self.mac_table[mac][0]['active'] = 0
+                self.mac_table.port_down(
+                    str(message['dp_name']), str(message['PORT_CHANGE']['port_no']))
         return
 
+    @staticmethod
+    def coalesce_events(messages):
+        '''
+        reduce a burst of FAUCET events to the latest effective state per
+        (dp_name, eth_src): the last L2_LEARN for each distinct port, vlan
+        and address, and an L2_EXPIRE only if it came after the last learn.
+        PORT_CHANGE and any other event is kept and nothing is merged
+        across it. Kept events stay in their original order.
+        '''
+        keep = []
+        learns = {}
+        last_learn = {}
+        expires = {}
+
+        def flush():
+            keep.extend(learns.values())
+            for key, i in expires.items():
+                if i > last_learn.get(key, -1):
+                    keep.append(i)
+            learns.clear()
+            last_learn.clear()
+            expires.clear()
+
+        for i, message in enumerate(messages):
+            if 'L2_LEARN' in message:
+                learn = message['L2_LEARN']
+                key = (message.get('dp_name', None), learn.get('eth_src', None))
+                learns[key + (learn.get('port_no', None), learn.get('vid', None),
+                              learn.get('l3_src_ip', None))] = i
+                last_learn[key] = i
+            elif 'L2_EXPIRE' in message:
+                key = (message.get('dp_name', None),
+                       message['L2_EXPIRE'].get('eth_src', None))
+                expires[key] = i
+            else:
+                flush()
+                keep.append(i)
+        flush()
+        return [messages[i] for i in sorted(keep)]
+
     def log(self, log_file):
+        ''' parse the lines appended to the log since the last call '''
         self.logger.debug('parsing log file')
         if not log_file:
             # default to FAUCET default
             log_file = '/var/log/faucet/faucet.log'
-        # NOTE very fragile, prone to errors
+        if self.log_tail is None or self.log_tail.path != log_file:
+            if self.log_tail:
+                self.log_tail.close()
+            self.log_tail = LogTail(log_file)
         try:
-            with open(log_file, 'r') as f:
-                for line in f:
-                    if 'L2 learned' in line:
-                        learned_mac = line.split()
-                        data = {'ip-address': learned_mac[16][0:-1],
-                                'ip-state': 'L2 learned',
-                                'mac': learned_mac[10],
-                                'segment': learned_mac[7][1:-1],
-                                'port': learned_mac[22],
-                                'tenant': learned_mac[24] + learned_mac[25],
-                                'active': 1}
-                        if learned_mac[10] in self.mac_table:
-                            dup = False
-                            for d in self.mac_table[learned_mac[10]]:
-                                if data == d:
-                                    dup = True
-                            if dup:
-                                self.mac_table[learned_mac[10]].remove(data)
-                            self.mac_table[learned_mac[10]].insert(0, data)
-                        else:
-                            self.mac_table[learned_mac[10]] = [data]
-                    elif ', expired [' in line:
-                        expired_mac = line.split(', expired [')
-                        expired_mac = expired_mac[1].split()[0]
-                        if expired_mac in self.mac_table:
-                            self.mac_table[expired_mac][0]['active'] = 0
-                    elif ' Port ' in line:
-                        # try and see if it was a port down event
-                        # this will break if more than one port expires at the same time TODO
-                        port_change = line.split(' Port ')
-                        dpid = port_change[0].split()[-2]
-                        port_change = port_change[1].split()
-                        if port_change[1] == 'down':
-                            m_table = self.mac_table.copy()
-                            for mac in m_table:
-                                for data in m_table[mac]:
-                                    if (port_change[0] == data['port'] and
-                                            dpid == data['segment']):
-                                        self.mac_table[mac][0]['active'] = 0
-        except Exception as e:
+            lines = self.log_tail.read_lines()
+        except Exception as e:  # pragma: no cover
             self.logger.error(
-                'Error parsing Faucet log file {0}'.format(str(e)))
+                'Error reading Faucet log file {0}'.format(str(e)))
+            return
+        # NOTE very fragile, prone to errors
+        for line in lines:
+            try:
+                self.log_line(line)
+            except Exception as e:
+                self.logger.error(
+                    'Error parsing Faucet log file {0}'.format(str(e)))
         return
+
+    def log_line(self, line):
+        if 'L2 learned' in line:
+            learned_mac = line.split()
+            data = {'ip-address': learned_mac[16][0:-1],
+                    'ip-state': 'L2 learned',
+                    'mac': learned_mac[10],
+                    'segment': learned_mac[7][1:-1],
+                    'port': learned_mac[22],
+                    'tenant': learned_mac[24] + learned_mac[25],
+                    'active': 1}
+            self.mac_table.learn(learned_mac[10], data)
+        elif ', expired [' in line:
+            expired_mac = line.split(', expired [')
+            expired_mac = expired_mac[1].split()[0]
+            self.mac_table.expire(expired_mac)
+        elif ' Port ' in line:
+            # try and see if it was a port down event
+            # this will break if more than one port expires at the same time TODO
+            port_change = line.split(' Port ')
+            dpid = port_change[0].split()[-2]
+            port_change = port_change[1].split()
+            if port_change[1] == 'down':
+                self.mac_table.port_down(dpid, port_change[0])
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled ACL rules for FAUCET.
+
+Created on 16 October 2026
+"""
+import logging
+from collections import namedtuple
+
+# what the rules look at in an endpoint's metadata
+Features = namedtuple('Features', ['oses', 'roles', 'behaviors'])
+
+
+def _newest_record(records):
+    '''
+    the record with the latest timestamp key, looked up by the key itself
+    so integer timestamps like '1551805502' are found too
+    '''
+    newest = None
+    newest_time = 0
+    for timestamp, record in records.items():
+        try:
+            record_time = float(timestamp)
+        except (TypeError, ValueError):
+            continue
+        if record_time > newest_time:
+            newest, newest_time = record, record_time
+    return newest
+
+
+def endpoint_features(endpoint):
+    '''
+    the OSes of the endpoint's addresses, the top three (role, confidence)
+    of the newest result for each of its MACs, and the behavior of those
+    results.
+    '''
+    metadata = endpoint.metadata or {}
+    oses = set()
+    for field in ('ipv4_addresses', 'ipv6_addresses'):
+        for record in metadata.get(field, {}).values():
+            if 'os' in record:
+                oses.add(record['os'])
+    roles = set()
+    behaviors = set()
+    for records in metadata.get('mac_addresses', {}).values():
+        newest = _newest_record(records)
+        if not newest:
+            continue
+        # results with fewer than three labels just have fewer roles
+        if 'labels' in newest and 'confidences' in newest:
+            roles.update(zip(newest['labels'][:3], newest['confidences'][:3]))
+        if 'behavior' in newest:
+            behaviors.add(newest['behavior'])
+    return Features(frozenset(oses), frozenset(roles), frozenset(behaviors))
+
+
+class RuleEngine:
+    '''
+    A rules file compiled to (rule name, predicates) once, and the rules
+    each endpoint matched, kept until the endpoint's features change.
+
+    A rule matches when all of its predicates do. Endpoints with the same
+    features are evaluated once per batch.
+    '''
+
+    def __init__(self, rules_doc):
+        self.logger = logging.getLogger('rules')
+        self.rules_doc = rules_doc
+        self.rules = []
+        for name, sub_rules in (rules_doc.get('rules', None) or {}).items():
+            predicates = []
+            for sub_rule in sub_rules:
+                rule = sub_rule.get('rule', {}) if isinstance(sub_rule, dict) else {}
+                predicates.append((rule.get('device_key', None), rule.get('value', None),
+                                   rule.get('min_confidence', None)))
+            self.rules.append((name, tuple(predicates)))
+        # name -> (features, matching rule names)
+        self.matched = {}
+
+    @staticmethod
+    def _predicate(features, device_key, value, min_confidence):
+        if device_key == 'os':
+            return value in features.oses
+        if device_key == 'role':
+            for role, confidence in features.roles:
+                if role == value and (min_confidence is None or
+                                      float(confidence) * 100 >= min_confidence):
+                    return True
+            return False
+        if device_key == 'behavior':
+            return value in features.behaviors
+        return False
+
+    def evaluate(self, features):
+        ''' names of the rules an endpoint with these features matches '''
+        return frozenset(
+            name for name, predicates in self.rules
+            if all(self._predicate(features, *predicate) for predicate in predicates))
+
+    def match_all(self, endpoints):
+        ''' name -> matching rule names, evaluating only changed endpoints '''
+        results = {}
+        evaluated = {}
+        for endpoint in endpoints:
+            features = endpoint_features(endpoint)
+            cached = self.matched.get(endpoint.name, None)
+            if cached and cached[0] == features:
+                results[endpoint.name] = cached[1]
+                continue
+            if features not in evaluated:
+                evaluated[features] = self.evaluate(features)
+            matches = evaluated[features]
+            if matches:
+                self.logger.info('Rules met for: {0}: {1}'.format(
+                    endpoint.name, sorted(matches)))
+            self.matched[endpoint.name] = (features, matches)
+            results[endpoint.name] = matches
+        return results
@@ -79,10 +79,11 @@ class Actions(object):
             status = True
         return status
 
-    def update_acls(self, rules_file=None, endpoints=None, force_apply_rules=None, force_remove_rules=None):
+    def update_acls(self, rules_file=None, endpoints=None, force_apply_rules=None, force_remove_rules=None, changed_endpoints=None):
         ''' tell the controller what ACLs to dynamically change '''
         status = False
         if self.sdnc:
             status = self.sdnc.update_acls(
-                rules_file=rules_file, endpoints=endpoints, force_apply_rules=force_apply_rules, force_remove_rules=force_remove_rules)
+                rules_file=rules_file, endpoints=endpoints, force_apply_rules=force_apply_rules, force_remove_rules=force_remove_rules,
+                changed_endpoints=changed_endpoints)
         return status
@@ -64,6 +64,7 @@ class Collector(object):
                     'Successfully started the collector for: {0}'.format(self.id))
                 self.endpoint.endpoint_data['container_id'] = response[1].rsplit(
                     ':', 1)[-1].strip()
+                self.endpoint.reindex()
                 status = True
             else:
                 self.logger.error(
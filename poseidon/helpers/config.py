@@ -37,9 +37,26 @@ class Config():
             'MIRROR_PORTS': None,
             'AUTOMATED_ACLS': False,
             'RABBIT_ENABLED': False,
+            'rabbit_server': 'RABBIT_SERVER',
+            'rabbit_port': 5672,
+            'rabbit_confirms': False,
+            'rabbit_prefetch': 100,
+            'rabbit_max_backoff': 30,
             'LEARN_PUBLIC_ADDRESSES': False,
             'reinvestigation_frequency': 900,
             'max_concurrent_reinvestigations': 2,
+            'endpoint_history_size': 100,
+            'endpoint_prev_states_size': 100,
+            'endpoint_acl_data_size': 100,
+            'queue_batch_size': 100,
+            'queue_timeout': 1,
+            'mirroring_frequency': 1,
+            'metadata_refresh_frequency': 60,
+            'rdns_workers': 4,
+            'rdns_ttl': 3600,
+            'rdns_negative_ttl': 300,
+            'prometheus_max_host_series': 10000,
+            'mac_history_size': 10,
             'logger_level': 'INFO',
         }
 
@@ -59,11 +76,27 @@ class Config():
             'controller_mirror_ports': ('MIRROR_PORTS', [ast.literal_eval]),
             'automated_acls': ('AUTOMATED_ACLS', [ast.literal_eval]),
             'rabbit_enabled': ('RABBIT_ENABLED', [ast.literal_eval]),
+            'rabbit_port': ('rabbit_port', [int]),
+            'rabbit_confirms': ('rabbit_confirms', [ast.literal_eval]),
+            'rabbit_prefetch': ('rabbit_prefetch', [int]),
+            'rabbit_max_backoff': ('rabbit_max_backoff', [int]),
             'FA_RABBIT_ENABLED': ('FA_RABBIT_ENABLED', [ast.literal_eval]),
             'FA_RABBIT_PORT': ('FA_RABBIT_PORT', [int]),
             'scan_frequency': ('scan_frequency', [int]),
             'reinvestigation_frequency': ('reinvestigation_frequency', [int]),
             'max_concurrent_reinvestigations': ('max_concurrent_reinvestigations', [int]),
+            'endpoint_history_size': ('endpoint_history_size', [int]),
+            'endpoint_prev_states_size': ('endpoint_prev_states_size', [int]),
+            'endpoint_acl_data_size': ('endpoint_acl_data_size', [int]),
+            'queue_batch_size': ('queue_batch_size', [int]),
+            'queue_timeout': ('queue_timeout', [float]),
+            'mirroring_frequency': ('mirroring_frequency', [int]),
+            'metadata_refresh_frequency': ('metadata_refresh_frequency', [int]),
+            'rdns_workers': ('rdns_workers', [int]),
+            'rdns_ttl': ('rdns_ttl', [int]),
+            'rdns_negative_ttl': ('rdns_negative_ttl', [int]),
+            'prometheus_max_host_series': ('prometheus_max_host_series', [int]),
+            'mac_history_size': ('mac_history_size', [int]),
             'ignore_vlans': ('ignore_vlans', [ast.literal_eval]),
             'ignore_ports': ('ignore_ports', [ast.literal_eval]),
             'trunk_ports': ('trunk_ports', [ast.literal_eval]),
@@ -5,15 +5,96 @@ Created on 3 December 2018
 """
 import hashlib
 import json
+import threading
 import time
+from collections import namedtuple
 
-from transitions import Machine
+import msgpack
 
 MACHINE_IP_FIELDS = {
     'ipv4': ('ipv4_rdns', 'ipv4_subnet'),
     'ipv6': ('ipv6_rdns', 'ipv6_subnet')}
 MACHINE_IP_PREFIXES = {
     'ipv4': 24, 'ipv6': 64}
+# bump when the packed endpoint record changes shape
+ENDPOINT_SCHEMA_VERSION = 1
+
+
+Transition = namedtuple('Transition', ['source', 'dest'])
+EventData = namedtuple('EventData', ['event', 'transition'])
+
+
+class TransitionError(Exception):
+    pass
+
+
+class StateMachine:
+    '''
+    A transition table shared by every model of a class.
+
+    The table is built once as trigger -> source -> (dest, before) and
+    the current state lives in a plain attribute on each model, so models
+    carry no per-object machine. 'before' callbacks are looked up on the
+    model and receive an EventData with the transition source and dest.
+    '''
+
+    def __init__(self, states, transitions, initial, attribute):
+        self.states = states
+        self.initial = initial
+        self.attribute = attribute
+        self.table = {}
+        for transition in transitions:
+            self.table.setdefault(transition['trigger'], {})[transition['source']] = (
+                transition['dest'], transition.get('before', None))
+
+    def fire(self, model, trigger):
+        source = getattr(model, self.attribute)
+        try:
+            dest, before = self.table[trigger][source]
+        except KeyError:
+            raise TransitionError(
+                "Can't trigger event {0} from state {1}!".format(trigger, source))
+        if before:
+            getattr(model, before)(EventData(trigger, Transition(source, dest)))
+        setattr(model, self.attribute, dest)
+        return True
+
+
+class HistoryRing(list):
+    '''
+    A list that holds at most maxlen entries. Once full, the oldest entries
+    after the first pinned ones move to spilled, where they wait to be
+    appended to the endpoint's archive in Redis. on_change, if given, is
+    called after each append.
+    '''
+
+    __slots__ = ('maxlen', 'pinned', 'spilled', 'on_change')
+
+    def __init__(self, entries=(), maxlen=None, pinned=0, on_change=None):
+        list.__init__(self, entries)
+        self.maxlen = maxlen
+        self.pinned = pinned
+        self.spilled = []
+        self.on_change = on_change
+        self._trim()
+
+    def _trim(self):
+        if self.maxlen and len(self) > self.maxlen:
+            end = self.pinned + len(self) - self.maxlen
+            self.spilled.extend(self[self.pinned:end])
+            del self[self.pinned:end]
+
+    def append(self, entry):
+        list.append(self, entry)
+        self._trim()
+        if self.on_change:
+            self.on_change()
+
+    def extend(self, entries):
+        list.extend(self, entries)
+        self._trim()
+        if self.on_change:
+            self.on_change()
 
 
 class HistoryTypes():
@@ -25,6 +106,16 @@ class HistoryTypes():
 
 class Endpoint:
 
+    __slots__ = ('name', '_ignore', 'copro_ignores', '_endpoint_data',
+                 '_p_next_state', '_p_prev_states', 'p_next_copro_state',
+                 'p_prev_copross_states', '_acl_data', '_metadata', '_history',
+                 '_state', '_copro_state', '_registry')
+
+    # ring sizes, see set_ring_sizes()
+    history_size = 100
+    prev_states_size = 100
+    acl_data_size = 100
+
     states = ['known', 'unknown', 'mirroring', 'inactive', 'abnormal',
               'shutdown', 'reinvestigating', 'queued']
 
@@ -139,10 +230,12 @@ class Endpoint:
     ]
 
     def __init__(self, hashed_val):
+        # the EndpointRegistry holding this endpoint, if any
+        self._registry = None
         self.name = hashed_val.strip()
-        self.ignore = False
+        self._ignore = False
         self.copro_ignores = False
-        self.endpoint_data = None
+        self._endpoint_data = None
         self.p_next_state = None
         self.p_prev_states = []
         self.p_next_copro_state = None
@@ -150,11 +243,113 @@ class Endpoint:
         self.acl_data = []
         self.metadata = {}
         self.history = []
-        self.state = None
-        self.copro_state = None
+        self._state = None
+        self._copro_state = None
 
-    def encode(self):
-        endpoint_d = {
+    @classmethod
+    def set_ring_sizes(cls, history_size, prev_states_size, acl_data_size):
+        ''' bound the history, prior states and ACL rings of new endpoints '''
+        cls.history_size = history_size
+        cls.prev_states_size = prev_states_size
+        cls.acl_data_size = acl_data_size
+
+    def reindex(self):
+        ''' tell the registry holding the endpoint that it changed '''
+        if self._registry is not None:
+            self._registry.reindex(self)
+
+    # the stored fields tell the registry when they are set
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = state
+        self.reindex()
+
+    @property
+    def copro_state(self):
+        return self._copro_state
+
+    @copro_state.setter
+    def copro_state(self, copro_state):
+        self._copro_state = copro_state
+        self.reindex()
+
+    @property
+    def ignore(self):
+        return self._ignore
+
+    @ignore.setter
+    def ignore(self, ignore):
+        self._ignore = ignore
+        self.reindex()
+
+    @property
+    def endpoint_data(self):
+        return self._endpoint_data
+
+    @endpoint_data.setter
+    def endpoint_data(self, endpoint_data):
+        self._endpoint_data = endpoint_data
+        self.reindex()
+
+    @property
+    def p_next_state(self):
+        return self._p_next_state
+
+    @p_next_state.setter
+    def p_next_state(self, p_next_state):
+        self._p_next_state = p_next_state
+        self.reindex()
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata
+        self.reindex()
+
+    # the first prior state is kept as it is when the endpoint was first seen
+    @property
+    def p_prev_states(self):
+        return self._p_prev_states
+
+    @p_prev_states.setter
+    def p_prev_states(self, entries):
+        self._p_prev_states = HistoryRing(
+            entries, max(Endpoint.prev_states_size, 2), pinned=1,
+            on_change=self.reindex)
+
+    @property
+    def acl_data(self):
+        return self._acl_data
+
+    @acl_data.setter
+    def acl_data(self, entries):
+        self._acl_data = HistoryRing(
+            entries, Endpoint.acl_data_size, on_change=self.reindex)
+
+    @property
+    def history(self):
+        return self._history
+
+    @history.setter
+    def history(self, entries):
+        self._history = HistoryRing(
+            entries, Endpoint.history_size, on_change=self.reindex)
+
+    def rings(self):
+        ''' the bounded fields of the endpoint, by archive name '''
+        return {'history': self._history,
+                'prev_states': self._p_prev_states,
+                'acl_data': self._acl_data}
+
+    def _record(self):
+        return {
             'name': self.name,
             'state': self.state,
             'copro_state': self.copro_state,
@@ -166,7 +361,21 @@ class Endpoint:
             'metadata': self.metadata,
             'history': self.history,
         }
-        return str(json.dumps(endpoint_d))
+
+    def trigger(self, trigger):
+        ''' fire a trigger by name, on the main machine if it has it '''
+        if trigger in Endpoint.machine.table:
+            return Endpoint.machine.fire(self, trigger)
+        return Endpoint.copro_machine.fire(self, trigger)
+
+    def encode(self):
+        return str(json.dumps(self._record()))
+
+    def pack(self):
+        ''' compact, schema-versioned binary form of the endpoint '''
+        record = self._record()
+        record['version'] = ENDPOINT_SCHEMA_VERSION
+        return msgpack.packb(record, use_bin_type=True)
 
     def _add_history_entry(self, entry_type, timestamp, message):
         self.history.append(
@@ -214,34 +423,182 @@ class Endpoint:
         return post_h
 
 
+Endpoint.machine = StateMachine(
+    Endpoint.states, Endpoint.transitions, 'unknown', 'state')
+Endpoint.copro_machine = StateMachine(
+    Endpoint.copro_states, Endpoint.copro_transitions, 'unknown', 'copro_state')
+
+
+def _make_trigger(machine, trigger):
+    def _trigger(self):
+        return machine.fire(self, trigger)
+    _trigger.__name__ = trigger
+    return _trigger
+
+
+# bind one method per trigger, the main machine wins on shared names (queue)
+for _machine in (Endpoint.machine, Endpoint.copro_machine):
+    for _trigger in _machine.table:
+        if not hasattr(Endpoint, _trigger):
+            setattr(Endpoint, _trigger, _make_trigger(_machine, _trigger))
+
+
+class EndpointRegistry(dict):
+    '''
+    name -> Endpoint, with indexes by MAC, IPv4, IPv6, state, copro_state
+    and ignore flag, so lookups only touch the matching endpoints. Other
+    threads may change the indexes while they are read, so readers iterate
+    over copies of them.
+
+    Endpoints tell the registry holding them when one of their stored
+    fields is set, by a transition or otherwise. Changing endpoint_data in
+    place needs a reindex() of the endpoint. Each listener is called with
+    the name and the endpoint when its indexed fields change, and with the
+    name and None when it is removed. The names of endpoints changed in any
+    way are kept until take_changed().
+    '''
+
+    INDEXED = ('mac', 'ipv4', 'ipv6', 'state', 'copro_state', 'ignore')
+
+    def __init__(self, endpoints=None):
+        super(EndpointRegistry, self).__init__()
+        # field -> value -> names, dicts as ordered sets
+        self.indexes = dict((field, {}) for field in self.INDEXED)
+        # name -> indexed values
+        self.indexed = {}
+        self.listeners = []
+        # names changed since the last take_changed(), a dict as an ordered set
+        self.changed = {}
+        self.changed_lock = threading.Lock()
+        if endpoints:
+            self.update(endpoints)
+
+    @staticmethod
+    def _values(endpoint):
+        data = endpoint.endpoint_data or {}
+        return (data.get('mac', None), data.get('ipv4', None), data.get('ipv6', None),
+                endpoint.state, endpoint.copro_state, endpoint.ignore)
+
+    def _move(self, name, old_values, new_values):
+        for field, old, new in zip(self.INDEXED, old_values, new_values):
+            if old == new:
+                continue
+            index = self.indexes[field]
+            if old is not None:
+                names = index.get(old, None)
+                if names is not None:
+                    names.pop(name, None)
+                    if not names:
+                        del index[old]
+            if new is not None:
+                index.setdefault(new, {})[name] = None
+
+    def take_changed(self):
+        ''' the names of the endpoints changed since the last call '''
+        with self.changed_lock:
+            changed, self.changed = self.changed, {}
+        return changed
+
+    def mark_changed(self, name):
+        with self.changed_lock:
+            self.changed[name] = None
+
+    def unmark_changed(self, name):
+        with self.changed_lock:
+            self.changed.pop(name, None)
+
+    def reindex(self, endpoint):
+        ''' bring the indexes up to date with the endpoint '''
+        self.mark_changed(endpoint.name)
+        values = self._values(endpoint)
+        old_values = self.indexed.get(endpoint.name, (None,) * len(self.INDEXED))
+        if values != old_values:
+            self._move(endpoint.name, old_values, values)
+            self.indexed[endpoint.name] = values
+            for listener in self.listeners:
+                listener(endpoint.name, endpoint)
+
+    def _unindex(self, name, endpoint):
+        old_values = self.indexed.pop(name, None)
+        if old_values:
+            self._move(name, old_values, (None,) * len(self.INDEXED))
+            for listener in self.listeners:
+                listener(name, None)
+        if endpoint._registry is self:
+            endpoint._registry = None
+
+    def __setitem__(self, name, endpoint):
+        if name in self:
+            self._unindex(name, self[name])
+        super(EndpointRegistry, self).__setitem__(name, endpoint)
+        endpoint._registry = self
+        self.reindex(endpoint)
+
+    def __delitem__(self, name):
+        self._unindex(name, self[name])
+        super(EndpointRegistry, self).__delitem__(name)
+
+    def pop(self, name, *default):
+        if name in self:
+            self._unindex(name, self[name])
+        return super(EndpointRegistry, self).pop(name, *default)
+
+    def popitem(self):
+        name, endpoint = super(EndpointRegistry, self).popitem()
+        self._unindex(name, endpoint)
+        return name, endpoint
+
+    def setdefault(self, name, endpoint=None):
+        if name not in self:
+            self[name] = endpoint
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, endpoint in dict(*args, **kwargs).items():
+            self[name] = endpoint
+
+    def clear(self):
+        for name, endpoint in self.items():
+            self._unindex(name, endpoint)
+        super(EndpointRegistry, self).clear()
+
+    def _endpoints(self, names):
+        # names is a copy, so endpoints removed since are skipped
+        return [endpoint for endpoint in map(self.get, names) if endpoint is not None]
+
+    def lookup(self, field, value):
+        ''' the endpoints whose field is value '''
+        return self._endpoints(list(self.indexes[field].get(value, ())))
+
+    def count(self, field, value):
+        return len(self.indexes[field].get(value, ()))
+
+    def by_ip(self, ip):
+        ''' the endpoints with ip as their IPv4 or IPv6 address '''
+        names = dict(self.indexes['ipv4'].get(ip, {}))
+        names.update(self.indexes['ipv6'].get(ip, {}))
+        return self._endpoints(names)
+
+
 def endpoint_factory(hashed_val):
     endpoint = Endpoint(hashed_val)
-    machine = Machine(
-        model=endpoint,
-        states=Endpoint.states,
-        transitions=Endpoint.transitions,
-        initial='unknown',
-        send_event=True)
-    machine.name = endpoint.name[:8]+' '
-    endpoint.machine = machine
-    copro_machine = Machine(
-        model=endpoint,
-        states=Endpoint.copro_states,
-        transitions=Endpoint.copro_transitions,
-        initial='unknown',
-        send_event=True)
-    copro_machine.name = endpoint.name[:8]+'_copro'
-    endpoint.copro_machine = copro_machine
+    endpoint.state = Endpoint.machine.initial
+    endpoint.copro_state = Endpoint.copro_machine.initial
     return endpoint
 
 
 class EndpointDecoder:
 
     def __init__(self, endpoint):
-        e = json.loads(endpoint)
+        ''' accepts either a JSON encoded or a packed endpoint '''
+        if isinstance(endpoint, bytes):
+            e = EndpointDecoder.upgrade(
+                msgpack.unpackb(endpoint, raw=False))
+        else:
+            e = json.loads(endpoint)
         self.endpoint = endpoint_factory(e['name'])
         self.endpoint.state = e['state']
-        self.endpoint.copro_state = e['copro_state']
+        self.endpoint.copro_state = e['copro_state'] or 'unknown'
         if 'ignore' in e:
             if e['ignore']:
                 self.endpoint.ignore = True
@@ -265,5 +622,14 @@ class EndpointDecoder:
         self.endpoint.p_next_state = e['p_next_state']
         self.endpoint.p_prev_states = e['p_prev_states']
 
+    @staticmethod
+    def upgrade(record):
+        ''' bring a packed endpoint record up to the current schema '''
+        version = record.pop('version', ENDPOINT_SCHEMA_VERSION)
+        if version > ENDPOINT_SCHEMA_VERSION:
+            raise ValueError('Endpoint record version {0} is newer than supported version {1}'.format(
+                version, ENDPOINT_SCHEMA_VERSION))
+        return record
+
     def get_endpoint(self):
         return self.endpoint
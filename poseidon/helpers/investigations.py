@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Queue and timeouts of endpoint investigations.
+
+Created on 16 October 2026
+"""
+import heapq
+import itertools
+import time
+
+# states in which an endpoint is being mirrored
+IN_FLIGHT = ('mirroring', 'reinvestigating')
+
+
+class InvestigationScheduler:
+    '''
+    The queued endpoints of an EndpointRegistry in the order they were
+    queued, and a deadline for each endpoint being mirrored.
+
+    The registry reports every change to an endpoint's state or ignore
+    flag, so the queue and the deadlines follow the endpoints as they
+    change instead of being rebuilt from all of them on every tick. Ignored
+    endpoints are neither queued nor timed out. Entries outdated by a later
+    change are dropped when they reach the top of their heap.
+    '''
+
+    def __init__(self, registry, timeout):
+        self.registry = None
+        self.timeout = timeout
+        # (queued at, seq, name)
+        self.pending = []
+        # (deadline, seq, name)
+        self.deadlines = []
+        # name -> seq of its current entry
+        self.seqs = {}
+        # name -> (state, ignore) when last seen
+        self.seen = {}
+        # entries handed out and not yet acted on
+        self.taken = []
+        self.counter = itertools.count()
+        self.rebind(registry)
+
+    def rebind(self, registry):
+        '''
+        follow registry instead of the current one. endpoints it holds in
+        the same state keep their place in the queue and their deadline.
+        '''
+        if self.registry is not None and self.changed in self.registry.listeners:
+            self.registry.listeners.remove(self.changed)
+        self.registry = registry
+        registry.listeners.append(self.changed)
+        for name in set(self.seen) - set(registry):
+            self.changed(name, None)
+        for name, endpoint in registry.items():
+            self.changed(name, endpoint)
+
+    @staticmethod
+    def _since(endpoint):
+        ''' when the endpoint entered its state, now if not recorded yet '''
+        prev_states = endpoint.p_prev_states
+        if prev_states and prev_states[-1][0] == endpoint.state:
+            return prev_states[-1][1]
+        return int(time.time())
+
+    def changed(self, name, endpoint):
+        if endpoint is None:
+            self.seqs.pop(name, None)
+            self.seen.pop(name, None)
+            return
+        seen = (endpoint.state, endpoint.ignore)
+        if self.seen.get(name, None) == seen:
+            return
+        self.seen[name] = seen
+        seq = next(self.counter)
+        self.seqs[name] = seq
+        if endpoint.ignore:
+            return
+        if endpoint.state == 'queued':
+            heapq.heappush(self.pending, (self._since(endpoint), seq, name))
+        elif endpoint.state in IN_FLIGHT:
+            heapq.heappush(self.deadlines, (self._since(endpoint) + self.timeout, seq, name))
+
+    def _current(self, entry):
+        return self.seqs.get(entry[2], None) == entry[1]
+
+    def _restore_taken(self):
+        # put back what was handed out but did not change state
+        for heap, entry in self.taken:
+            if self._current(entry):
+                heapq.heappush(heap, entry)
+        self.taken = []
+
+    def take_queued(self, count):
+        ''' up to count queued endpoints, longest queued first '''
+        self._restore_taken()
+        endpoints = []
+        held = []
+        while self.pending and len(endpoints) < count:
+            entry = heapq.heappop(self.pending)
+            if not self._current(entry):
+                continue
+            endpoint = self.registry[entry[2]]
+            if endpoint.p_next_state == 'inactive':
+                held.append(entry)
+                continue
+            self.taken.append((self.pending, entry))
+            endpoints.append(endpoint)
+        for entry in held:
+            heapq.heappush(self.pending, entry)
+        return endpoints
+
+    def expired(self, now):
+        ''' the endpoints mirrored for longer than the timeout '''
+        self._restore_taken()
+        endpoints = []
+        while self.deadlines and self.deadlines[0][0] < now:
+            entry = heapq.heappop(self.deadlines)
+            if self._current(entry):
+                self.taken.append((self.deadlines, entry))
+                endpoints.append(self.registry[entry[2]])
+        return endpoints
+
+    @property
+    def in_flight(self):
+        ''' how many endpoints are being mirrored '''
+        return sum(self.registry.count('state', state) for state in IN_FLIGHT)
+
+    @property
+    def queued(self):
+        return self.registry.count('state', 'queued')
@@ -3,21 +3,77 @@
 Created on 19 February 2019
 @author: Charlie Lewis
 """
+import os
 import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from poseidon.constants import NO_DATA
 
 
+class OuiIndex:
+    """
+    Vendor prefixes from an nmap-mac-prefixes file, indexed by prefix.
+
+    Prefixes may be 6 (MA-L), 7 (MA-M) or 9 (MA-S) hex digits, the longest
+    matching prefix wins. The file is loaded again when it changes, checked
+    at most every check_interval seconds.
+    """
+
+    def __init__(self, lookup_path, check_interval=1):
+        self.lookup_path = lookup_path
+        self.check_interval = check_interval
+        self.prefixes = {}
+        self.lengths = ()
+        self.stamp = None
+        self.checked = None
+
+    def load(self):
+        st = os.stat(self.lookup_path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self.stamp:
+            return
+        prefixes = {}
+        with open(self.lookup_path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2 or line.startswith('#'):
+                    continue
+                prefixes[fields[0].upper()] = fields[1].strip()
+        self.prefixes = prefixes
+        self.lengths = tuple(sorted(set(len(prefix) for prefix in prefixes), reverse=True))
+        self.stamp = stamp
+
+    def lookup(self, mac):
+        now = time.monotonic()
+        if self.checked is None or now - self.checked >= self.check_interval:
+            self.checked = now
+            self.load()
+        mac = ''.join(mac.split(':')).upper()
+        for length in self.lengths:
+            vendor = self.prefixes.get(mac[:length], None)
+            if vendor is not None:
+                return vendor
+        return None
+
+
+# lookup_path -> OuiIndex
+OUI_INDEXES = {}
+
+
 def get_ether_vendor(mac, lookup_path):
     """
     Takes a MAC address and looks up and returns the vendor for it.
     """
-    mac = ''.join(mac.split(':'))[:6].upper()
     try:
-        with open(lookup_path, 'r') as f:
-            for line in f:
-                if line.startswith(mac):
-                    return line.split()[1].strip()
+        index = OUI_INDEXES.get(lookup_path, None)
+        if index is None:
+            index = OuiIndex(lookup_path)
+            index.load()
+            OUI_INDEXES[lookup_path] = index
+        return index.lookup(mac)
     except Exception as e:  # pragma: no cover
         return NO_DATA
 
@@ -35,3 +91,83 @@ def get_rdns_lookup(ip):
     except Exception as e:  # pragma: no cover
         return NO_DATA
     return rdns
+
+
+class RDNSResolver:
+    """
+    Reverse DNS lookups that never block the caller.
+
+    lookup() answers from the cache and, for an address not cached or
+    expired, queues a lookup on a pool of worker threads and returns what it
+    had, NO_DATA the first time. Names are kept for ttl seconds, failures
+    for negative_ttl seconds. The pool is started on the first miss, and
+    only the last max_latencies lookup latencies are kept for take_stats().
+    """
+
+    def __init__(self, workers=4, ttl=3600, negative_ttl=300, max_entries=100000,
+                 max_latencies=1000, resolve=get_rdns_lookup):
+        self.workers = workers
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.resolve = resolve
+        self.pool = None
+        self.lock = threading.Lock()
+        # ip -> (name, expiry)
+        self.cache = {}
+        self.pending = set()
+        # since take_stats() was last called
+        self.hits = 0
+        self.misses = 0
+        self.latencies = deque(maxlen=max_latencies)
+
+    def lookup(self, ip):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(ip, None)
+            if cached and cached[1] > now:
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+            if ip not in self.pending:
+                self.pending.add(ip)
+                if self.pool is None:
+                    self.pool = ThreadPoolExecutor(max_workers=self.workers)
+                self.pool.submit(self._resolve, ip)
+        if cached:
+            # refreshed in the background, use the old name meanwhile
+            return cached[0]
+        return NO_DATA
+
+    def _resolve(self, ip):
+        start = time.monotonic()
+        try:
+            name = self.resolve(ip)
+        except Exception as e:  # pragma: no cover
+            name = NO_DATA
+        now = time.monotonic()
+        ttl = self.negative_ttl if name == NO_DATA else self.ttl
+        with self.lock:
+            if len(self.cache) >= self.max_entries:
+                self.cache = dict(
+                    (key, value) for key, value in self.cache.items() if value[1] > now)
+            self.cache[ip] = (name, now + ttl)
+            self.pending.discard(ip)
+            self.latencies.append(now - start)
+
+    def take_stats(self):
+        """ (hits, misses, lookup latencies) since the last call """
+        with self.lock:
+            stats = (self.hits, self.misses, list(self.latencies))
+            self.hits = 0
+            self.misses = 0
+            self.latencies.clear()
+        return stats
+
+    def shutdown(self, wait=False):
+        """ stop the pool, a later miss starts a new one """
+        with self.lock:
+            pool = self.pool
+            self.pool = None
+        if pool is not None:
+            pool.shutdown(wait=wait)
@@ -5,72 +5,69 @@ Created on 5 December 2018
 """
 import logging
 import socket
+import threading
 from binascii import hexlify
 
+from prometheus_client import Counter
 from prometheus_client import Gauge
+from prometheus_client import Histogram
 from prometheus_client import start_http_server
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.core import REGISTRY
+
+from poseidon.constants import NO_DATA
 
 
 class Prometheus():
 
-    def __init__(self):
+    def __init__(self, max_host_series=10000):
         self.logger = logging.getLogger('prometheus')
         self.prom_metrics = {}
+        self.endpoint_metrics = EndpointCollector(max_host_series)
 
     def initialize_metrics(self):
-        self.prom_metrics['inactive'] = Gauge('poseidon_endpoint_inactive',
-                                              'Number of endpoints that are inactive')
-        self.prom_metrics['active'] = Gauge('poseidon_endpoint_active',
-                                            'Number of endpoints that are active')
-        self.prom_metrics['behavior'] = Gauge('poseidon_endpoint_behavior',
-                                              'Behavior of an endpoint, 0 is normal, 1 is abnormal',
-                                              ['ipv4',
-                                               'mac',
-                                               'tenant',
-                                               'segment',
-                                               'port',
-                                               'role',
-                                               'ipv4_os',
-                                               'source'])
-        self.prom_metrics['ipv4_table'] = Gauge('poseidon_endpoint_ip_table',
-                                                'IP Table',
-                                                ['mac',
-                                                 'tenant',
-                                                 'segment',
-                                                 'port',
-                                                 'role',
-                                                 'ipv4_os',
-                                                 'hash_id',
-                                                 'source'])
-        self.prom_metrics['roles'] = Gauge('poseidon_endpoint_roles',
-                                           'Number of endpoints by role',
-                                           ['source',
-                                            'role'])
-        self.prom_metrics['oses'] = Gauge('poseidon_endpoint_oses',
-                                          'Number of endpoints by OS',
-                                          ['source',
-                                           'ipv4_os'])
-        self.prom_metrics['current_states'] = Gauge('poseidon_endpoint_current_states',
-                                                    'Number of endpoints by current state',
-                                                    ['source',
-                                                     'current_state'])
-        self.prom_metrics['vlans'] = Gauge('poseidon_endpoint_vlans',
-                                           'Number of endpoints by VLAN',
-                                           ['source',
-                                            'tenant'])
-        self.prom_metrics['sources'] = Gauge('poseidon_endpoint_sources',
-                                             'Number of endpoints by record source',
-                                             ['source'])
-        self.prom_metrics['port_tenants'] = Gauge('poseidon_endpoint_port_tenants',
-                                                  'Number of tenants by port',
-                                                  ['port',
-                                                   'tenant'])
-        self.prom_metrics['port_hosts'] = Gauge('poseidon_endpoint_port_hosts',
-                                                'Number of hosts by port',
-                                                ['port'])
+        REGISTRY.register(self.endpoint_metrics)
         self.prom_metrics['last_rabbitmq_routing_key_time'] = Gauge('last_rabbitmq_routing_key_time',
                                                                     'Epoch time when last received a RabbitMQ message',
                                                                     ['routing_key'])
+        self.prom_metrics['queue_depth'] = Gauge('poseidon_queue_depth',
+                                                 'Number of messages waiting in the work queue')
+        self.prom_metrics['queue_batch_latency'] = Histogram('poseidon_queue_batch_seconds',
+                                                             'Time spent processing a batch of queued messages')
+        self.prom_metrics['faucet_events_raw'] = Counter('poseidon_faucet_events_raw',
+                                                         'Number of FAUCET events received')
+        self.prom_metrics['faucet_events_coalesced'] = Counter('poseidon_faucet_events_coalesced',
+                                                               'Number of FAUCET events left to parse after coalescing')
+        self.prom_metrics['acl_ports_recomputed'] = Counter('poseidon_acl_ports_recomputed',
+                                                            'Number of switch ports whose ACLs were recomputed')
+        self.prom_metrics['acl_ports_skipped'] = Counter('poseidon_acl_ports_skipped',
+                                                         'Number of switch ports whose ACLs were left as they were')
+        self.prom_metrics['rabbitmq_messages'] = Counter('poseidon_rabbitmq_messages',
+                                                         'Number of rabbitmq messages handled',
+                                                         ['routing_key'])
+        self.prom_metrics['rabbitmq_lag'] = Histogram('poseidon_rabbitmq_lag_seconds',
+                                                      'Time rabbitmq messages waited to be handled',
+                                                      ['routing_key'])
+        self.prom_metrics['rdns_hits'] = Counter('poseidon_rdns_hits',
+                                                 'Number of reverse DNS lookups answered from the cache')
+        self.prom_metrics['rdns_misses'] = Counter('poseidon_rdns_misses',
+                                                   'Number of reverse DNS lookups not cached or expired')
+        self.prom_metrics['rdns_latency'] = Histogram('poseidon_rdns_lookup_seconds',
+                                                      'Time taken by reverse DNS lookups')
+
+    def update_event_counts(self, raw, coalesced):
+        self.prom_metrics['faucet_events_raw'].inc(raw)
+        self.prom_metrics['faucet_events_coalesced'].inc(coalesced)
+
+    def update_acl_counts(self, recomputed, skipped):
+        self.prom_metrics['acl_ports_recomputed'].inc(recomputed)
+        self.prom_metrics['acl_ports_skipped'].inc(skipped)
+
+    def update_rdns_stats(self, hits, misses, latencies):
+        self.prom_metrics['rdns_hits'].inc(hits)
+        self.prom_metrics['rdns_misses'].inc(misses)
+        for latency in latencies:
+            self.prom_metrics['rdns_latency'].observe(latency)
 
     @staticmethod
     def get_metrics():
@@ -92,146 +89,200 @@ class Prometheus():
                    'actives': 0}
         return metrics
 
-    def update_metrics(self, hosts):
+    @staticmethod
+    def ip2int(ip):
+        ''' convert ip quad octet string to an int '''
+        if not ip or ip in ['None', '::']:
+            res = 0
+        elif ':' in ip:
+            res = int(hexlify(socket.inet_pton(socket.AF_INET6, ip)), 16)
+        else:
+            o = list(map(int, ip.split('.')))
+            res = (16777216 * o[0]) + (65536 * o[1]) + (256 * o[2]) + o[3]
+        return res
 
-        def ip2int(ip):
-            ''' convert ip quad octet string to an int '''
-            if not ip or ip in ['None', '::']:
-                res = 0
-            elif ':' in ip:
-                res = int(hexlify(socket.inet_pton(socket.AF_INET6, ip)), 16)
-            else:
-                o = list(map(int, ip.split('.')))
-                res = (16777216 * o[0]) + (65536 * o[1]) + (256 * o[2]) + o[3]
-            return res
-
-        metrics = Prometheus.get_metrics()
-        for host in hosts:
-            if host['active'] == 0:
-                metrics['inactives'] += 1
-            if host['active'] == 1:
-                metrics['actives'] += 1
-            if (host['source'], host['role']) in metrics['roles']:
-                if host['active'] == 1:
-                    metrics['roles'][(host['source'],
-                                      host['role'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['roles'][(host['source'], host['role'])] = 1
-                else:
-                    metrics['roles'][(host['source'], host['role'])] = 0
-
-            if (host['source'], host['ipv4_os']) in metrics['oses']:
-                if host['active'] == 1:
-                    metrics['oses'][(host['source'], host['ipv4_os'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['oses'][(host['source'], host['ipv4_os'])] = 1
-                else:
-                    metrics['oses'][(host['source'], host['ipv4_os'])] = 0
-
-            if (host['source'], host['state']) in metrics['current_states']:
-                if host['active'] == 1:
-                    metrics['current_states'][(host['source'],
-                                               host['state'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['current_states'][(host['source'],
-                                               host['state'])] = 1
-                else:
-                    metrics['current_states'][(host['source'],
-                                               host['state'])] = 0
-
-            if (host['source'], host['tenant']) in metrics['vlans']:
-                if host['active'] == 1:
-                    metrics['vlans'][(host['source'],
-                                      host['tenant'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['vlans'][(host['source'],
-                                      host['tenant'])] = 1
-                else:
-                    metrics['vlans'][(host['source'],
-                                      host['tenant'])] = 0
-
-            if (host['source']) in metrics['sources']:
-                if host['active'] == 1:
-                    metrics['sources'][(host['source'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['sources'][(host['source'])] = 1
-                else:
-                    metrics['sources'][(host['source'])] = 0
-
-            if (host['port'], host['tenant']) in metrics['port_tenants']:
-                if host['active'] == 1:
-                    metrics['port_tenants'][(
-                        host['port'], host['tenant'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['port_tenants'][(host['port'], host['tenant'])] = 1
-                else:
-                    metrics['port_tenants'][(host['port'], host['tenant'])] = 0
-
-            if (host['port']) in metrics['port_hosts']:
-                if host['active'] == 1:
-                    metrics['port_hosts'][(host['port'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['port_hosts'][(host['port'])] = 1
-                else:
-                    metrics['port_hosts'][(host['port'])] = 0
+    @staticmethod
+    def endpoint_host(endpoint):
+        '''
+        the host record counted by update_hosts, from an endpoint in memory
+        and the ML and OS metadata last stored with it.
+        '''
+        data = endpoint.endpoint_data or {}
+        metadata = endpoint.metadata or {}
+        mac = data.get('mac', 0)
+        ipv4 = data.get('ipv4', 0)
+        role = NO_DATA
+        behavior = 0
+        ml_results = metadata.get('mac_addresses', {}).get(mac, {})
+        if ml_results:
+            latest = ml_results[max(ml_results, key=float)]
+            if latest.get('labels', None):
+                role = latest['labels'][0]
+            if latest.get('behavior', 'None') not in ('None', 'normal'):
+                behavior = 1
+        ipv4_os = metadata.get('ipv4_addresses', {}).get(
+            ipv4, {}).get('os', NO_DATA)
+        return {'id': endpoint.name, 'mac': mac, 'ipv4': ipv4,
+                'tenant': data.get('tenant', 0), 'segment': data.get('segment', 0),
+                'port': data.get('port', 0), 'active': data.get('active', 0),
+                'source': data.get('source', NO_DATA), 'role': role,
+                'ipv4_os': ipv4_os, 'state': endpoint.state, 'behavior': behavior}
 
-            try:
-                if host['active'] == 1:
-                    self.prom_metrics['behavior'].labels(ipv4=host['ipv4'],
-                                                         mac=host['mac'],
-                                                         tenant=host['tenant'],
-                                                         segment=host['segment'],
-                                                         port=host['port'],
-                                                         role=host['role'],
-                                                         ipv4_os=host['ipv4_os'],
-                                                         source=host['source']).set(host['behavior'])
-                    self.prom_metrics['ipv4_table'].labels(mac=host['mac'],
-                                                           tenant=host['tenant'],
-                                                           segment=host['segment'],
-                                                           port=host['port'],
-                                                           role=host['role'],
-                                                           ipv4_os=host['ipv4_os'],
-                                                           hash_id=host['id'],
-                                                           source=host['source']).set(ip2int(host['ipv4']))
-            except Exception as e:  # pragma: no cover
-                self.logger.error(
-                    'Unable to send {0} results to prometheus because {1}'.format(host, str(e)))
-
-        try:
-            for role in metrics['roles']:
-                self.prom_metrics['roles'].labels(source=role[0],
-                                                  role=role[1]).set(metrics['roles'][role])
-            for os_t in metrics['oses']:
-                self.prom_metrics['oses'].labels(source=os_t[0],
-                                                 ipv4_os=os_t[1]).set(metrics['oses'][os_t])
-            for current_state in metrics['current_states']:
-                self.prom_metrics['current_states'].labels(source=current_state[0],
-                                                           current_state=current_state[1]).set(metrics['current_states'][current_state])
-            for vlan in metrics['vlans']:
-                self.prom_metrics['vlans'].labels(source=vlan[0],
-                                                  tenant=vlan[1]).set(metrics['vlans'][vlan])
-            for source in metrics['sources']:
-                self.prom_metrics['sources'].labels(source=source).set(
-                    metrics['sources'][source])
-            for port_tenant in metrics['port_tenants']:
-                self.prom_metrics['port_tenants'].labels(port=port_tenant[0],
-                                                         tenant=port_tenant[1]).set(metrics['port_tenants'][port_tenant])
-            for port_host in metrics['port_hosts']:
-                self.prom_metrics['port_hosts'].labels(
-                    port=port_host).set(metrics['port_hosts'][port_host])
-            self.prom_metrics['inactive'].set(metrics['inactives'])
-            self.prom_metrics['active'].set(metrics['actives'])
-        except Exception as e:  # pragma: no cover
-            self.logger.error(
-                'Unable to send results to prometheus because {0}'.format(str(e)))
+    def update_hosts(self, hosts):
+        self.endpoint_metrics.update_hosts(hosts)
+
+    def set_hosts(self, hosts):
+        self.endpoint_metrics.set_hosts(hosts)
+
+    def update_metrics(self, hosts):
+        ''' make the counts those of a list of hosts '''
+        self.set_hosts({host['id']: host for host in hosts})
 
     @staticmethod
     def start(port=9304):
         start_http_server(port)
+
+
+class EndpointCollector():
+    '''
+    Endpoint metrics for Prometheus, built on each scrape from per-host
+    records instead of kept as labelled gauges.
+
+    Hosts are applied as deltas to counts by label, and a count goes away
+    with the last host in it, so series for endpoints that were removed or
+    changed are not exported any more. The per-host behavior and IP table
+    series are capped at max_host_series.
+    '''
+
+    # metric, name, description and labels of the counts by label
+    COUNTS = (('roles', 'poseidon_endpoint_roles',
+               'Number of endpoints by role', ('source', 'role')),
+              ('oses', 'poseidon_endpoint_oses',
+               'Number of endpoints by OS', ('source', 'ipv4_os')),
+              ('current_states', 'poseidon_endpoint_current_states',
+               'Number of endpoints by current state', ('source', 'current_state')),
+              ('vlans', 'poseidon_endpoint_vlans',
+               'Number of endpoints by VLAN', ('source', 'tenant')),
+              ('sources', 'poseidon_endpoint_sources',
+               'Number of endpoints by record source', ('source',)),
+              ('port_tenants', 'poseidon_endpoint_port_tenants',
+               'Number of tenants by port', ('port', 'tenant')),
+              ('port_hosts', 'poseidon_endpoint_port_hosts',
+               'Number of hosts by port', ('port',)))
+
+    def __init__(self, max_host_series=10000):
+        self.max_host_series = max_host_series
+        # id -> host record, and the endpoint counts they add up to
+        self.hosts = {}
+        self.counts = Prometheus.get_metrics()
+        # the always exported counts, and how many hosts are in the others
+        self.pinned = {'current_states': set(self.counts['current_states'])}
+        self.members = {metric: {} for metric, _, _, _ in self.COUNTS}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def host_counts(host):
+        '''
+        the (metric, labels) counts a host is in, and what it adds to those
+        by label, which only count active hosts.
+        '''
+        keys = [('roles', (host['source'], host['role'])),
+                ('oses', (host['source'], host['ipv4_os'])),
+                ('current_states', (host['source'], host['state'])),
+                ('vlans', (host['source'], host['tenant'])),
+                ('sources', (host['source'],)),
+                ('port_tenants', (host['port'], host['tenant'])),
+                ('port_hosts', (host['port'],))]
+        if host['active'] == 0:
+            keys.append(('inactives', None))
+        if host['active'] == 1:
+            keys.append(('actives', None))
+        return keys, 1 if host['active'] == 1 else 0
+
+    def _count(self, host, sign):
+        keys, weight = self.host_counts(host)
+        for metric, key in keys:
+            # active and inactive are plain numbers of hosts
+            if key is None:
+                self.counts[metric] += sign
+                continue
+            counts = self.counts[metric]
+            members = self.members[metric]
+            counts[key] = counts.get(key, 0) + sign * weight
+            members[key] = members.get(key, 0) + sign
+            if members[key] <= 0:
+                del members[key]
+                if key not in self.pinned.get(metric, ()):
+                    del counts[key]
+
+    def update_hosts(self, hosts):
+        '''
+        apply changed hosts, by id, to the endpoint counts, where a host of
+        None was removed.
+        '''
+        with self.lock:
+            for name, host in hosts.items():
+                old = self.hosts.get(name, None)
+                if old == host:
+                    continue
+                if old is not None:
+                    self._count(old, -1)
+                if host is None:
+                    self.hosts.pop(name, None)
+                    continue
+                self.hosts[name] = host
+                self._count(host, 1)
+
+    def set_hosts(self, hosts):
+        ''' make the counts those of exactly these hosts, by id '''
+        with self.lock:
+            changed = {name: None for name in self.hosts if name not in hosts}
+            changed.update(hosts)
+            self.update_hosts(changed)
+
+    def collect(self):
+        with self.lock:
+            counts = {metric: dict(self.counts[metric])
+                      for metric, _, _, _ in self.COUNTS}
+            actives = self.counts['actives']
+            inactives = self.counts['inactives']
+            hosts = [host for host in self.hosts.values()
+                     if host['active'] == 1]
+        yield GaugeMetricFamily('poseidon_endpoint_inactive',
+                                'Number of endpoints that are inactive', value=inactives)
+        yield GaugeMetricFamily('poseidon_endpoint_active',
+                                'Number of endpoints that are active', value=actives)
+        for metric, name, description, labels in self.COUNTS:
+            family = GaugeMetricFamily(name, description, labels=labels)
+            for key, value in counts[metric].items():
+                family.add_metric([str(label) for label in key], value)
+            yield family
+
+        dropped = max(len(hosts) - self.max_host_series, 0)
+        if dropped:
+            hosts = sorted(hosts, key=lambda host: host['id'])[:self.max_host_series]
+        behavior = GaugeMetricFamily('poseidon_endpoint_behavior',
+                                     'Behavior of an endpoint, 0 is normal, 1 is abnormal',
+                                     labels=('ipv4', 'mac', 'tenant', 'segment',
+                                             'port', 'role', 'ipv4_os', 'source'))
+        ipv4_table = GaugeMetricFamily('poseidon_endpoint_ip_table', 'IP Table',
+                                       labels=('mac', 'tenant', 'segment', 'port',
+                                               'role', 'ipv4_os', 'hash_id', 'source'))
+        for host in hosts:
+            behavior.add_metric(
+                [str(host[label]) for label in ('ipv4', 'mac', 'tenant', 'segment',
+                                                'port', 'role', 'ipv4_os', 'source')],
+                host['behavior'])
+            try:
+                ipv4 = Prometheus.ip2int(host['ipv4'])
+            except (ValueError, TypeError, OSError):
+                ipv4 = 0
+            ipv4_table.add_metric(
+                [str(host[label]) for label in ('mac', 'tenant', 'segment', 'port',
+                                                'role', 'ipv4_os', 'id', 'source')],
+                ipv4)
+        yield behavior
+        yield ipv4_table
+        yield GaugeMetricFamily('poseidon_endpoint_host_series_dropped',
+                                'Number of active endpoints left out of the per-host series',
+                                value=dropped)
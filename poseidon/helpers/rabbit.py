@@ -11,73 +11,231 @@ from functools import partial
 import pika
 
 
-class Rabbit(object):
+class RabbitPublisher(object):
     '''
-    Base Class for RabbitMQ
+    Publishes to a topic exchange over one connection and channel that stay
+    open between publishes. A dropped connection is reopened and the
+    publish tried once more.
+
+    With confirms, each message waits for the broker to take it and a
+    rejected message raises.
     '''
 
-    def __init__(self):
+    def __init__(self, host, port=5672, exchange='topic-poseidon-internal',
+                 confirms=False, connection_factory=pika.BlockingConnection):
         self.logger = logging.getLogger('rabbit')
+        self.host = host
+        self.port = port
+        self.exchange = exchange
+        self.confirms = confirms
+        self.connection_factory = connection_factory
+        self.connection = None
+        self.channel = None
+        self.lock = threading.Lock()
+
+    def _open(self):
+        if self.channel is not None and self.channel.is_open and self.connection.is_open:
+            return self.channel
+        self._close()
+        self.connection = self.connection_factory(
+            pika.ConnectionParameters(host=self.host, port=self.port))
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(
+            exchange=self.exchange, exchange_type='topic')
+        if self.confirms:
+            self.channel.confirm_delivery()
+        self.logger.debug('connected to {0}:{1} rabbitmq to publish'.format(
+            self.host, self.port))
+        return self.channel
+
+    def _close(self):
+        connection = self.connection
+        self.connection = None
+        self.channel = None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError as e:  # pragma: no cover
+                self.logger.debug(
+                    'Unable to close rabbitmq connection because {0}'.format(str(e)))
+
+    def publish(self, routing_key, body):
+        ''' publish one message '''
+        self.publish_batch([(routing_key, body)])
 
-    def make_rabbit_connection(self, host, port, exchange, queue_name, keys,
-                               total_sleep=float('inf')):  # pragma: no cover
+    def publish_batch(self, messages):
         '''
-        Connects to rabbitmq using the given hostname,
-        exchange, and queue. Retries on failure until success.
-        Binds routing keys appropriate for module, and returns
-        the channel and connection.
+        publish (routing_key, body) pairs in order over one channel. if the
+        connection drops part way, the batch is sent again, so messages
+        may be delivered more than once.
         '''
-        wait = True
-        do_rabbit = True
-        rabbit_channel = None
-        rabbit_connection = None
+        messages = list(messages)
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    channel = self._open()
+                    for routing_key, body in messages:
+                        channel.basic_publish(exchange=self.exchange,
+                                              routing_key=routing_key,
+                                              body=body)
+                    return
+                except (pika.exceptions.AMQPConnectionError,
+                        pika.exceptions.AMQPChannelError) as e:
+                    self._close()
+                    if attempt:
+                        raise
+                    self.logger.debug(
+                        'Reconnecting to rabbitmq because {0}'.format(str(e)))
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+
+class Delivery(tuple):
+    '''
+    A (routing_key, body) work item that still has to be acked to the
+    consumer it came from, once it has been handled. redelivered is set
+    when rabbitmq has handed it out before.
+    '''
+
+    def __new__(cls, routing_key, body, consumer=None, channel=None, delivery_tag=None,
+                redelivered=False):
+        delivery = super(Delivery, cls).__new__(cls, (routing_key, body))
+        delivery.consumer = consumer
+        delivery.channel = channel
+        delivery.delivery_tag = delivery_tag
+        delivery.redelivered = redelivered
+        delivery.received = time.time()
+        return delivery
+
+
+class RabbitConsumer(object):
+    '''
+    Consumes a queue bound to a topic exchange into a work queue, on its
+    own thread.
 
-        while wait and total_sleep > 0:
+    At most prefetch messages are unacked at a time, and each is acked only
+    once the main loop has handled it, so a crash leaves unhandled messages
+    with rabbitmq. A message whose handler fails is requeued once, and
+    dropped if it fails again when redelivered. A lost connection is
+    reopened, waiting twice as long after each failed attempt up to
+    max_backoff seconds.
+    '''
+
+    def __init__(self, host, port, exchange, queue_name, keys, m_queue,
+                 prefetch=100, max_backoff=30, connection_factory=pika.BlockingConnection):
+        self.logger = logging.getLogger('rabbit')
+        self.host = host
+        self.port = port
+        self.exchange = exchange
+        self.queue_name = queue_name
+        self.keys = [keys] if isinstance(keys, str) else list(keys)
+        self.m_queue = m_queue
+        self.prefetch = prefetch
+        self.max_backoff = max_backoff
+        self.connection_factory = connection_factory
+        self.connection = None
+        self.channel = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def _connect(self):
+        self.connection = self.connection_factory(
+            pika.ConnectionParameters(host=self.host, port=self.port))
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(
+            exchange=self.exchange, exchange_type='topic')
+        self.channel.queue_declare(
+            queue=self.queue_name, exclusive=False, durable=True)
+        for key in self.keys:
+            self.channel.queue_bind(exchange=self.exchange,
+                                    queue=self.queue_name,
+                                    routing_key=key)
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+        self.channel.basic_consume(self.queue_name, self.on_message)
+        self.logger.debug('consuming {0} from {1}:{2} rabbitmq'.format(
+            self.queue_name, self.host, self.port))
+
+    def on_message(self, channel, method, properties, body):
+        self.m_queue.put(Delivery(method.routing_key, body, consumer=self,
+                                  channel=channel, delivery_tag=method.delivery_tag,
+                                  redelivered=method.redelivered))
+
+    def run(self):
+        backoff = min(1, self.max_backoff)
+        while not self.stopping.is_set():
             try:
-                # Starting rabbit connection
-                rabbit_connection = pika.BlockingConnection(
-                    pika.ConnectionParameters(host=host, port=port)
-                )
-                rabbit_channel = rabbit_connection.channel()
-                rabbit_channel.exchange_declare(exchange=exchange,
-                                                exchange_type='topic')
-                rabbit_channel.queue_declare(queue=queue_name, exclusive=False, durable=True)
-                self.logger.debug(
-                    'connected to {0} rabbitmq...'.format(host))
-                wait = False
-            except Exception as e:
+                self._connect()
+                backoff = min(1, self.max_backoff)
+                self.channel.start_consuming()
+            except pika.exceptions.AMQPError as e:
                 self.logger.debug(
-                    'waiting for connection to {0} rabbitmq...'.format(host))
-                self.logger.debug(str(e))
-                time.sleep(2)
-                total_sleep -= 2
-                wait = True
+                    'Lost connection to {0} rabbitmq because {1}, retrying in {2}s'.format(
+                        self.host, str(e), backoff))
+                self.stopping.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                if self.connection is not None and self.connection.is_open:
+                    try:
+                        self.connection.close()
+                    except pika.exceptions.AMQPError:  # pragma: no cover
+                        pass
 
-        if wait:
-            do_rabbit = False
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='rabbit_consumer')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
 
-        if rabbit_channel is not None and isinstance(keys, list) and not wait:
-            for key in keys:
+    def _settle(self, channel, acks, requeues, rejects):
+        # deliveries from a channel since closed are redelivered anyway
+        if not channel.is_open:
+            return
+        for delivery_tag in acks:
+            channel.basic_ack(delivery_tag=delivery_tag)
+        for delivery_tag in requeues:
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        for delivery_tag in rejects:
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+
+    def settle(self, deliveries, failed=()):
+        '''
+        ack the handled deliveries and requeue the failed ones, from any
+        thread, with one call into the consumer thread per channel. a
+        delivery that fails again after being redelivered is dropped.
+        '''
+        by_channel = {}
+        for delivery in deliveries:
+            by_channel.setdefault(delivery.channel, ([], [], []))[0].append(delivery.delivery_tag)
+        for delivery in failed:
+            if delivery.redelivered:
+                self.logger.error('Dropping {0} message that failed again after redelivery: {1}'.format(
+                    delivery[0], delivery[1]))
+                by_channel.setdefault(delivery.channel, ([], [], []))[2].append(delivery.delivery_tag)
+            else:
+                by_channel.setdefault(delivery.channel, ([], [], []))[1].append(delivery.delivery_tag)
+        connection = self.connection
+        # while reconnecting, the unsettled deliveries are redelivered anyway
+        if connection is None or not connection.is_open:
+            return
+        for channel, (acks, requeues, rejects) in by_channel.items():
+            try:
+                connection.add_callback_threadsafe(
+                    partial(self._settle, channel, acks, requeues, rejects))
+            except pika.exceptions.AMQPError as e:  # pragma: no cover
                 self.logger.debug(
-                    'array adding key:{0} to rabbitmq channel'.format(key))
-                rabbit_channel.queue_bind(exchange=exchange,
-                                          queue=queue_name,
-                                          routing_key=key)
-
-        if isinstance(keys, str) and not wait:
-            self.logger.debug(
-                'string adding key:{0} to rabbitmq channel'.format(keys))
-            rabbit_channel.queue_bind(exchange=exchange,
-                                      queue=queue_name,
-                                      routing_key=keys)
-
-        return rabbit_channel, rabbit_connection, do_rabbit
-
-    def start_channel(self, channel, mycallback, queue, m_queue):
-        ''' handle threading for messagetype '''
-        self.logger.debug(
-            'about to start channel {0}'.format(channel))
-        channel.basic_consume(queue, partial(mycallback, q=m_queue))
-        mq_recv_thread = threading.Thread(target=channel.start_consuming)
-        mq_recv_thread.start()
-        return mq_recv_thread
+                    'Unable to ack messages because {0}'.format(str(e)))
+
+    def _stop_consuming(self):
+        if self.channel is not None and self.channel.is_open:
+            self.channel.stop_consuming()
+
+    def stop(self):
+        self.stopping.set()
+        connection = self.connection
+        if connection is not None and connection.is_open:
+            try:
+                connection.add_callback_threadsafe(self._stop_consuming)
+            except pika.exceptions.AMQPError:  # pragma: no cover
+                pass
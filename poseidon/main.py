@@ -18,10 +18,11 @@ import signal
 import sys
 import threading
 import time
+from contextlib import contextmanager
 from copy import deepcopy
 from functools import partial
 
-import pika
+import msgpack
 import requests
 import schedule
 from redis import StrictRedis
@@ -35,55 +36,64 @@ from poseidon.helpers.config import Config
 from poseidon.helpers.endpoint import Endpoint
 from poseidon.helpers.endpoint import endpoint_factory
 from poseidon.helpers.endpoint import EndpointDecoder
+from poseidon.helpers.endpoint import EndpointRegistry
 from poseidon.helpers.endpoint import HistoryTypes
 from poseidon.helpers.endpoint import MACHINE_IP_FIELDS
 from poseidon.helpers.endpoint import MACHINE_IP_PREFIXES
+from poseidon.helpers.investigations import InvestigationScheduler
 from poseidon.helpers.log import Logger
 from poseidon.helpers.metadata import get_ether_vendor
 from poseidon.helpers.metadata import get_rdns_lookup
+from poseidon.helpers.metadata import RDNSResolver
 from poseidon.helpers.prometheus import Prometheus
-from poseidon.helpers.rabbit import Rabbit
+from poseidon.helpers.rabbit import RabbitConsumer
+from poseidon.helpers.rabbit import RabbitPublisher
 
 requests.packages.urllib3.disable_warnings()
 logging.getLogger('pika').setLevel(logging.WARNING)
 
 CTRL_C = dict()
 CTRL_C['STOP'] = False
+
+# guards Monitor.faucet_event between the rabbit handler and the scan job
+FAUCET_EVENT_LOCK = threading.Lock()
 Logger()
 logger = logging.getLogger('main')
 
 
-def rabbit_callback(ch, method, properties, body, q=None):
-    ''' callback, places rabbit data into internal queue'''
-    logger.debug('got a message: {0}:{1}:{2}'.format(
-        method.routing_key, body, type(body)))
-    if q is not None:
-        q.put((method.routing_key, body))
-    else:
-        logger.debug('poseidonMain workQueue is None')
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-
-
 def schedule_job_kickurl(schedule_func):
     global CTRL_C
-    schedule_func.s.check_endpoints(messages=schedule_func.faucet_event)
-    del schedule_func.faucet_event[:]
+    # swap in a fresh list so events that arrive meanwhile wait for next time
+    with FAUCET_EVENT_LOCK:
+        messages = schedule_func.faucet_event
+        schedule_func.faucet_event = []
+    coalesced = Parser.coalesce_events(messages)
+    try:
+        schedule_func.prom.update_event_counts(len(messages), len(coalesced))
+    except Exception as e:  # pragma: no cover
+        schedule_func.logger.debug(
+            'Unable to count FAUCET events because: {0}'.format(str(e)))
+    schedule_func.s.check_endpoints(messages=coalesced)
+    try:
+        planner = getattr(schedule_func.s.sdnc, 'acl_planner', None)
+        if planner:
+            schedule_func.prom.update_acl_counts(*planner.take_counts())
+    except Exception as e:  # pragma: no cover
+        schedule_func.logger.debug(
+            'Unable to count ACL ports because: {0}'.format(str(e)))
+    try:
+        schedule_func.prom.update_rdns_stats(*schedule_func.s.rdns.take_stats())
+    except Exception as e:  # pragma: no cover
+        schedule_func.logger.debug(
+            'Unable to send reverse DNS stats to Prometheus because: {0}'.format(str(e)))
 
     if not CTRL_C['STOP']:
         try:
-            # get current state
-            req = requests.get(
-                'http://poseidon-api:8000/v1/network_full', timeout=10)
-
-            # send results to prometheus
-            hosts = req.json()['dataset']
-            schedule_func.prom.update_metrics(hosts)
-        except requests.exceptions.ConnectionError as e:
-            schedule_func.logger.debug(
-                'Unable to get current state and send it to Prometheus because: {0}'.format(str(e)))
+            # catch up on the endpoint changes that are not state transitions
+            schedule_func.update_endpoint_metrics()
         except Exception as e:  # pragma: no cover
             schedule_func.logger.error(
-                'Unable to get current state and send it to Prometheus because: {0}'.format(str(e)))
+                'Unable to send the current state to Prometheus because: {0}'.format(str(e)))
 
 
 def schedule_job_reinvestigation(schedule_func):
@@ -103,17 +113,18 @@ def schedule_job_reinvestigation(schedule_func):
                 schedule_func.s.mirror_endpoint(chosen)
 
     if not CTRL_C['STOP']:
-        candidates = [
-            endpoint for endpoint in schedule_func.s.endpoints.values()
-            if endpoint.state in ['queued']]
-        if len(candidates) == 0:
-            # if no queued endpoints, then known and abnormal are candidates
-            candidates = [
-                endpoint for endpoint in schedule_func.s.endpoints.values()
-                if endpoint.state in ['known', 'abnormal']]
-            if len(candidates) > 0:
-                random.shuffle(candidates)
-        if schedule_func.s.sdnc:
+        schedule_func.s.investigations = schedule_func.s.scheduler.in_flight
+        budget = schedule_func.controller['max_concurrent_reinvestigations'] - \
+            schedule_func.s.investigations
+        if schedule_func.s.sdnc and budget > 0:
+            endpoints = schedule_func.s.endpoints
+            candidates = endpoints.lookup('state', 'queued')
+            if len(candidates) == 0:
+                # if no queued endpoints, then known and abnormal are candidates
+                candidates = endpoints.lookup(
+                    'state', 'known') + endpoints.lookup('state', 'abnormal')
+                if len(candidates) > 0:
+                    random.shuffle(candidates)
             trigger_reinvestigation(candidates)
 
 def schedule_job_coprocessing(schedule_func):
@@ -137,14 +148,12 @@ def schedule_job_coprocessing(schedule_func):
             schedule_func.s.start_pipette
             schedule_func.s.pipette_running = True
 
-        candidates = [
-            endpoint for endpoint in schedule_func.s.endpoints.values()
-            if endpoint.state in ['queued']]
+        endpoints = schedule_func.s.endpoints
+        candidates = endpoints.lookup('state', 'queued')
         if len(candidates) == 0:
             # if no queued endpoints, then known and abnormal are candidates
-            candidates = [
-                endpoint for endpoint in schedule_func.s.endpoints.values()
-                if endpoint.state in ['known', 'abnormal']]
+            candidates = endpoints.lookup(
+                'state', 'known') + endpoints.lookup('state', 'abnormal')
             if len(candidates) > 0:
                 random.shuffle(candidates)
         if schedule_func.s.sdnc:
@@ -179,16 +188,52 @@ class SDNConnect:
         else:
             self.trunk_ports = trunk_ports
         self.logger = logger
+        self.publisher = None
+        self.rdns = RDNSResolver(
+            workers=self.controller.get('rdns_workers', 4),
+            ttl=self.controller.get('rdns_ttl', 3600),
+            negative_ttl=self.controller.get('rdns_negative_ttl', 300))
         self.get_sdn_context()
         self.redis_lock = threading.Lock()
+        # last packed form and generation of each endpoint known to be in Redis
+        self.stored_snapshots = {}
+        self.stored_generations = {}
+        # when every endpoint's metadata was last refreshed from Redis
+        self.metadata_refreshed = 0
+        self._endpoints = EndpointRegistry()
+        # mirrors not reported back in twice the reinvestigation frequency time out
+        self.scheduler = InvestigationScheduler(
+            self._endpoints, 2*self.controller['reinvestigation_frequency'])
         self.connect_redis()
         if self.first_time:
-            self.endpoints = {}
             self.investigations = 0
             self.coprocessing = 0
             self.clear_filters()
             self.default_endpoints()
 
+    @property
+    def endpoints(self):
+        return self._endpoints
+
+    @endpoints.setter
+    def endpoints(self, endpoints):
+        if not isinstance(endpoints, EndpointRegistry):
+            endpoints = EndpointRegistry(endpoints)
+        self._endpoints = endpoints
+        self.scheduler.rebind(endpoints)
+
+    @contextmanager
+    def config_transaction(self):
+        '''
+        group controller config changes made in the block into a single
+        config update, for controllers that support it.
+        '''
+        if self.sdnc and hasattr(self.sdnc, 'config_transaction'):
+            with self.sdnc.config_transaction():
+                yield
+        else:
+            yield
+
     def mirror_endpoint(self, endpoint):
         ''' mirror an endpoint. '''
         status = Actions(endpoint, self.sdnc).mirror_endpoint()
@@ -238,21 +283,74 @@ class SDNConnect:
                         (endpoint.state, int(time.time())))
         self.store_endpoints()
 
+    @staticmethod
+    def _endpoint_key(name):
+        ''' name of the Redis key holding a packed endpoint. '''
+        return '_'.join(('p_endpoint', str(name)))
+
+    def _migrate_p_endpoints(self):
+        ''' move endpoints from the legacy p_endpoints blob to per-endpoint keys. '''
+        p_endpoints = self.r.get('p_endpoints')
+        if not p_endpoints:
+            return
+        p_endpoints = ast.literal_eval(p_endpoints.decode('ascii'))
+        pipe = self.r.pipeline(transaction=True)
+        for p_endpoint in p_endpoints:
+            endpoint = EndpointDecoder(p_endpoint).get_endpoint()
+            pipe.set(self._endpoint_key(endpoint.name), endpoint.pack())
+            pipe.hincrby('p_endpoints_generations', endpoint.name, 1)
+        pipe.delete('p_endpoints')
+        pipe.execute()
+        self.logger.info(
+            'Migrated {0} endpoints out of p_endpoints'.format(len(p_endpoints)))
+
     def get_stored_endpoints(self):
-        ''' load existing endpoints from Redis. '''
+        '''
+        load existing endpoints from Redis.
+
+        every endpoint has a generation counter in p_endpoints_generations
+        that is bumped on each write, so only endpoints whose generation
+        differs from the one last seen are fetched and decoded.
+        '''
         with self.redis_lock:
             if self.r:
                 try:
-                    p_endpoints = self.r.get('p_endpoints')
-                    if p_endpoints:
-                        new_endpoints = {}
-                        p_endpoints = ast.literal_eval(
-                            p_endpoints.decode('ascii'))
-                        for p_endpoint in p_endpoints:
-                            endpoint = EndpointDecoder(
-                                p_endpoint).get_endpoint()
-                            new_endpoints[endpoint.name] = endpoint
-                        self.endpoints = new_endpoints
+                    generations = self.r.hgetall('p_endpoints_generations')
+                    if not generations:
+                        self._migrate_p_endpoints()
+                        generations = self.r.hgetall('p_endpoints_generations')
+                    generations = {
+                        name.decode('ascii'): int(generation) for name, generation in generations.items()}
+                    if generations:
+                        # updated in place, so unchanged endpoints keep their index entries
+                        kept = set()
+                        changed = []
+                        for name, generation in generations.items():
+                            if name in self.endpoints and self.stored_generations.get(name, None) == generation:
+                                kept.add(name)
+                            else:
+                                changed.append(name)
+                        if changed:
+                            p_endpoints = self.r.mget(
+                                [self._endpoint_key(name) for name in changed])
+                            for name, p_endpoint in zip(changed, p_endpoints):
+                                if p_endpoint is None:
+                                    continue
+                                endpoint = EndpointDecoder(
+                                    p_endpoint).get_endpoint()
+                                self.endpoints[endpoint.name] = endpoint
+                                # just as it is in Redis, nothing to store
+                                self.endpoints.unmark_changed(endpoint.name)
+                                kept.add(endpoint.name)
+                                self.stored_snapshots[name] = p_endpoint
+                                self.stored_generations[name] = generations[name]
+                        for name in set(self.endpoints) - kept:
+                            del self.endpoints[name]
+                        for name in set(self.stored_snapshots) - kept:
+                            del self.stored_snapshots[name]
+                            self.stored_generations.pop(name, None)
+                        self.logger.debug('Loaded {0} changed endpoints of {1}'.format(
+                            len(changed), len(self.endpoints)))
                 except Exception as e:  # pragma: no cover
                     self.logger.error(
                         'Unable to get existing endpoints from Redis because {0}'.format(str(e)))
@@ -288,70 +386,130 @@ class SDNConnect:
             'pcap_labels': pcap_labels})
         return metadata
 
+    @staticmethod
+    def _mac_index_key(hash_id):
+        ''' name of the Redis set indexing the MACs of a poseidon hash. '''
+        return '_'.join((str(hash_id), 'macs'))
+
     def get_stored_metadata(self, hash_id):
-        mac_addresses = {}
-        ip_addresses = {ip_field: {} for ip_field in MACHINE_IP_FIELDS}
+        endpoint = self.endpoints.get(hash_id, None)
+        if endpoint is None:
+            endpoint = endpoint_factory(hash_id)
+            endpoint.endpoint_data = {}
+        metadata, _ = self.get_stored_metadata_bulk([endpoint])
+        return metadata[endpoint.name]
+
+    def get_stored_metadata_bulk(self, endpoints):
+        '''
+        fetch ML and OS metadata for many endpoints at once.
+
+        uses the <hash>_macs reverse index (plus the endpoint's own MAC) to
+        find candidate MACs, so the cost is linear in the number of
+        endpoints and their ML records, and the lookups go out as three
+        pipelined round-trips no matter how many endpoints there are.
+        returns a dict of hash -> (mac_addresses, ipv4_addresses,
+        ipv6_addresses) and a dict of MAC -> the poseidon hash currently
+        stored for that MAC.
+        '''
+        endpoints = list(endpoints)
+        mac_addresses = {endpoint.name: {} for endpoint in endpoints}
+        ip_addresses = {endpoint.name: {ip_field: {} for ip_field in MACHINE_IP_FIELDS}
+                        for endpoint in endpoints}
+        mac_owners = {}
 
-        if self.r:
-            macs = []
+        def _metadata():
+            return {name: (mac_addresses[name], ip_addresses[name]['ipv4'], ip_addresses[name]['ipv6'])
+                    for name in mac_addresses}, mac_owners
+
+        if not self.r or not endpoints:
+            return _metadata()
+
+        # candidate MACs for each endpoint
+        candidates = {}
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            for endpoint in endpoints:
+                pipe.smembers(self._mac_index_key(endpoint.name))
+            indexed_macs = pipe.execute()
+        except Exception as e:  # pragma: no cover
+            self.logger.error(
+                'Unable to get existing mac addresses from Redis because: {0}'.format(str(e)))
+            indexed_macs = [set() for _ in endpoints]
+        for endpoint, macs in zip(endpoints, indexed_macs):
+            macs = {mac.decode('ascii') for mac in macs}
+            mac = (endpoint.endpoint_data or {}).get('mac', None)
+            if mac:
+                macs.add(mac)
+            candidates[endpoint.name] = sorted(macs)
+
+        # MAC records, including ML timestamps and the owning hash
+        mac_infos = {}
+        unique_macs = sorted(
+            {mac for macs in candidates.values() for mac in macs})
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            for mac in unique_macs:
+                pipe.hgetall(mac)
+            mac_infos = dict(zip(unique_macs, pipe.execute()))
+        except Exception as e:  # pragma: no cover
+            self.logger.error(
+                'Unable to get existing metadata from Redis because: {0}'.format(str(e)))
+        for mac, mac_info in mac_infos.items():
+            if b'poseidon_hash' in mac_info:
+                mac_owners[mac] = mac_info[b'poseidon_hash'].decode('ascii')
+
+        # ML records and IP records
+        ml_lookups = []
+        ip_lookups = []
+        for endpoint in endpoints:
+            for mac in candidates[endpoint.name]:
+                if mac_owners.get(mac, None) != endpoint.name:
+                    continue
+                mac_addresses[endpoint.name][mac] = {}
+                mac_info = mac_infos[mac]
+                if b'timestamps' in mac_info:
+                    try:
+                        timestamps = ast.literal_eval(
+                            mac_info[b'timestamps'].decode('ascii'))
+                        for timestamp in timestamps:
+                            ml_lookups.append(
+                                (endpoint.name, mac, str(timestamp)))
+                    except Exception as e:  # pragma: no cover
+                        self.logger.error(
+                            'Unable to get existing ML data from Redis because: {0}'.format(str(e)))
+            for ip_field in MACHINE_IP_FIELDS:
+                raw_field = (endpoint.endpoint_data or {}).get(ip_field, None)
+                try:
+                    machine_ip = ipaddress.ip_address(raw_field)
+                except ValueError:
+                    machine_ip = ''
+                if machine_ip:
+                    ip_lookups.append((endpoint.name, ip_field, raw_field))
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            for _, mac, timestamp in ml_lookups:
+                pipe.hgetall('_'.join((mac, timestamp)))
+            for _, _, raw_field in ip_lookups:
+                pipe.hgetall(raw_field)
+            results = pipe.execute()
+        except Exception as e:  # pragma: no cover
+            self.logger.error(
+                'Unable to get existing ML and IP data from Redis because: {0}'.format(str(e)))
+            return _metadata()
+        for (name, mac, timestamp), ml_info in zip(ml_lookups, results):
             try:
-                macs = self.r.smembers('mac_addresses')
+                mac_addresses[name][mac][timestamp] = SDNConnect.parse_metadata(
+                    mac_infos[mac], ml_info)
             except Exception as e:  # pragma: no cover
                 self.logger.error(
-                    'Unable to get existing mac addresses from Redis because: {0}'.format(str(e)))
-            for mac in macs:
-                try:
-                    mac_info = self.r.hgetall(mac)
-                    if b'poseidon_hash' in mac_info and mac_info[b'poseidon_hash'] == hash_id.encode('utf-8'):
-                        mac_addresses[mac.decode('ascii')] = {}
-                        if b'timestamps' in mac_info:
-                            try:
-                                timestamps = ast.literal_eval(
-                                    mac_info[b'timestamps'].decode('ascii'))
-                                for timestamp in timestamps:
-                                    ml_info = self.r.hgetall(
-                                        mac.decode('ascii')+'_'+str(timestamp))
-                                    metadata = SDNConnect.parse_metadata(
-                                        mac_info, ml_info)
-                                    mac_addresses[mac.decode('ascii')][str(
-                                        timestamp)] = metadata
-                            except Exception as e:  # pragma: no cover
-                                self.logger.error(
-                                    'Unable to get existing ML data from Redis because: {0}'.format(str(e)))
-                        try:
-                            poseidon_info = self.r.hgetall(
-                                mac_info[b'poseidon_hash'])
-                            if b'endpoint_data' in poseidon_info:
-                                endpoint_data = ast.literal_eval(
-                                    poseidon_info[b'endpoint_data'].decode('ascii'))
-                                for ip_field in MACHINE_IP_FIELDS:
-                                    try:
-                                        raw_field = endpoint_data.get(
-                                            ip_field, None)
-                                        machine_ip = ipaddress.ip_address(
-                                            raw_field)
-                                    except ValueError:
-                                        machine_ip = ''
-                                    if machine_ip:
-                                        try:
-                                            ip_info = self.r.hgetall(raw_field)
-                                            short_os = ip_info.get(
-                                                b'short_os', None)
-                                            ip_addresses[ip_field][raw_field] = {
-                                            }
-                                            if short_os:
-                                                ip_addresses[ip_field][raw_field]['os'] = short_os.decode(
-                                                    'ascii')
-                                        except Exception as e:  # pragma: no cover
-                                            self.logger.error(
-                                                'Unable to get existing {0} data from Redis because: {1}'.format(ip_field, str(e)))
-                        except Exception as e:  # pragma: no cover
-                            self.logger.error(
-                                'Unable to get existing endpoint data from Redis because: {0}'.format(str(e)))
-                except Exception as e:  # pragma: no cover
-                    self.logger.error(
-                        'Unable to get existing metadata for {0} from Redis because: {1}'.format(mac, str(e)))
-        return mac_addresses, ip_addresses['ipv4'], ip_addresses['ipv6']
+                    'Unable to parse ML data for {0} because: {1}'.format(mac, str(e)))
+        for (name, ip_field, raw_field), ip_info in zip(ip_lookups, results[len(ml_lookups):]):
+            ip_addresses[name][ip_field][raw_field] = {}
+            short_os = ip_info.get(b'short_os', None)
+            if short_os:
+                ip_addresses[name][ip_field][raw_field]['os'] = short_os.decode(
+                    'ascii')
+        return _metadata()
 
     def get_sdn_context(self):
         controller_type = self.controller.get('TYPE', None)
@@ -385,46 +543,32 @@ class SDNConnect:
         return self.endpoint_by_name(hash_id)
 
     def endpoints_by_ip(self, ip):
-        endpoints = [
-            endpoint for endpoint in self.endpoints.values()
-            if ip == endpoint.endpoint_data.get('ipv4', None) or
-            ip == endpoint.endpoint_data.get('ipv6', None)]
-        return endpoints
+        return self.endpoints.by_ip(ip)
 
     def endpoints_by_mac(self, mac):
-        endpoints = [
-            endpoint for endpoint in self.endpoints.values()
-            if mac == endpoint.endpoint_data['mac']]
-        return endpoints
-
-    @staticmethod
-    def _connect_rabbit():
-        # Rabbit settings
-        exchange = 'topic-poseidon-internal'
-        exchange_type = 'topic'
-
-        # Starting rabbit connection
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host='RABBIT_SERVER')
-        )
-
-        channel = connection.channel()
-        channel.exchange_declare(
-            exchange=exchange, exchange_type=exchange_type
-        )
-
-        return channel, exchange, connection
-
-    @staticmethod
-    def publish_action(action, message):
+        return self.endpoints.lookup('mac', mac)
+
+    def _get_publisher(self):
+        ''' the publisher for actions, connected on first use '''
+        if self.publisher is None:
+            self.publisher = RabbitPublisher(
+                self.controller.get('rabbit_server', 'RABBIT_SERVER'),
+                port=int(self.controller.get('rabbit_port', 5672)),
+                confirms=self.controller.get('rabbit_confirms', False))
+        return self.publisher
+
+    def publish_action(self, action, message):
+        return self.publish_actions([(action, message)])
+
+    def publish_actions(self, actions):
+        ''' publish (action, message) pairs over one connection '''
         try:
-            channel, exchange, connection = SDNConnect._connect_rabbit()
-            channel.basic_publish(exchange=exchange,
-                                  routing_key=action,
-                                  body=message)
-            connection.close()
+            self._get_publisher().publish_batch(actions)
+            return True
         except Exception as e:  # pragma: no cover
-            print(str(e))
+            self.logger.error(
+                'Unable to publish actions because {0}'.format(str(e)))
+            return False
 
     def show_endpoints(self, arg):
         endpoints = []
@@ -432,15 +576,18 @@ class SDNConnect:
             endpoints = list(self.endpoints.values())
         else:
             show_type, arg = arg.split(' ', 1)
-            for endpoint in self.endpoints.values():
-                if show_type == 'state':
-                    if arg == 'active' and endpoint.state != 'inactive':
-                        endpoints.append(endpoint)
-                    elif arg == 'ignored' and endpoint.ignore:
-                        endpoints.append(endpoint)
-                    elif endpoint.state == arg:
-                        endpoints.append(endpoint)
-                elif show_type in ['os', 'behavior', 'role']:
+            if show_type == 'state':
+                if arg == 'active':
+                    endpoints = [
+                        endpoint for state in list(self.endpoints.indexes['state']) if state != 'inactive'
+                        for endpoint in self.endpoints.lookup('state', state)]
+                elif arg == 'ignored':
+                    endpoints = self.endpoints.lookup('ignore', True)
+                else:
+                    endpoints = self.endpoints.lookup('state', arg)
+                return endpoints
+            for endpoint in list(self.endpoints.values()):
+                if show_type in ['os', 'behavior', 'role']:
                     mac_addresses = endpoint.metadata.get(
                         'mac_addresses', None)
                     endpoint_mac = endpoint.endpoint_data['mac']
@@ -520,7 +667,7 @@ class SDNConnect:
             machine_a_strlines, machine_b_strlines, n=1))
 
     @staticmethod
-    def _parse_machine_ip(machine):
+    def _parse_machine_ip(machine, rdns_lookup=get_rdns_lookup):
         machine_ip_data = {}
         for ip_field, fields in MACHINE_IP_FIELDS.items():
             try:
@@ -535,7 +682,7 @@ class SDNConnect:
             if machine_ip:
                 machine_ip_data.update({
                     ip_field: str(machine_ip),
-                    '_'.join((ip_field, 'rdns')): get_rdns_lookup(str(machine_ip)),
+                    '_'.join((ip_field, 'rdns')): rdns_lookup(str(machine_ip)),
                     '_'.join((ip_field, 'subnet')): str(machine_subnet)})
             for field in fields:
                 if field not in machine_ip_data:
@@ -557,72 +704,77 @@ class SDNConnect:
         '''parse switch structure to find new machines added to network
         since last call'''
         change_acls = False
-
-        for machine in machines:
-            machine['ether_vendor'] = get_ether_vendor(
-                machine['mac'], '/poseidon/poseidon/metadata/nmap-mac-prefixes.txt')
-            machine.update(self._parse_machine_ip(machine))
-            if 'controller_type' not in machine:
-                machine.update({
-                    'controller_type': 'none',
-                    'controller': ''})
-            trunk = False
-            for sw in self.trunk_ports:
-                if sw == machine['segment'] and self.trunk_ports[sw].split(',')[1] == str(machine['port']) and self.trunk_ports[sw].split(',')[0] == machine['mac']:
-                    trunk = True
-
-            h = Endpoint.make_hash(machine, trunk=trunk)
-            ep = self.endpoints.get(h, None)
-            if ep is None:
-                change_acls = True
-                m = endpoint_factory(h)
-                m.p_prev_states.append((m.state, int(time.time())))
-                m.endpoint_data = deepcopy(machine)
-                self.endpoints[m.name] = m
-                self.logger.info(
-                    'Detected new endpoint: {0}:{1}'.format(m.name, machine))
-            else:
-                self.merge_machine_ip(ep.endpoint_data, machine)
-
-            if ep and ep.endpoint_data != machine and not ep.ignore:
-                diff_txt = self._diff_machine(ep.endpoint_data, machine)
-                self.logger.info(
-                    'Endpoint changed: {0}:{1}'.format(h, diff_txt))
-                change_acls = True
-                ep.endpoint_data = deepcopy(machine)
-                if ep.state == 'inactive' and machine['active'] == 1:
-                    if ep.p_next_state in ['known', 'abnormal']:
-                        ep.trigger(ep.p_next_state)
-                    else:
-                        ep.unknown()
-                    ep.p_prev_states.append((ep.state, int(time.time())))
-                elif ep.state != 'inactive' and machine['active'] == 0:
-                    if ep.state in ['mirroring', 'reinvestigating']:
-                        self.unmirror_endpoint(ep)
-                        if ep.state == 'mirroring':
-                            ep.p_next_state = 'mirror'
-                        elif ep.state == 'reinvestigating':
-                            ep.p_next_state = 'reinvestigate'
-                    if ep.state in ['known', 'abnormal']:
-                        ep.p_next_state = ep.state
-                    ep.inactive()
-                    ep.p_prev_states.append((ep.state, int(time.time())))
-
-        if change_acls and self.controller['AUTOMATED_ACLS']:
-            status = Actions(None, self.sdnc).update_acls(
-                rules_file=self.controller['RULES_FILE'],
-                endpoints=self.endpoints.values())
-            if isinstance(status, list):
-                self.logger.info(
-                    'Automated ACLs did the following: {0}'.format(status[1]))
-                for item in status[1]:
-                    machine = {'mac': item[1],
-                               'segment': item[2], 'port': item[3]}
-                    h = Endpoint.make_hash(machine)
-                    ep = self.endpoints.get(h, None)
-                    if ep:
-                        ep.acl_data.append(
-                            ((item[0], item[4], item[5]), int(time.time())))
+        changed_endpoints = []
+
+        with self.config_transaction():
+            for machine in machines:
+                machine['ether_vendor'] = get_ether_vendor(
+                    machine['mac'], '/poseidon/poseidon/metadata/nmap-mac-prefixes.txt')
+                machine.update(self._parse_machine_ip(machine, self.rdns.lookup))
+                if 'controller_type' not in machine:
+                    machine.update({
+                        'controller_type': 'none',
+                        'controller': ''})
+                trunk = False
+                for sw in self.trunk_ports:
+                    if sw == machine['segment'] and self.trunk_ports[sw].split(',')[1] == str(machine['port']) and self.trunk_ports[sw].split(',')[0] == machine['mac']:
+                        trunk = True
+
+                h = Endpoint.make_hash(machine, trunk=trunk)
+                ep = self.endpoints.get(h, None)
+                if ep is None:
+                    change_acls = True
+                    m = endpoint_factory(h)
+                    changed_endpoints.append(m)
+                    m.p_prev_states.append((m.state, int(time.time())))
+                    m.endpoint_data = deepcopy(machine)
+                    self.endpoints[m.name] = m
+                    self.logger.info(
+                        'Detected new endpoint: {0}:{1}'.format(m.name, machine))
+                else:
+                    self.merge_machine_ip(ep.endpoint_data, machine)
+
+                if ep and ep.endpoint_data != machine and not ep.ignore:
+                    diff_txt = self._diff_machine(ep.endpoint_data, machine)
+                    self.logger.info(
+                        'Endpoint changed: {0}:{1}'.format(h, diff_txt))
+                    change_acls = True
+                    changed_endpoints.append(ep)
+                    ep.endpoint_data = deepcopy(machine)
+                    if ep.state == 'inactive' and machine['active'] == 1:
+                        if ep.p_next_state in ['known', 'abnormal']:
+                            ep.trigger(ep.p_next_state)
+                        else:
+                            ep.unknown()
+                        ep.p_prev_states.append((ep.state, int(time.time())))
+                    elif ep.state != 'inactive' and machine['active'] == 0:
+                        if ep.state in ['mirroring', 'reinvestigating']:
+                            self.unmirror_endpoint(ep)
+                            if ep.state == 'mirroring':
+                                ep.p_next_state = 'mirror'
+                            elif ep.state == 'reinvestigating':
+                                ep.p_next_state = 'reinvestigate'
+                        if ep.state in ['known', 'abnormal']:
+                            ep.p_next_state = ep.state
+                        ep.inactive()
+                        ep.p_prev_states.append((ep.state, int(time.time())))
+
+            if change_acls and self.controller['AUTOMATED_ACLS']:
+                status = Actions(None, self.sdnc).update_acls(
+                    rules_file=self.controller['RULES_FILE'],
+                    endpoints=self.endpoints.values(),
+                    changed_endpoints=changed_endpoints)
+                if isinstance(status, list):
+                    self.logger.info(
+                        'Automated ACLs did the following: {0}'.format(status[1]))
+                    for item in status[1]:
+                        machine = {'mac': item[1],
+                                   'segment': item[2], 'port': item[3]}
+                        h = Endpoint.make_hash(machine)
+                        ep = self.endpoints.get(h, None)
+                        if ep:
+                            ep.acl_data.append(
+                                ((item[0], item[4], item[5]), int(time.time())))
         self.store_endpoints()
         self.get_stored_endpoints()
 
@@ -663,53 +815,151 @@ class SDNConnect:
                                                      record[field['field_name']])
                 prior = record
 
-    def store_endpoints(self):
-        ''' store current endpoints in Redis. '''
+    @staticmethod
+    def _archive_key(name, ring):
+        return 'p_archive_'+ring+'_'+name
+
+    @staticmethod
+    def _queue_archive_writes(pipe, endpoint):
+        ''' append entries that aged out of the endpoint's rings to its archives. '''
+        for ring_name, ring in endpoint.rings().items():
+            if ring.spilled:
+                pipe.rpush(SDNConnect._archive_key(endpoint.name, ring_name),
+                           *[msgpack.packb(entry, use_bin_type=True) for entry in ring.spilled])
+
+    def get_endpoint_archive(self, name, ring='history'):
+        '''
+        full history of one of an endpoint's rings ('history',
+        'prev_states' or 'acl_data'): the stored archive merged with what
+        is still in the ring. the archive is kept after the endpoint is
+        removed, so its history can still be read.
+        '''
+        archived = []
+        if self.r:
+            try:
+                archived = [msgpack.unpackb(entry, raw=False) for entry in
+                            self.r.lrange(self._archive_key(name, ring), 0, -1)]
+            except Exception as e:  # pragma: no cover
+                self.logger.error(
+                    'Unable to get archive for {0} because {1}'.format(name, str(e)))
+        endpoint = self.endpoints.get(name, None)
+        if endpoint is None:
+            return archived
+        entries = endpoint.rings()[ring]
+        return entries[:entries.pinned] + archived + entries.spilled + entries[entries.pinned:]
+
+    @staticmethod
+    def _queue_endpoint_writes(pipe, endpoint, mac_owners):
+        ''' queue the Redis writes for a single endpoint onto a pipeline. '''
+        redis_endpoint_data = {
+            'name': str(endpoint.name),
+            'state': str(endpoint.state),
+            'ignore': str(endpoint.ignore),
+            'endpoint_data': str(endpoint.endpoint_data),
+            'next_state': str(endpoint.p_next_state),
+            'prev_states': str(endpoint.p_prev_states),
+            'acl_data': str(endpoint.acl_data),
+            'metadata': str(endpoint.metadata),
+        }
+        pipe.hmset(endpoint.name, redis_endpoint_data)
+        mac = endpoint.endpoint_data['mac']
+        pipe.hmset(mac, {'poseidon_hash': str(endpoint.name)})
+        pipe.sadd('mac_addresses', mac)
+        # keep the hash -> MACs reverse index in step with the MAC record
+        old_owner = mac_owners.get(mac, None)
+        if old_owner and old_owner != endpoint.name:
+            pipe.srem(SDNConnect._mac_index_key(old_owner), mac)
+        pipe.sadd(SDNConnect._mac_index_key(endpoint.name), mac)
+        mac_owners[mac] = endpoint.name
+        for ip_field in MACHINE_IP_FIELDS:
+            try:
+                machine_ip = ipaddress.ip_address(
+                    endpoint.endpoint_data.get(ip_field, None))
+            except ValueError:
+                machine_ip = None
+            if machine_ip:
+                pipe.hmset(
+                    str(machine_ip), {'poseidon_hash': str(endpoint.name)})
+                pipe.sadd('ip_addresses', str(machine_ip))
+
+    def store_endpoints(self, full=False):
+        '''
+        store current endpoints in Redis.
+
+        only endpoints that changed since the last store (or load) are
+        packed and written, and all writes go out as a single pipelined
+        transaction. their metadata is refreshed from Redis as they are
+        stored, and every endpoint's metadata once each
+        metadata_refresh_frequency seconds, or with full.
+        '''
         with self.redis_lock:
             if self.r:
+                changed = self.endpoints.take_changed()
                 try:
-                    serialized_endpoints = []
-                    for endpoint in self.endpoints.values():
+                    now = time.time()
+                    refresh_all = full or now - self.metadata_refreshed >= self.controller.get(
+                        'metadata_refresh_frequency', 60)
+                    if refresh_all:
+                        endpoints = list(self.endpoints.values())
+                    else:
+                        endpoints = [self.endpoints[name]
+                                     for name in changed if name in self.endpoints]
+                    snapshots = {}
+                    dirty_endpoints = []
+                    metadata, mac_owners = self.get_stored_metadata_bulk(
+                        endpoints)
+                    for endpoint in endpoints:
                         # set metadata
-                        mac_addresses, ipv4_addresses, ipv6_addresses = self.get_stored_metadata(
-                            str(endpoint.name))
+                        mac_addresses, ipv4_addresses, ipv6_addresses = metadata[endpoint.name]
                         self.update_history(
                             endpoint, mac_addresses, ipv4_addresses, ipv6_addresses)
                         endpoint.metadata = {
                             'mac_addresses': mac_addresses,
                             'ipv4_addresses': ipv4_addresses,
                             'ipv6_addresses': ipv6_addresses}
-                        redis_endpoint_data = {
-                            'name': str(endpoint.name),
-                            'state': str(endpoint.state),
-                            'ignore': str(endpoint.ignore),
-                            'endpoint_data': str(endpoint.endpoint_data),
-                            'next_state': str(endpoint.p_next_state),
-                            'prev_states': str(endpoint.p_prev_states),
-                            'acl_data': str(endpoint.acl_data),
-                            'metadata': str(endpoint.metadata),
-                        }
-                        self.r.hmset(endpoint.name, redis_endpoint_data)
-                        mac = endpoint.endpoint_data['mac']
-                        self.r.hmset(
-                            mac, {'poseidon_hash': str(endpoint.name)})
-                        if not self.r.sismember('mac_addresses', mac):
-                            self.r.sadd('mac_addresses', mac)
-                        for ip_field in MACHINE_IP_FIELDS:
-                            try:
-                                machine_ip = ipaddress.ip_address(
-                                    endpoint.endpoint_data.get(ip_field, None))
-                            except ValueError:
-                                machine_ip = None
-                            if machine_ip:
-                                self.r.hmset(
-                                    str(machine_ip), {'poseidon_hash': str(endpoint.name)})
-                                if not self.r.sismember('ip_addresses', str(machine_ip)):
-                                    self.r.sadd('ip_addresses',
-                                                str(machine_ip))
-                        serialized_endpoints.append(endpoint.encode())
-                    self.r.set('p_endpoints', str(serialized_endpoints))
+                        # changes from here on are left for the next store
+                        self.endpoints.unmark_changed(endpoint.name)
+                        packed_endpoint = endpoint.pack()
+                        snapshots[endpoint.name] = packed_endpoint
+                        if full or self.stored_snapshots.get(endpoint.name) != packed_endpoint:
+                            dirty_endpoints.append(endpoint)
+                    removed = set(self.stored_snapshots) - set(self.endpoints)
+                    if dirty_endpoints or removed:
+                        pipe = self.r.pipeline(transaction=True)
+                        generation_results = {}
+                        for endpoint in dirty_endpoints:
+                            self._queue_endpoint_writes(
+                                pipe, endpoint, mac_owners)
+                            self._queue_archive_writes(pipe, endpoint)
+                            pipe.set(self._endpoint_key(endpoint.name),
+                                     snapshots[endpoint.name])
+                            generation_results[endpoint.name] = len(pipe)
+                            pipe.hincrby('p_endpoints_generations',
+                                         endpoint.name, 1)
+                        for name in removed:
+                            pipe.delete(self._endpoint_key(name))
+                            pipe.hdel('p_endpoints_generations', name)
+                        # tells the API its snapshot of the endpoints is stale
+                        pipe.incr('p_endpoints_version')
+                        results = pipe.execute()
+                        for endpoint in dirty_endpoints:
+                            for ring in endpoint.rings().values():
+                                del ring.spilled[:]
+                        for name, result in generation_results.items():
+                            self.stored_generations[name] = int(
+                                results[result])
+                        for name in removed:
+                            self.stored_snapshots.pop(name, None)
+                            self.stored_generations.pop(name, None)
+                        self.logger.debug('Stored {0} changed and {1} removed endpoints'.format(
+                            len(dirty_endpoints), len(removed)))
+                    self.stored_snapshots.update(snapshots)
+                    if refresh_all:
+                        self.metadata_refreshed = now
                 except Exception as e:  # pragma: no cover
+                    # try them again on the next store
+                    for name in changed:
+                        self.endpoints.mark_changed(name)
                     self.logger.error(
                         'Unable to store endpoints in Redis because {0}'.format(str(e)))
 
@@ -723,6 +973,7 @@ class Monitor:
         self.logger = logger
         self.rabbit_channel_connection_local = None
         self.rabbit_channel_connection_local_fa = None
+        self.rabbit_consumers = []
 
         # get config options
         self.controller = Config().get_config()
@@ -730,8 +981,15 @@ class Monitor:
         # timer class to call things periodically in own thread
         self.schedule = schedule
 
+        # bound endpoint histories once for the process, before any are loaded
+        Endpoint.set_ring_sizes(
+            self.controller.get('endpoint_history_size', 100),
+            self.controller.get('endpoint_prev_states_size', 100),
+            self.controller.get('endpoint_acl_data_size', 100))
+
         # setup prometheus
-        self.prom = Prometheus()
+        self.prom = Prometheus(
+            max_host_series=self.controller.get('prometheus_max_host_series', 10000))
         try:
             self.prom.initialize_metrics()
         except Exception as e:  # pragma: no cover
@@ -741,6 +999,8 @@ class Monitor:
 
         # initialize sdnconnect
         self.s = SDNConnect(self.controller)
+        self.watched_endpoints = None
+        self.update_endpoint_metrics()
 
         # schedule periodic scan of endpoints thread
         self.schedule.every(self.controller['scan_frequency']).seconds.do(
@@ -757,6 +1017,31 @@ class Monitor:
                 schedule=self.schedule),
             name='st_worker')
 
+    def endpoint_changed(self, name, endpoint):
+        try:
+            host = None
+            if endpoint is not None:
+                host = Prometheus.endpoint_host(endpoint)
+            self.prom.update_hosts({name: host})
+        except Exception as e:  # pragma: no cover
+            self.logger.error(
+                'Unable to send {0} changes to Prometheus because: {1}'.format(name, str(e)))
+
+    def update_endpoint_metrics(self):
+        '''
+        send Prometheus the endpoint counts from the endpoints in memory.
+
+        state transitions and other changes to indexed fields are counted
+        as they happen; this picks up everything else, such as ports,
+        activity and ML results, and only sends the counts that changed.
+        '''
+        endpoints = self.s.endpoints
+        if self.watched_endpoints is not endpoints:
+            endpoints.listeners.append(self.endpoint_changed)
+            self.watched_endpoints = endpoints
+        self.prom.set_hosts({name: Prometheus.endpoint_host(endpoint)
+                             for name, endpoint in list(endpoints.items())})
+
     def update_routing_key_time(self, routing_key):
         self.prom.prom_metrics['last_rabbitmq_routing_key_time'].labels(
             routing_key=routing_key).set(time.time())
@@ -842,19 +1127,18 @@ class Monitor:
 
         def handler_action_remove_ignored(_my_obj):
             remove_list = [
-                endpoint.name for endpoint in self.s.endpoints.values()
-                if endpoint.ignore]
+                endpoint.name for endpoint in self.s.endpoints.lookup('ignore', True)]
             return ({}, remove_list)
 
         def handler_action_remove_inactives(_my_obj):
             remove_list = [
-                endpoint.name for endpoint in self.s.endpoints.values()
-                if endpoint.state == 'inactive']
+                endpoint.name for endpoint in self.s.endpoints.lookup('state', 'inactive')]
             return ({}, remove_list)
 
         def handler_faucet_event(my_obj):
             self.logger.debug('FAUCET Event:{0}'.format(my_obj))
-            self.faucet_event.append(my_obj)
+            with FAUCET_EVENT_LOCK:
+                self.faucet_event.append(my_obj)
             return (my_obj, None)
 
         handlers = {
@@ -885,52 +1169,46 @@ class Monitor:
         return ({}, False)
 
     def schedule_mirroring(self):
-        queued_endpoints = [
-            endpoint for endpoint in self.s.endpoints.values()
-            if not endpoint.ignore and endpoint.state == 'queued' and endpoint.p_next_state != 'inactive']
-        self.s.investigations = len([
-            endpoint for endpoint in self.s.endpoints.values()
-            if endpoint.state in ['mirroring', 'reinvestigating']])
-        # mirror things in the order they got added to the queue
-        queued_endpoints = sorted(
-            queued_endpoints, key=lambda x: x.p_prev_states[-1][1])
+        endpoints = self.s.endpoints
+        scheduler = self.s.scheduler
+        self.s.investigations = scheduler.in_flight
 
         investigation_budget = max(
             self.controller['max_concurrent_reinvestigations'] -
             self.s.investigations,
             0)
         self.logger.debug('investigations {0}, budget {1}, queued {2}'.format(
-            str(self.s.investigations), str(investigation_budget), str(len(queued_endpoints))))
-
-        for endpoint in queued_endpoints[:investigation_budget]:
-            endpoint.trigger(endpoint.p_next_state)
-            endpoint.p_next_state = None
-            endpoint.p_prev_states.append(
-                (endpoint.state, int(time.time())))
-            self.s.mirror_endpoint(endpoint)
-
-        for endpoint in self.s.endpoints.values():
-            if not endpoint.ignore:
-                if self.s.sdnc:
-                    if endpoint.state == 'unknown':
+            str(self.s.investigations), str(investigation_budget), str(scheduler.queued)))
+
+        with self.s.config_transaction():
+            # mirror things in the order they got added to the queue
+            for endpoint in scheduler.take_queued(investigation_budget):
+                endpoint.trigger(endpoint.p_next_state)
+                endpoint.p_next_state = None
+                endpoint.p_prev_states.append(
+                    (endpoint.state, int(time.time())))
+                self.s.mirror_endpoint(endpoint)
+
+            if self.s.sdnc:
+                for endpoint in endpoints.lookup('state', 'unknown'):
+                    if not endpoint.ignore:
                         endpoint.p_next_state = 'mirror'
                         endpoint.queue()
                         endpoint.p_prev_states.append(
                             (endpoint.state, int(time.time())))
-                    elif endpoint.state in ['mirroring', 'reinvestigating']:
-                        cur_time = int(time.time())
-                        # timeout after 2 times the reinvestigation frequency
-                        # in case something didn't report back, put back in an
-                        # unknown state
-                        if cur_time - endpoint.p_prev_states[-1][1] > 2*self.controller['reinvestigation_frequency']:
-                            self.logger.debug(
-                                'timing out: {0} and setting to unknown'.format(endpoint.name))
-                            self.s.unmirror_endpoint(endpoint)
-                            endpoint.unknown()
-                            endpoint.p_prev_states.append(
-                                (endpoint.state, int(time.time())))
-                else:
-                    if endpoint.state != 'known':
+                # timeout after 2 times the reinvestigation frequency
+                # in case something didn't report back, put back in an
+                # unknown state
+                for endpoint in scheduler.expired(int(time.time())):
+                    self.logger.debug(
+                        'timing out: {0} and setting to unknown'.format(endpoint.name))
+                    self.s.unmirror_endpoint(endpoint)
+                    endpoint.unknown()
+                    endpoint.p_prev_states.append(
+                        (endpoint.state, int(time.time())))
+            else:
+                for endpoint in list(endpoints.values()):
+                    if not endpoint.ignore and endpoint.state != 'known':
                         endpoint.known()
 
     def schedule_coprocessing(self):
@@ -986,42 +1264,99 @@ class Monitor:
     def process(self):
         global CTRL_C
         signal.signal(signal.SIGINT, partial(self.signal_handler))
+        last_mirroring = 0
         while not CTRL_C['STOP']:
-            time.sleep(1)
+            items = self.get_q_items()
+            if items:
+                self.process_batch(items)
+
+            now = time.time()
+            if now - last_mirroring >= self.controller['mirroring_frequency']:
+                self.schedule_mirroring()
+                last_mirroring = now
 
-            found_work, item = self.get_q_item()
+        self.s.store_endpoints()
 
-            if found_work:
+    def process_batch(self, items):
+        '''
+        handle a batch of work items, then ack the ones handled and requeue
+        the ones that failed.
+        '''
+        start = time.time()
+        handled = []
+        failed = []
+        for item in items:
+            try:
                 self.format_rabbit_message(item)
+                handled.append(item)
+            except Exception as e:  # pragma: no cover
+                self.logger.error(
+                    'Unable to handle {0} message because {1}'.format(item[0], str(e)))
+                failed.append(item)
+        self.settle_items(handled, failed)
+        self.update_queue_metrics(time.time() - start)
+        self.update_routing_key_metrics(items)
 
-            self.schedule_mirroring()
+    @staticmethod
+    def settle_items(handled, failed):
+        ''' ack or requeue the items that came from a rabbitmq consumer '''
+        consumers = {}
+        for items, index in ((handled, 0), (failed, 1)):
+            for item in items:
+                consumer = getattr(item, 'consumer', None)
+                if consumer is not None:
+                    consumers.setdefault(consumer, ([], []))[index].append(item)
+        for consumer, (acks, nacks) in consumers.items():
+            consumer.settle(acks, nacks)
+
+    def update_routing_key_metrics(self, items):
+        try:
+            now = time.time()
+            for item in items:
+                self.prom.prom_metrics['rabbitmq_messages'].labels(
+                    routing_key=item[0]).inc()
+                received = getattr(item, 'received', None)
+                if received is not None:
+                    self.prom.prom_metrics['rabbitmq_lag'].labels(
+                        routing_key=item[0]).observe(now - received)
+        except Exception as e:  # pragma: no cover
+            self.logger.debug(
+                'Unable to update routing key metrics because {0}'.format(str(e)))
 
-        self.s.store_endpoints()
+    def update_queue_metrics(self, batch_time):
+        try:
+            self.prom.prom_metrics['queue_depth'].set(self.m_queue.qsize())
+            self.prom.prom_metrics['queue_batch_latency'].observe(batch_time)
+        except Exception as e:  # pragma: no cover
+            self.logger.debug(
+                'Unable to update queue metrics because {0}'.format(str(e)))
 
-    def get_q_item(self):
+    def get_q_items(self):
         '''
-        attempt to get a work item from the queue
+        wait up to queue_timeout seconds for a work item, then drain
+        whatever else is waiting, up to queue_batch_size items in all.
         m_queue -> (routing_key, body)
-        a read from get_q_item should be of the form
-        (boolean,(routing_key, body))
         '''
-        found_work = False
-        item = None
+        items = []
         global CTRL_C
 
         if not CTRL_C['STOP']:
             try:
-                item = self.m_queue.get(False)
-                found_work = True
+                items.append(self.m_queue.get(
+                    timeout=self.controller['queue_timeout']))
                 self.m_queue.task_done()
-            except queue.Empty:  # pragma: no cover
+                while len(items) < self.controller['queue_batch_size']:
+                    items.append(self.m_queue.get_nowait())
+                    self.m_queue.task_done()
+            except queue.Empty:
                 pass
 
-        return (found_work, item)
+        return items
 
     def shutdown(self):
         ''' gracefully shut down. '''
         self.s.clear_filters()
+        self.s.rdns.shutdown()
         for job in self.schedule.jobs:
             self.logger.debug('shutdown :{0}'.format(job))
             self.schedule.cancel_job(job)
@@ -1029,6 +1364,8 @@ class Monitor:
             self.rabbit_channel_connection_local.close()
         if self.rabbit_channel_connection_local_fa:
             self.rabbit_channel_connection_local_fa.close()
+        for consumer in self.rabbit_consumers:
+            consumer.stop()
         self.logger.debug('SHUTTING DOWN')
         self.logger.debug('EXITING')
         sys.exit()
@@ -1048,39 +1385,28 @@ class Monitor:
 def main(skip_rabbit=False):  # pragma: no cover
     # setup rabbit and monitoring of the network
     pmain = Monitor(skip_rabbit=skip_rabbit)
+    consumers = []
     if not skip_rabbit:
-        rabbit = Rabbit()
-        host = pmain.controller['rabbit_server']
-        port = int(pmain.controller['rabbit_port'])
-        exchange = 'topic-poseidon-internal'
-        queue_name = 'poseidon_main'
-        binding_key = ['poseidon.algos.#', 'poseidon.action.#']
-        retval = rabbit.make_rabbit_connection(
-            host, port, exchange, queue_name, binding_key)
-        pmain.rabbit_channel_local = retval[0]
-        pmain.rabbit_channel_connection_local = retval[1]
-        pmain.rabbit_thread = rabbit.start_channel(
-            pmain.rabbit_channel_local,
-            rabbit_callback,
-            queue_name,
-            pmain.m_queue)
+        consumers.append((
+            pmain.controller['rabbit_server'],
+            int(pmain.controller['rabbit_port']),
+            'topic-poseidon-internal',
+            ['poseidon.algos.#', 'poseidon.action.#']))
 
     if pmain.controller['FA_RABBIT_ENABLED']:
-        rabbit = Rabbit()
-        host = pmain.controller['FA_RABBIT_HOST']
-        port = pmain.controller['FA_RABBIT_PORT']
-        exchange = pmain.controller['FA_RABBIT_EXCHANGE']
-        queue_name = 'poseidon_main'
-        binding_key = [pmain.controller['FA_RABBIT_ROUTING_KEY']+'.#']
-        retval = rabbit.make_rabbit_connection(
-            host, port, exchange, queue_name, binding_key)
-        pmain.rabbit_channel_local = retval[0]
-        pmain.rabbit_channel_connection_local_fa = retval[1]
-        pmain.rabbit_thread = rabbit.start_channel(
-            pmain.rabbit_channel_local,
-            rabbit_callback,
-            queue_name,
-            pmain.m_queue)
+        consumers.append((
+            pmain.controller['FA_RABBIT_HOST'],
+            pmain.controller['FA_RABBIT_PORT'],
+            pmain.controller['FA_RABBIT_EXCHANGE'],
+            [pmain.controller['FA_RABBIT_ROUTING_KEY']+'.#']))
+
+    for host, port, exchange, binding_key in consumers:
+        consumer = RabbitConsumer(
+            host, port, exchange, 'poseidon_main', binding_key, pmain.m_queue,
+            prefetch=pmain.controller['rabbit_prefetch'],
+            max_backoff=pmain.controller['rabbit_max_backoff'])
+        pmain.rabbit_consumers.append(consumer)
+        pmain.rabbit_thread = consumer.start()
 
     pmain.schedule_thread.start()
 
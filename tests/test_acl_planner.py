@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for the faucet ACL planner.
+"""
+from poseidon.controllers.faucet.acl_planner import AclPlanner
+from poseidon.controllers.faucet.rules import RuleEngine
+from poseidon.helpers.endpoint import endpoint_factory
+
+RULES = {'rules': {
+    'windows': [{'rule': {'device_key': 'os', 'value': 'Windows', 'acls': ['block-windows']}}],
+    'mac': [{'rule': {'device_key': 'os', 'value': 'Mac', 'acls': ['block-mac']}}]}}
+
+
+def make_endpoint(name, port, os_name):
+    endpoint = endpoint_factory(name)
+    endpoint.endpoint_data = {'mac': name, 'segment': 'sw1', 'port': str(port)}
+    endpoint.metadata = {'ipv4_addresses': {'10.0.0.1': {'os': os_name}}}
+    return endpoint
+
+
+def make_doc():
+    return {'dps': {'sw1': {'interfaces': {
+        1: {'acls_in': ['local']}, 2: {}, 3: {'acls_in': ['block-mac']}}}}}
+
+
+def test_plan():
+    planner = AclPlanner()
+    engine = RuleEngine(RULES)
+    win = make_endpoint('win', 1, 'Windows')
+    mac = make_endpoint('mac', 2, 'Mac')
+    other = make_endpoint('other', 3, 'Linux')
+    gone = make_endpoint('gone', 1, 'Windows')
+    gone.endpoint_data['segment'] = 'sw9'
+    endpoints = [win, mac, other, gone]
+    obj_doc = make_doc()
+
+    plan = planner.plan(obj_doc, RULES, engine, endpoints)
+    assert obj_doc == make_doc()
+    assert plan.recomputed == 3
+    assert plan.skipped == 0
+    changes = {change['port']: change for change in plan.changes}
+    assert changes[1]['desired'] == ['local', 'block-windows']
+    assert changes[2]['added'] == ['block-mac']
+    assert changes[3]['removed'] == ['block-mac']
+    assert ['added acls', 'win', 'sw1', '1', ['block-windows'], 'windows'] in plan.status
+    assert ['removed acls', 'other', 'sw1', '3', ['block-mac'], None] in plan.status
+
+    assert planner.apply(obj_doc, plan)
+    assert obj_doc['dps']['sw1']['interfaces'][3]['acls_in'] == []
+    # nothing is remembered until the plan is committed
+    assert planner.take_counts() == (0, 0)
+    assert planner.locations == {}
+    planner.commit(plan)
+    assert planner.take_counts() == (3, 0)
+    assert planner.take_counts() == (0, 0)
+
+    # nothing changed, nothing recomputed
+    plan = planner.plan(obj_doc, RULES, engine, endpoints, changed=[])
+    assert plan.changes == []
+    assert (plan.recomputed, plan.skipped) == (0, 3)
+
+    # a moved endpoint recomputes its old and new port only
+    win.endpoint_data['port'] = '3'
+    plan = planner.plan(obj_doc, RULES, engine, endpoints, changed=[win])
+    assert (plan.recomputed, plan.skipped) == (2, 1)
+    changes = {change['port']: change for change in plan.changes}
+    assert changes[1]['desired'] == ['local']
+    assert changes[3]['desired'] == ['block-windows']
+
+    # so does one that now matches different rules
+    planner.apply(obj_doc, plan)
+    planner.commit(plan)
+    mac.metadata['ipv4_addresses']['10.0.0.1']['os'] = 'Linux'
+    plan = planner.plan(obj_doc, RULES, engine, endpoints, changed=[])
+    assert plan.recomputed == 1
+    assert plan.changes[0]['removed'] == ['block-mac']
+
+
+def test_force_rules():
+    planner = AclPlanner()
+    engine = RuleEngine(RULES)
+    other = make_endpoint('other', 2, 'Linux')
+    obj_doc = make_doc()
+    plan = planner.plan(obj_doc, RULES, engine, [other], force_apply_rules=['mac'])
+    assert plan.changes[0]['added'] == ['block-mac']
+    win = make_endpoint('win', 1, 'Windows')
+    plan = planner.plan(obj_doc, RULES, engine, [win], force_remove_rules=['block-windows'])
+    assert plan.changes == []
@@ -1,3 +1,5 @@
+import gzip
+import json
 import os
 
 import falcon
@@ -6,6 +8,9 @@ import redis
 from falcon import testing
 
 from api.app.app import api
+from api.app.data import build_node
+from api.app.data import parse_etags
+from api.app.data import SNAPSHOT
 
 
 @pytest.fixture
@@ -116,6 +121,117 @@ def test_network(client):
     assert response.status == falcon.HTTP_OK
 
 
+def test_network_etag(client):
+    response = client.simulate_get('/v1/network')
+    etag = response.headers['etag']
+    response = client.simulate_get(
+        '/v1/network', headers={'If-None-Match': etag})
+    assert response.status == falcon.HTTP_NOT_MODIFIED
+    assert not response.content
+    response = client.simulate_get(
+        '/v1/network', headers={'If-None-Match': '"stale"'})
+    assert response.status == falcon.HTTP_OK
+
+    # rebuilt without any change in Redis, the durations in the body may
+    # move on but the ETag stays
+    SNAPSHOT.built = 0
+    response = client.simulate_get(
+        '/v1/network', headers={'If-None-Match': etag})
+    assert response.status == falcon.HTTP_NOT_MODIFIED
+    r = redis.StrictRedis(host='redis', port=6379, db=0, decode_responses=True)
+    r.hset('10.0.0.1', 'short_os', 'Linux')
+    SNAPSHOT.built = 0
+    try:
+        response = client.simulate_get(
+            '/v1/network', headers={'If-None-Match': etag})
+        assert response.status == falcon.HTTP_OK
+        assert response.headers['etag'] != etag
+    finally:
+        r.hset('10.0.0.1', 'short_os', 'Mac')
+        SNAPSHOT.built = 0
+
+
+def test_network_query(client):
+    macs = [node['mac'] for node in client.simulate_get('/v1/network').json['dataset']]
+    response = client.simulate_get(
+        '/v1/network', query_string='fields=mac,state&limit=2')
+    assert response.status == falcon.HTTP_OK
+    assert len(response.json['dataset']) == 2
+    assert set(response.json['dataset'][0]) == {'mac', 'state'}
+    assert [field['path'] for field in response.json['configuration']['fields']] == [
+        ['mac'], ['state']]
+    paged = [node['mac'] for node in response.json['dataset']]
+    while response.json['next_cursor']:
+        response = client.simulate_get(
+            '/v1/network', query_string='fields=mac&limit=2&cursor=' + response.json['next_cursor'])
+        assert 0 < len(response.json['dataset']) <= 2
+        paged += [node['mac'] for node in response.json['dataset']]
+    assert paged == macs
+    response = client.simulate_get(
+        '/v1/network', query_string='subnet=10.0.0.0/24&os=Mac')
+    assert [node['mac'] for node in response.json['dataset']] == [
+        '00:00:00:00:00:01']
+    response = client.simulate_get(
+        '/v1/network', query_string='fields=foo')
+    assert response.status == falcon.HTTP_BAD_REQUEST
+    response = client.simulate_get('/v1/network', query_string='page=2')
+    assert response.status == falcon.HTTP_BAD_REQUEST
+
+
+def test_network_gzip(client):
+    response = client.simulate_get(
+        '/v1/network_full', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['content-encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.content)) == client.simulate_get(
+        '/v1/network_full').json
+
+
+def test_network_full_ndjson(client):
+    response = client.simulate_get(
+        '/v1/network_full', query_string='format=ndjson&fields=mac,state')
+    assert response.status == falcon.HTTP_OK
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    nodes = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(nodes, key=lambda node: node['mac']) == [
+        {'mac': node['mac'], 'state': node['state']}
+        for node in client.simulate_get('/v1/network_full').json['dataset']]
+    assert {'00:00:00:00:00:01', '00:00:00:00:00:02',
+            '00:00:00:00:00:03'} <= {node['mac'] for node in nodes}
+    response = client.simulate_get(
+        '/v1/network', query_string='format=ndjson&os=Linux')
+    assert '00:00:00:00:00:03' in [
+        json.loads(line)['mac'] for line in response.text.splitlines()]
+    response = client.simulate_get(
+        '/v1/network_full', query_string='format=xml')
+    assert response.status == falcon.HTTP_BAD_REQUEST
+
+
+def test_parse_etags():
+    assert parse_etags(None) == set()
+    assert parse_etags('"a", W/"b"') == {'a', 'b'}
+
+
+def test_build_node():
+    node = build_node('00:00:00:00:00:01',
+                      {'poseidon_hash': 'foo', 'timestamps': "['1']"},
+                      {'ignore': 'True',
+                       'prev_states': "[('unknown', 1), ('known', 2)]",
+                       'endpoint_data': "{'ipv4': '10.0.0.1', 'ipv6': 'None'}"},
+                      {'labels': "['printer']", 'confidences': '[0.5]',
+                       'foo': "{'decisions': {'behavior': 'abnormal'}}"},
+                      {'short_os': 'Linux'}, {})
+    assert node['id'] == 'foo'
+    assert node['ignored'] == 'True'
+    assert node['seen'] == (1, 2)
+    assert node['ipv4_subnet'] == '10.0.0.0/24'
+    assert node['ipv4_os'] == 'Linux'
+    assert 'ipv6_subnet' not in node
+    assert node['addresses'] == {'10.0.0.1', 'None'}
+    assert node['role'] == 'printer'
+    assert node['role_confidence'] == 50
+    assert node['behavior'] == 1
+
+
 def test_network_by_ip(client):
     response = client.simulate_get('/v1/network/10.0.0.1')
     assert len(response.json['dataset']) == 1
@@ -3,6 +3,8 @@
 Created on 18 Jan 2019
 @author: Charlie Lewis
 """
+import pytest
+
 from poseidon.cli.commands import Commands
 from poseidon.helpers.endpoint import Endpoint
 from poseidon.helpers.endpoint import endpoint_factory
@@ -15,6 +17,7 @@ def test_commands():
         'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1'}
     commands.sdnc.endpoints = {}
     commands.sdnc.endpoints[endpoint.name] = endpoint
+    commands.sdnc.publish_action = lambda action, message: True
 
     commands.what_is('foo')
     commands.history_of('foo')
@@ -36,3 +39,15 @@ def test_commands():
         'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1'}
     commands.sdnc.endpoints[endpoint2.name] = endpoint2
     commands.what_is('00:00:00:00:00:00')
+
+
+def test_publish_action_failure():
+    commands = Commands()
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1'}
+    commands.sdnc.endpoints = {}
+    commands.sdnc.endpoints[endpoint.name] = endpoint
+    commands.sdnc.publish_action = lambda action, message: False
+    with pytest.raises(RuntimeError):
+        commands.remove('foo')
@@ -3,6 +3,8 @@
 Test module for faucet connection.
 @author: Charlie Lewis
 """
+import os
+
 from poseidon.controllers.faucet.connection import Connection
 
 
@@ -24,3 +26,84 @@ def test_Connection():
     conn.receive_file('log')
     conn.send_file('config')
     conn.send_file('log')
+
+
+def test_receive_log(tmpdir):
+    class MockSFTP:
+
+        def stat(self, path):
+            return os.stat(path)
+
+        def open(self, path, mode):
+            return open(path, mode)
+
+        def close(self):
+            return
+
+    class MockSSH:
+
+        def open_sftp(self):
+            return MockSFTP()
+
+    remote_log = os.path.join(str(tmpdir), 'remote.log')
+    conn = Connection(host='foo', log_file=remote_log)
+    conn.ssh = MockSSH()
+    conn.log_dir = str(tmpdir)
+    local_log = os.path.join(conn.log_dir, 'faucet.log')
+
+    with open(remote_log, 'w') as f:
+        f.write('one\n')
+    conn._receive_log()
+    with open(remote_log, 'a') as f:
+        f.write('two\n')
+    conn._receive_log()
+    assert open(local_log).read() == 'one\ntwo\n'
+    assert conn.log_fetched == 8
+
+    # rotated to a file that is already bigger
+    with open(remote_log, 'w') as f:
+        f.write('three three\n')
+    conn._receive_log()
+    assert open(local_log).read() == 'three three\n'
+
+
+def test_ssh_reuse():
+    class MockTransport:
+
+        def __init__(self):
+            self.active = True
+
+        def is_active(self):
+            return self.active
+
+    class MockSSH:
+
+        def __init__(self):
+            self.transport = MockTransport()
+            self.closed = False
+
+        def get_transport(self):
+            return self.transport
+
+        def close(self):
+            self.closed = True
+
+    conn = Connection(host='foo')
+    ssh = MockSSH()
+    conn.ssh = ssh
+    conn._connect()
+    assert conn.ssh is ssh
+    assert conn.handshakes == 0
+
+    calls = []
+
+    def action():
+        calls.append(conn.ssh)
+        if len(calls) == 1:
+            raise EOFError('dropped')
+        return 'done'
+
+    conn._connect = lambda: None
+    assert conn._with_ssh(action) == 'done'
+    assert ssh.closed
+    assert len(calls) == 2
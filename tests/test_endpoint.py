@@ -8,6 +8,8 @@ import os
 from poseidon.helpers.endpoint import Endpoint
 from poseidon.helpers.endpoint import endpoint_factory
 from poseidon.helpers.endpoint import EndpointDecoder
+from poseidon.helpers.endpoint import EndpointRegistry
+from poseidon.helpers.endpoint import TransitionError
 
 
 def test_Endpoint():
@@ -19,3 +21,81 @@ def test_Endpoint():
     c = EndpointDecoder(b).get_endpoint()
     a = {'tenant': 'foo', 'mac': '00:00:00:00:00:00'}
     hashed_val = Endpoint.make_hash(a)
+
+
+def test_pack():
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1'}
+    endpoint.queue()
+    endpoint.p_prev_states.append((endpoint.state, 1))
+    c = EndpointDecoder(endpoint.pack()).get_endpoint()
+    assert c.state == 'queued'
+    assert c.endpoint_data == endpoint.endpoint_data
+    assert c.pack() == endpoint.pack()
+
+
+def test_triggers():
+    endpoint = endpoint_factory('foo')
+    assert endpoint.state == 'unknown'
+    assert endpoint.copro_state == 'unknown'
+    endpoint.mirror()
+    assert endpoint.state == 'mirroring'
+    endpoint.trigger('known')
+    assert endpoint.state == 'known'
+    assert endpoint.history[-1]['message'] == 'State changed from mirroring to known'
+    endpoint.trigger('coprocess')
+    assert endpoint.copro_state == 'coprocessing'
+    assert endpoint.state == 'known'
+    try:
+        endpoint.trigger('inactive')
+        endpoint.trigger('mirror')
+        assert False
+    except TransitionError:
+        pass
+
+
+def test_endpoint_registry():
+    registry = EndpointRegistry()
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {'mac': '00:00:00:00:00:01', 'ipv4': '10.0.0.1', 'ipv6': '::1'}
+    registry[endpoint.name] = endpoint
+    other = endpoint_factory('bar')
+    registry.update({other.name: other})
+    assert registry.lookup('mac', '00:00:00:00:00:01') == [endpoint]
+    assert registry.by_ip('::1') == [endpoint]
+    assert registry.count('state', 'unknown') == 2
+
+    # transitions and new endpoint_data move the endpoint between buckets
+    endpoint.mirror()
+    assert registry.lookup('state', 'mirroring') == [endpoint]
+    assert registry.lookup('state', 'unknown') == [other]
+    endpoint.endpoint_data = {'mac': '00:00:00:00:00:02', 'ipv4': '10.0.0.2'}
+    assert registry.by_ip('10.0.0.1') == []
+    assert registry.by_ip('10.0.0.2') == [endpoint]
+    other.ignore = True
+    assert registry.lookup('ignore', True) == [other]
+
+    # in place changes need a reindex
+    endpoint.endpoint_data['ipv4'] = '10.0.0.3'
+    registry.reindex(endpoint)
+    assert registry.by_ip('10.0.0.3') == [endpoint]
+
+    del registry[endpoint.name]
+    assert registry.lookup('state', 'mirroring') == []
+    endpoint.unknown()
+    assert registry.count('state', 'unknown') == 1
+    assert registry.pop(other.name) is other
+    assert registry.indexed == {}
+    assert all(not values for values in registry.indexes.values())
+
+
+def test_endpoint_registry_removed_while_read():
+    registry = EndpointRegistry()
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {'mac': '00:00:00:00:00:01', 'ipv4': '10.0.0.1'}
+    registry[endpoint.name] = endpoint
+    # the scan thread has removed the endpoint but not yet its index entries
+    dict.__delitem__(registry, endpoint.name)
+    assert registry.lookup('state', 'unknown') == []
+    assert registry.by_ip('10.0.0.1') == []
@@ -4,9 +4,11 @@ Test module for faucet.
 @author: Charlie Lewis
 """
 import os
+import threading
 
 from poseidon.controllers.faucet.faucet import FaucetProxy
 from poseidon.helpers.config import Config
+from poseidon.helpers.endpoint import endpoint_factory
 
 
 def test_get_endpoints():
@@ -104,3 +106,143 @@ def test_format_endpoints():
     data = [[{'ip-state': 'foo'}, {'ip-state': 'bar'}],
             [{'ip-state': 'foo', 'ip-address': '0.0.0.0'}, {'ip-state': 'bar', 'ip-address': '::1'}]]
     output = FaucetProxy.format_endpoints(data, 'foo')
+
+
+def test_config_transaction():
+    class MockFaucetProxy(FaucetProxy):
+
+        def __init__(self, controller):
+            super(MockFaucetProxy, self).__init__(controller)
+            self.loads = 0
+            self.writes = 0
+
+        def yaml_in(self, config_file):
+            self.loads += 1
+            return {'dps': {'switch1': {'interfaces': {1: {}, 2: {}, 3: {}}}}}
+
+        def yaml_out(self, config_file, obj_doc):
+            self.writes += 1
+            self.written = obj_doc
+            return True
+
+    controller = Config().get_config()
+    controller['MIRROR_PORTS'] = {'switch1': 3}
+    proxy = MockFaucetProxy(controller)
+    proxy.mac_table.learn('00:00:00:00:00:01', {'segment': 'switch1', 'port': '1'})
+    proxy.mac_table.learn('00:00:00:00:00:02', {'segment': 'switch1', 'port': '2'})
+    with proxy.config_transaction():
+        pass
+    assert proxy.loads == 0
+    with proxy.config_transaction():
+        assert proxy.mirror_mac('00:00:00:00:00:01', None, None)
+        with proxy.config_transaction():
+            assert proxy.mirror_mac('00:00:00:00:00:02', None, None)
+        assert proxy.writes == 0
+    assert proxy.loads == 1
+    assert proxy.writes == 1
+    assert proxy.written['dps']['switch1']['interfaces'][3]['mirror'] == [1, 2]
+
+
+def test_config_transaction_threads():
+    class MockFaucetProxy(FaucetProxy):
+
+        def __init__(self, controller):
+            super(MockFaucetProxy, self).__init__(controller)
+            self.written = []
+
+        def yaml_in(self, config_file):
+            return {'dps': {'switch1': {'interfaces': {1: {}, 2: {}, 3: {}}}}}
+
+        def yaml_out(self, config_file, obj_doc):
+            self.written.append(obj_doc['dps']['switch1']['interfaces'][3].get('mirror', []))
+            return True
+
+    controller = Config().get_config()
+    controller['MIRROR_PORTS'] = {'switch1': 3}
+    proxy = MockFaucetProxy(controller)
+    proxy.mac_table.learn('00:00:00:00:00:01', {'segment': 'switch1', 'port': '1'})
+    proxy.mac_table.learn('00:00:00:00:00:02', {'segment': 'switch1', 'port': '2'})
+    def mirror_other():
+        with proxy.config_transaction():
+            proxy.mirror_mac('00:00:00:00:00:02', None, None)
+
+    other = threading.Thread(target=mirror_other)
+    with proxy.config_transaction():
+        assert proxy.mirror_mac('00:00:00:00:00:01', None, None)
+        # another thread's transaction does not join this one
+        other.start()
+        other.join(0.1)
+        assert other.is_alive()
+    other.join()
+    assert proxy.written == [[1], [2]]
+
+
+def test_config_transaction_discarded(tmpdir):
+    class MockFaucetProxy(FaucetProxy):
+
+        def __init__(self, controller):
+            super(MockFaucetProxy, self).__init__(controller)
+            self.written = []
+
+        def yaml_in(self, config_file):
+            return {'dps': {'switch1': {'interfaces': {1: {}}}}}
+
+        def yaml_out(self, config_file, obj_doc):
+            self.written.append(os.path.basename(config_file))
+            return True
+
+    tmpdir.join('acls.yaml').write('acls:\n  block-windows: []\n')
+    rules_file = str(tmpdir.join('rules.yaml'))
+    tmpdir.join('rules.yaml').write(
+        'include:\n  - acls.yaml\n'
+        'rules:\n  windows:\n    - rule:\n        device_key: os\n'
+        '        value: Windows\n        acls: [block-windows]\n')
+    controller = Config().get_config()
+    controller['URI'] = ''
+    controller['CONFIG_FILE'] = str(tmpdir.join('faucet.yaml'))
+    proxy = MockFaucetProxy(controller)
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {'mac': '00:00:00:00:00:01', 'segment': 'switch1', 'port': '1'}
+    endpoint.metadata = {'ipv4_addresses': {'10.0.0.1': {'os': 'Windows'}}}
+
+    # a failed transaction writes nothing, ACL include files included,
+    # and the planner does not remember its plan
+    try:
+        with proxy.config_transaction():
+            proxy.update_acls(rules_file=rules_file, endpoints=[endpoint])
+            raise ValueError('failed')
+    except ValueError:
+        pass
+    assert proxy.written == []
+    assert proxy.acl_planner.locations == {}
+
+    with proxy.config_transaction():
+        proxy.update_acls(rules_file=rules_file, endpoints=[endpoint])
+    assert sorted(proxy.written) == ['faucet.yaml', 'poseidon_acls.yaml']
+    assert proxy.acl_planner.locations == {'foo': ('switch1', 1)}
+
+
+def test_dry_run_acls():
+    class MockFaucetProxy(FaucetProxy):
+
+        def yaml_in(self, config_file):
+            return {'dps': {'switch1': {'interfaces': {1: {}}}}}
+
+        def yaml_out(self, config_file, obj_doc):
+            raise AssertionError('a dry run must not write')
+
+        def parse_rules(self, config_file):
+            return {'rules': {'windows': [{'rule': {'device_key': 'os', 'value': 'Windows',
+                                                    'acls': ['block-windows']}}]}}
+
+    controller = Config().get_config()
+    controller['URI'] = ''
+    proxy = MockFaucetProxy(controller)
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {'mac': '00:00:00:00:00:01', 'segment': 'switch1', 'port': '1'}
+    endpoint.metadata = {'ipv4_addresses': {'10.0.0.1': {'os': 'Windows'}}}
+    changes = proxy.dry_run_acls(endpoints=[endpoint], changed_endpoints=[endpoint])
+    assert changes == [{'switch': 'switch1', 'port': 1, 'current': [], 'desired': ['block-windows'],
+                        'added': ['block-windows'], 'removed': []}]
+    assert proxy.acl_planner.take_counts() == (0, 0)
+    assert proxy.dry_run_acls(endpoints=[]) == []
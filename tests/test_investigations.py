@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for the investigation scheduler.
+"""
+from poseidon.helpers.endpoint import endpoint_factory
+from poseidon.helpers.endpoint import EndpointRegistry
+from poseidon.helpers.investigations import InvestigationScheduler
+
+
+def make_queued(name, queued_at):
+    endpoint = endpoint_factory(name)
+    endpoint.p_next_state = 'mirror'
+    endpoint.queue()
+    endpoint.p_prev_states.append((endpoint.state, queued_at))
+    return endpoint
+
+
+def test_take_queued():
+    registry = EndpointRegistry()
+    later = make_queued('later', 200)
+    registry[later.name] = later
+    scheduler = InvestigationScheduler(registry, 10)
+    sooner = make_queued('sooner', 100)
+    registry[sooner.name] = sooner
+    ignored = make_queued('ignored', 50)
+    ignored.ignore = True
+    registry[ignored.name] = ignored
+    assert scheduler.queued == 3
+
+    assert scheduler.take_queued(1) == [sooner]
+    # not acted on, so offered again
+    assert scheduler.take_queued(1) == [sooner]
+    sooner.mirror()
+    assert scheduler.take_queued(5) == [later]
+    assert scheduler.in_flight == 1
+
+    ignored.ignore = False
+    later.unknown()
+    assert scheduler.take_queued(5) == [ignored]
+
+
+def test_expired():
+    registry = EndpointRegistry()
+    scheduler = InvestigationScheduler(registry, 10)
+    endpoint = endpoint_factory('foo')
+    registry[endpoint.name] = endpoint
+    endpoint.mirror()
+    endpoint.p_prev_states.append((endpoint.state, 100))
+    # entered mirroring before its start time was recorded, so it counts from now
+    assert scheduler.expired(105) == []
+    scheduler = InvestigationScheduler(registry, 10)
+    assert scheduler.expired(105) == []
+    assert scheduler.expired(111) == [endpoint]
+    endpoint.unknown()
+    assert scheduler.expired(1000) == []
+    del registry[endpoint.name]
+    assert scheduler.seqs == {}
+
+
+def test_rebind():
+    registry = EndpointRegistry()
+    scheduler = InvestigationScheduler(registry, 10)
+    queued = make_queued('queued', 100)
+    registry[queued.name] = queued
+    endpoint = endpoint_factory('foo')
+    registry[endpoint.name] = endpoint
+    endpoint.mirror()
+    deadlines = list(scheduler.deadlines)
+
+    # the same endpoints loaded into a new registry keep their deadlines
+    loaded = make_queued('queued', 300)
+    mirrored = endpoint_factory('foo')
+    mirrored.mirror()
+    mirrored.p_prev_states.append((mirrored.state, 0))
+    new = EndpointRegistry({queued.name: loaded, mirrored.name: mirrored})
+    scheduler.rebind(new)
+    assert scheduler.changed not in registry.listeners
+    assert scheduler.deadlines == deadlines
+    assert scheduler.take_queued(5) == [loaded]
+
+    # endpoints missing from the new registry are dropped
+    scheduler.rebind(EndpointRegistry({queued.name: loaded}))
+    assert endpoint.name not in scheduler.seqs
+    assert scheduler.expired(10**10) == []
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for the faucet log tail.
+"""
+import os
+
+from poseidon.controllers.faucet.log_tail import LogTail
+
+
+def test_read_lines(tmpdir):
+    path = os.path.join(str(tmpdir), 'faucet.log')
+    tail = LogTail(path)
+    assert tail.read_lines() == []
+    with open(path, 'w') as f:
+        f.write('one\ntwo\nthr')
+    assert tail.read_lines() == ['one', 'two']
+    assert tail.read_lines() == []
+    with open(path, 'a') as f:
+        f.write('ee\n')
+    assert tail.read_lines() == ['three']
+
+    # truncated
+    with open(path, 'w') as f:
+        f.write('four\n')
+    assert tail.read_lines() == ['four']
+
+    # rotated, the rest of the old file comes first
+    with open(path, 'a') as f:
+        f.write('five')
+    os.rename(path, path + '.1')
+    with open(path, 'w') as f:
+        f.write('six\n')
+    assert tail.read_lines() == ['five', 'six']
+    tail.close()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for the faucet learned host table.
+"""
+from poseidon.controllers.faucet.mac_table import MacTable
+
+
+def record(port, segment='switch1', tenant='VLAN100'):
+    return {'mac': '00:00:00:00:00:01', 'segment': segment, 'port': port,
+            'tenant': tenant, 'active': 1}
+
+
+def test_learn():
+    table = MacTable(max_history=2)
+    table.learn('00:00:00:00:00:01', record('1'))
+    table.learn('00:00:00:00:00:01', record('2'))
+    table.learn('00:00:00:00:00:01', record('1'))
+    assert table['00:00:00:00:00:01'] == [record('1'), record('2')]
+    table.learn('00:00:00:00:00:01', record('3', tenant='VLAN200'))
+    assert table['00:00:00:00:00:01'] == [record('3', tenant='VLAN200'), record('1')]
+    assert table.location('00:00:00:00:00:01') == ('switch1', '3')
+    assert table.location('00:00:00:00:00:02') == (None, None)
+    assert table.macs_on_port('switch1', '1') == set()
+    assert table.macs_on_port('switch1', '3') == {'00:00:00:00:00:01'}
+    assert table.macs_in_vlan('VLAN100') == set()
+    assert table.macs_in_vlan('VLAN200') == {'00:00:00:00:00:01'}
+
+
+def test_expire_and_port_down():
+    table = MacTable()
+    table.learn('00:00:00:00:00:01', record('1'))
+    table.learn('00:00:00:00:00:02', record('2'))
+    table.expire('00:00:00:00:00:01')
+    table.expire('00:00:00:00:00:03')
+    assert table['00:00:00:00:00:01'][0]['active'] == 0
+    table.port_down('switch1', '2')
+    assert table['00:00:00:00:00:02'][0]['active'] == 0
+
+
+def test_history():
+    table = MacTable()
+    table.learn('00:00:00:00:00:01', record('1'))
+    history = table.history('00:00:00:00:00:01')
+    history[0]['port'] = '5'
+    history.reverse()
+    assert table['00:00:00:00:00:01'] == [record('1')]
+    assert table.history('00:00:00:00:00:02') == []
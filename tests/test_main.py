@@ -8,6 +8,8 @@ Created on 28 June 2016
 import json
 import logging
 import os
+import queue
+import threading
 import time
 
 import redis
@@ -15,10 +17,13 @@ from prometheus_client import Gauge
 
 from poseidon.constants import NO_DATA
 from poseidon.helpers.config import Config
+from poseidon.helpers.endpoint import Endpoint
 from poseidon.helpers.endpoint import endpoint_factory
+from poseidon.helpers.prometheus import Prometheus
+from poseidon.helpers.rabbit import Delivery
 from poseidon.main import CTRL_C
+from poseidon.main import FAUCET_EVENT_LOCK
 from poseidon.main import Monitor
-from poseidon.main import rabbit_callback
 from poseidon.main import schedule_job_kickurl
 from poseidon.main import schedule_job_reinvestigation
 from poseidon.main import schedule_thread_worker
@@ -168,15 +173,7 @@ def test_signal_handler():
     assert True == mock_monitor.rabbit_channel_connection_local.connection_closed
 
 
-def test_get_q_item():
-    class MockMQueue:
-
-        def get(self, block):
-            return 'Item'
-
-        def task_done(self):
-            return
-
+def test_get_q_items():
     CTRL_C['STOP'] = False
 
     class MockMonitor(Monitor):
@@ -184,15 +181,36 @@ def test_get_q_item():
         def __init__(self):
             self.logger = logger
             self.controller = Config().get_config()
-            self.s = SDNConnect(self.controller)
+            self.controller['queue_batch_size'] = 3
+            self.controller['queue_timeout'] = 0.1
+            self.m_queue = queue.Queue()
 
     mock_monitor = MockMonitor()
-    mock_monitor.m_queue = MockMQueue()
-    assert (True, 'Item') == mock_monitor.get_q_item()
+    assert [] == mock_monitor.get_q_items()
+    for i in range(5):
+        mock_monitor.m_queue.put(('foo', str(i)))
+    assert [('foo', '0'), ('foo', '1'), ('foo', '2')] == mock_monitor.get_q_items()
+    assert [('foo', '3'), ('foo', '4')] == mock_monitor.get_q_items()
 
     CTRL_C['STOP'] = True
-    mock_monitor.m_queue = MockMQueue()
-    assert (False, None) == mock_monitor.get_q_item()
+    mock_monitor.m_queue.put(('foo', '5'))
+    assert [] == mock_monitor.get_q_items()
+    CTRL_C['STOP'] = False
+
+
+def test_settle_items():
+    class MockConsumer:
+
+        def settle(self, acks, nacks):
+            self.acks = acks
+            self.nacks = nacks
+
+    consumer = MockConsumer()
+    handled = Delivery('foo', 'a', consumer=consumer)
+    failed = Delivery('bar', 'b', consumer=consumer)
+    Monitor.settle_items([handled, ('baz', 'c')], [failed])
+    assert consumer.acks == [handled]
+    assert consumer.nacks == [failed]
 
 
 def test_update_history():
@@ -287,57 +305,46 @@ def test_format_rabbit_message():
     assert msg_valid
 
 
-def test_rabbit_callback():
-    def mock_method(): return True
-    mock_method.routing_key = 'test_routing_key'
-    mock_method.delivery_tag = 'test_delivery_tag'
-
-    # force mock_method coverage
-    assert mock_method()
-
-    class MockChannel:
-        def basic_ack(self, delivery_tag): return True
-
-    class MockQueue:
-        item = None
-
-        def put(self, item):
-            self.item = item
-            return True
+def test_schedule_job_kickurl():
 
-        # used for testing to verify that we put right stuff there
-        def get_item(self):
-            return self.item
+    class func():
 
-    mock_channel = MockChannel()
-    mock_queue = MockQueue()
-    rabbit_callback(
-        mock_channel,
-        mock_method,
-        'properties',
-        'body',
-        mock_queue)
-    assert mock_queue.get_item() == (mock_method.routing_key, 'body')
+        def __init__(self):
+            self.logger = logger
+            self.faucet_event = []
+            self.controller = Config().get_config()
+            self.s = SDNConnect(self.controller)
 
-    rabbit_callback(
-        mock_channel,
-        mock_method,
-        'properties',
-        'body',
-        None)
+    schedule_job_kickurl(func())
 
 
-def test_schedule_job_kickurl():
+def test_faucet_event_swap():
 
-    class func():
+    class MockMonitor(Monitor):
 
         def __init__(self):
             self.logger = logger
             self.faucet_event = []
             self.controller = Config().get_config()
+            self.controller['FA_RABBIT_ROUTING_KEY'] = 'FAUCET.Event'
             self.s = SDNConnect(self.controller)
 
-    schedule_job_kickurl(func())
+        def update_routing_key_time(self, routing_key):
+            return
+
+    monitor = MockMonitor()
+    old_events = monitor.faucet_event
+    # a handler that started before a swap adds to the list that is swapped in
+    with FAUCET_EVENT_LOCK:
+        handler = threading.Thread(target=monitor.format_rabbit_message,
+                                   args=(('FAUCET.Event', json.dumps({'a': 1})),))
+        handler.start()
+        handler.join(0.1)
+        assert old_events == []
+        monitor.faucet_event = []
+    handler.join()
+    assert old_events == []
+    assert monitor.faucet_event == [{'a': 1}]
 
 
 def test_schedule_job_reinvestigation():
@@ -400,6 +407,28 @@ def test_Monitor_init():
     monitor.update_routing_key_time('foo')
 
 
+def test_update_endpoint_metrics(monkeypatch):
+    # leave the global registry and metrics port to test_Monitor_init
+    monkeypatch.setattr(Prometheus, 'initialize_metrics', lambda self: None)
+    monkeypatch.setattr(Prometheus, 'start', staticmethod(lambda port=9304: None))
+    monitor = Monitor(skip_rabbit=True)
+    endpoint = endpoint_factory('metrics')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:0b', 'segment': 'foo', 'port': '1', 'active': 1}
+    monitor.s.endpoints[endpoint.name] = endpoint
+    # transitions are counted as they happen
+    assert monitor.prom.endpoint_metrics.hosts['metrics']['state'] == 'unknown'
+    endpoint.queue()
+    assert monitor.prom.endpoint_metrics.hosts['metrics']['state'] == 'queued'
+    # other changes on the next scan
+    endpoint.endpoint_data['port'] = '2'
+    assert monitor.prom.endpoint_metrics.hosts['metrics']['port'] == '1'
+    monitor.update_endpoint_metrics()
+    assert monitor.prom.endpoint_metrics.hosts['metrics']['port'] == '2'
+    del monitor.s.endpoints['metrics']
+    assert 'metrics' not in monitor.prom.endpoint_metrics.hosts
+
+
 def test_SDNConnect_init():
     controller = Config().get_config()
     controller['trunk_ports'] = []
@@ -451,11 +480,11 @@ def test_process():
             self.s.store_endpoints()
             self.s.get_stored_endpoints()
 
-        def get_q_item(self):
-            return (True, ('foo', {'data': {}}))
+        def get_q_items(self):
+            return [('foo', {'data': {}}), ('foo', {'data': {}})]
 
-        def bad_get_q_item(self):
-            return (False, ('bar', {'data': {}}))
+        def bad_get_q_items(self):
+            return []
 
         def format_rabbit_message(self, item):
             return ({'data': {}}, False)
@@ -468,7 +497,7 @@ def test_process():
 
     t1.join()
 
-    mock_monitor.get_q_item = mock_monitor.bad_get_q_item
+    mock_monitor.get_q_items = mock_monitor.bad_get_q_items
 
     t1 = Thread(target=thread1)
     t1.start()
@@ -555,3 +584,141 @@ def test_schedule_thread_worker():
         pass
 
     t1.join()
+
+
+def test_store_endpoints_incremental():
+    controller = Config().get_config()
+    s = SDNConnect(controller)
+    endpoint = endpoint_factory('incremental')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:0a', 'segment': 'foo', 'port': '1', 'ipv4': '10.0.0.10'}
+    s.endpoints[endpoint.name] = endpoint
+    s.store_endpoints()
+    assert endpoint.name in s.stored_snapshots
+    assert s.r.hget('incremental', 'state') == b'unknown'
+    # second store picks up the metadata written by the first
+    s.store_endpoints()
+
+    # unchanged endpoints are not rewritten, or even looked at
+    s.r.hset('incremental', 'state', 'bar')
+    version = s.r.get('p_endpoints_version')
+    looked_up = []
+    get_stored_metadata_bulk = s.get_stored_metadata_bulk
+
+    def record_lookups(endpoints):
+        endpoints = list(endpoints)
+        looked_up.extend(endpoint.name for endpoint in endpoints)
+        return get_stored_metadata_bulk(endpoints)
+    s.get_stored_metadata_bulk = record_lookups
+    s.store_endpoints()
+    assert s.r.hget('incremental', 'state') == b'bar'
+    assert s.r.get('p_endpoints_version') == version
+    assert looked_up == []
+
+    endpoint.queue()
+    s.store_endpoints()
+    assert s.r.hget('incremental', 'state') == b'queued'
+    assert looked_up == ['incremental']
+
+    # changes that leave the indexes alone are stored too
+    generation = s.stored_generations['incremental']
+    endpoint.p_prev_states.append(('queued', 1))
+    s.store_endpoints()
+    assert s.stored_generations['incremental'] > generation
+    s.store_endpoints(full=True)
+    assert s.r.sismember('ip_addresses', '10.0.0.10')
+
+
+def test_get_stored_metadata_bulk():
+    controller = Config().get_config()
+    s = SDNConnect(controller)
+    endpoint = endpoint_factory('bulk')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:0b', 'segment': 'foo', 'port': '1', 'ipv4': '10.0.0.11'}
+    s.endpoints[endpoint.name] = endpoint
+    s.store_endpoints()
+    assert s.r.smembers('bulk_macs') == {b'00:00:00:00:00:0b'}
+
+    s.r.hset('00:00:00:00:00:0b', 'timestamps', "['1551805502']")
+    s.r.hmset('00:00:00:00:00:0b_1551805502', {
+        'labels': "['foo', 'bar']", 'confidences': '[0.9, 0.1]',
+        'bulk': "{'decisions': {'behavior': 'normal'}}"})
+    s.r.hset('10.0.0.11', 'short_os', 'Linux')
+    metadata, mac_owners = s.get_stored_metadata_bulk([endpoint])
+    mac_addresses, ipv4_addresses, ipv6_addresses = metadata['bulk']
+    assert mac_owners == {'00:00:00:00:00:0b': 'bulk'}
+    assert mac_addresses['00:00:00:00:00:0b']['1551805502']['behavior'] == 'normal'
+    assert ipv4_addresses == {'10.0.0.11': {'os': 'Linux'}}
+    assert ipv6_addresses == {}
+    assert s.get_stored_metadata('bulk') == metadata['bulk']
+
+
+def test_get_stored_endpoints_generations():
+    controller = Config().get_config()
+    s = SDNConnect(controller)
+    endpoint = endpoint_factory('generations')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:0c', 'segment': 'foo', 'port': '1'}
+    s.endpoints[endpoint.name] = endpoint
+    s.store_endpoints()
+    generation = s.stored_generations['generations']
+    assert int(s.r.hget('p_endpoints_generations', 'generations')) == generation
+
+    # unchanged endpoints keep their in-memory object across reloads
+    s.get_stored_endpoints()
+    assert s.endpoints['generations'] is endpoint
+
+    # a write from elsewhere bumps the generation and gets reloaded
+    other = SDNConnect(controller, first_time=False)
+    other.get_stored_endpoints()
+    other.endpoints['generations'].queue()
+    other.store_endpoints()
+    s.get_stored_endpoints()
+    assert s.endpoints['generations'] is not endpoint
+    assert s.endpoints['generations'].state == 'queued'
+    assert s.stored_generations['generations'] > generation
+
+
+def test_migrate_p_endpoints():
+    controller = Config().get_config()
+    s = SDNConnect(controller, first_time=False)
+    s.r.delete('p_endpoints_generations')
+    endpoint = endpoint_factory('migrated')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:0d', 'segment': 'foo', 'port': '1'}
+    s.r.set('p_endpoints', str([endpoint.encode()]))
+    s.get_stored_endpoints()
+    assert s.r.get('p_endpoints') is None
+    assert s.endpoints['migrated'].endpoint_data == endpoint.endpoint_data
+
+
+def test_endpoint_archive():
+    # the ring sizes are process wide, so put them back
+    ring_sizes = (Endpoint.history_size, Endpoint.prev_states_size,
+                  Endpoint.acl_data_size)
+    try:
+        Endpoint.set_ring_sizes(2, 3, 100)
+        s = SDNConnect(Config().get_config(), first_time=False)
+        for ring in ('history', 'prev_states', 'acl_data'):
+            s.r.delete(s._archive_key('archived', ring))
+        endpoint = endpoint_factory('archived')
+        endpoint.endpoint_data = {
+            'tenant': 'foo', 'mac': '00:00:00:00:00:0e', 'segment': 'foo', 'port': '1'}
+        s.endpoints[endpoint.name] = endpoint
+        for i in range(6):
+            endpoint.p_prev_states.append(('unknown', i))
+            endpoint.trigger('unknown')
+        assert len(endpoint.p_prev_states) == 3
+        assert len(endpoint.history) == 2
+        s.store_endpoints()
+        assert endpoint.p_prev_states.spilled == []
+        prev_states = s.get_endpoint_archive('archived', 'prev_states')
+        assert [state[1] for state in prev_states] == list(range(6))
+        assert len(s.get_endpoint_archive('archived')) == 6
+        # the archive outlives the endpoint
+        s.endpoints = {}
+        s.store_endpoints()
+        assert not s.r.exists(s._endpoint_key('archived'))
+        assert len(s.get_endpoint_archive('archived')) == 4
+    finally:
+        Endpoint.set_ring_sizes(*ring_sizes)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for metadata lookups.
+"""
+import os
+
+from poseidon.constants import NO_DATA
+from poseidon.helpers.metadata import get_ether_vendor
+from poseidon.helpers.metadata import OuiIndex
+from poseidon.helpers.metadata import RDNSResolver
+
+
+def test_get_ether_vendor():
+    lookup_path = os.path.join(os.getcwd(), 'poseidon/metadata/nmap-mac-prefixes.txt')
+    assert get_ether_vendor('e0:43:db:00:00:01', lookup_path) == 'Shenzhen'
+    assert get_ether_vendor('ff:ff:ff:ff:ff:ff', lookup_path) is None
+    assert get_ether_vendor('e0:43:db:00:00:01', '/nonexistent') == NO_DATA
+
+
+def test_oui_index(tmpdir):
+    lookup_path = str(tmpdir.join('prefixes.txt'))
+    with open(lookup_path, 'w') as f:
+        f.write('0050C2\tIEEE\n0050C21\tMedium\n0050C2123\tSmall\n')
+    index = OuiIndex(lookup_path, check_interval=0)
+    index.load()
+    assert index.lookup('00:50:c2:00:00:00') == 'IEEE'
+    assert index.lookup('00:50:c2:1f:00:00') == 'Medium'
+    assert index.lookup('00:50:c2:12:30:00') == 'Small'
+
+    with open(lookup_path, 'w') as f:
+        f.write('0050C2\tRenamed Vendor\n')
+    assert index.lookup('00:50:c2:12:30:00') == 'Renamed'
+
+
+def test_rdns_resolver():
+    lookups = []
+
+    def resolve(ip):
+        lookups.append(ip)
+        if ip == '10.0.0.1':
+            return 'host.example.com'
+        return NO_DATA
+
+    resolver = RDNSResolver(workers=1, ttl=3600, negative_ttl=0, max_latencies=1,
+                            resolve=resolve)
+    assert resolver.pool is None
+    assert resolver.lookup('10.0.0.1') == NO_DATA
+    assert resolver.lookup('10.0.0.2') == NO_DATA
+    resolver.shutdown(wait=True)
+    assert resolver.pool is None
+    assert resolver.lookup('10.0.0.1') == 'host.example.com'
+    assert resolver.lookup('10.0.0.1') == 'host.example.com'
+    assert lookups == ['10.0.0.1', '10.0.0.2']
+    hits, misses, latencies = resolver.take_stats()
+    assert (hits, misses, len(latencies)) == (2, 2, 1)
+    assert resolver.take_stats() == (0, 0, [])
+    # cached, so no pool is started again
+    assert resolver.pool is None
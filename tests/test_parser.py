@@ -6,8 +6,10 @@ Test module for faucet parser.
 import os
 
 from poseidon.controllers.faucet.faucet import FaucetProxy
+from poseidon.controllers.faucet.mac_table import MacTable
 from poseidon.controllers.faucet.parser import Parser
 from poseidon.controllers.faucet.parser import represent_none
+from poseidon.controllers.faucet.parser import YamlCache
 from poseidon.helpers.config import Config
 from poseidon.helpers.endpoint import endpoint_factory
 
@@ -82,3 +84,50 @@ def test_Parser():
                                        'tests/sample_faucet_config.yaml'), endpoints)
     check_config(proxy, os.path.join(os.getcwd(),
                                      'tests/sample_faucet_config.yaml'), endpoints)
+
+
+def test_coalesce_events():
+    def learn(port, ip='10.0.0.1'):
+        return {'dp_name': 't1-1', 'L2_LEARN': {
+            'eth_src': '00:00:00:00:00:01', 'port_no': port, 'vid': 2, 'l3_src_ip': ip}}
+    expire = {'dp_name': 't1-1', 'L2_EXPIRE': {'eth_src': '00:00:00:00:00:01'}}
+    port_down = {'dp_name': 't1-1', 'PORT_CHANGE': {'port_no': 1, 'status': False}}
+
+    flap = [learn(1), learn(2), learn(1), learn(2), learn(1)]
+    assert Parser.coalesce_events(flap) == [learn(2), learn(1)]
+    assert Parser.coalesce_events(flap + [expire, learn(1), expire]) == [
+        learn(2), learn(1), expire]
+    assert Parser.coalesce_events([learn(1), port_down, learn(1)]) == [
+        learn(1), port_down, learn(1)]
+
+    controller = Config().get_config()
+    raw = FaucetProxy(controller)
+    raw.mac_table = MacTable()
+    coalesced = FaucetProxy(controller)
+    coalesced.mac_table = MacTable()
+    for message in flap + [port_down]:
+        raw.event(message)
+    for message in Parser.coalesce_events(flap + [port_down]):
+        coalesced.event(message)
+    assert raw.mac_table == coalesced.mac_table
+
+
+def test_yaml_cache(tmpdir):
+    path = os.path.join(str(tmpdir), 'faucet.yaml')
+    cache = YamlCache()
+    with open(path, 'w') as f:
+        f.write('dps:\n  switch1:\n    dp_id: 1\n')
+    doc = cache.load(path)
+    doc['dps']['switch1']['dp_id'] = 2
+    assert cache.load(path) == {'dps': {'switch1': {'dp_id': 1}}}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # same content written again
+    with open(path, 'w') as f:
+        f.write('dps:\n  switch1:\n    dp_id: 1\n')
+    os.utime(path, ns=(0, 0))
+    cache.load(path)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    Parser.yaml_out(path, {'dps': {'switch1': {'dp_id': 3}}})
+    assert Parser.yaml_in(path) == {'dps': {'switch1': {'dp_id': 3}}}
@@ -3,6 +3,8 @@
 Test module for prometheus
 @author: Charlie Lewis
 """
+from poseidon.helpers.endpoint import endpoint_factory
+from poseidon.helpers.prometheus import EndpointCollector
 from poseidon.helpers.prometheus import Prometheus
 
 
@@ -21,3 +23,65 @@ def test_Prometheus():
              {'active': 1, 'source': 'poseidon', 'role': 'unknown', 'state': 'unknown', 'ipv4_os': 'unknown', 'tenant': 'vlan1', 'port': 1, 'segment': 'switch1', 'ipv4': '::', 'mac': '00:00:00:00:00:00', 'id': 'foo5', 'behavior': 1}]
     p = Prometheus()
     p.update_metrics(hosts)
+
+
+def host(name, active, state='unknown', port=1):
+    return {'active': active, 'source': 'poseidon', 'role': 'unknown', 'state': state, 'ipv4_os': 'unknown', 'tenant': 'vlan1',
+            'port': port, 'segment': 'switch1', 'ipv4': '10.0.0.1', 'mac': '00:00:00:00:00:00', 'id': name, 'behavior': 1}
+
+
+def test_update_hosts():
+    p = Prometheus()
+    counts = p.endpoint_metrics.counts
+    p.update_metrics([host('foo1', 1), host('foo2', 0), host('foo3', 1)])
+    assert counts['actives'] == 2
+    assert counts['inactives'] == 1
+    assert counts['port_hosts'] == {(1,): 2}
+    p.update_hosts({'foo1': host('foo1', 1, state='known', port=2),
+                    'foo3': None})
+    assert counts['actives'] == 1
+    assert counts['port_hosts'] == {(1,): 0, (2,): 1}
+    assert counts['current_states'][('poseidon', 'known')] == 1
+    assert counts['current_states'][('poseidon', 'unknown')] == 0
+    # series go away with the last host in them
+    p.update_hosts({'foo2': None})
+    assert counts['port_hosts'] == {(2,): 1}
+    assert ('poseidon', 'unknown') not in counts['current_states']
+    p.set_hosts({})
+    assert p.endpoint_metrics.hosts == {}
+    assert counts['actives'] == 0
+    assert counts['inactives'] == 0
+    assert counts['roles'] == {}
+    assert counts['current_states'][('Poseidon', 'known')] == 0
+
+
+def test_collect():
+    collector = EndpointCollector(max_host_series=1)
+    collector.set_hosts({'foo1': host('foo1', 1), 'foo2': host('foo2', 1),
+                         'foo3': host('foo3', 0)})
+    families = {family.name: family for family in collector.collect()}
+    assert families['poseidon_endpoint_active'].samples[0].value == 2
+    assert families['poseidon_endpoint_port_hosts'].samples[0].labels == {
+        'port': '1'}
+    assert families['poseidon_endpoint_port_hosts'].samples[0].value == 2
+    assert len(families['poseidon_endpoint_behavior'].samples) == 1
+    assert families['poseidon_endpoint_ip_table'].samples[0].labels['hash_id'] == 'foo1'
+    assert families['poseidon_endpoint_host_series_dropped'].samples[0].value == 1
+
+
+def test_endpoint_host():
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {
+        'tenant': 'vlan1', 'mac': '00:00:00:00:00:00', 'segment': 'switch1', 'port': '1', 'ipv4': '10.0.0.1', 'active': 1}
+    endpoint.metadata = {
+        'mac_addresses': {'00:00:00:00:00:00': {
+            '1': {'labels': ['printer'], 'behavior': 'normal'},
+            '2': {'labels': ['server'], 'behavior': 'abnormal'}}},
+        'ipv4_addresses': {'10.0.0.1': {'os': 'Linux'}}}
+    host = Prometheus.endpoint_host(endpoint)
+    assert host['id'] == 'foo'
+    assert host['state'] == 'unknown'
+    assert host['role'] == 'server'
+    assert host['behavior'] == 1
+    assert host['ipv4_os'] == 'Linux'
+    assert host['source'] == 'NO DATA'
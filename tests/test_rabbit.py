@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for the rabbit publisher and consumer.
+"""
+import queue
+
+import pika
+import pytest
+
+from poseidon.helpers.rabbit import Delivery
+from poseidon.helpers.rabbit import RabbitConsumer
+from poseidon.helpers.rabbit import RabbitPublisher
+
+
+class MockChannel:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+        self.confirming = False
+
+    def exchange_declare(self, exchange, exchange_type):
+        pass
+
+    def confirm_delivery(self):
+        self.confirming = True
+
+    def basic_publish(self, exchange, routing_key, body):
+        if self.connection.fail:
+            self.connection.fail -= 1
+            self.is_open = False
+            raise pika.exceptions.StreamLostError('lost')
+        self.connection.published.append((exchange, routing_key, body))
+
+
+class MockConnection:
+    opened = []
+
+    def __init__(self, parameters, fail=0):
+        self.parameters = parameters
+        self.is_open = True
+        self.fail = fail
+        self.published = []
+        MockConnection.opened.append(self)
+
+    def channel(self):
+        return MockChannel(self)
+
+    def close(self):
+        self.is_open = False
+
+
+def test_publish_batch():
+    MockConnection.opened = []
+    publisher = RabbitPublisher('rabbit', port=5673, confirms=True,
+                                connection_factory=MockConnection)
+    publisher.publish('poseidon.action.ignore', '["foo"]')
+    publisher.publish_batch([('a', '1'), ('b', '2')])
+    assert len(MockConnection.opened) == 1
+    connection = MockConnection.opened[0]
+    assert connection.parameters.host == 'rabbit'
+    assert connection.parameters.port == 5673
+    assert publisher.channel.confirming
+    assert [message[1:] for message in connection.published] == [
+        ('poseidon.action.ignore', '["foo"]'), ('a', '1'), ('b', '2')]
+    publisher.close()
+    assert not connection.is_open
+
+
+def test_publish_reconnects():
+    MockConnection.opened = []
+
+    def flaky(parameters):
+        return MockConnection(parameters, fail=1 if not MockConnection.opened else 0)
+
+    publisher = RabbitPublisher('rabbit', connection_factory=flaky)
+    publisher.publish('a', '1')
+    assert len(MockConnection.opened) == 2
+    assert MockConnection.opened[1].published == [
+        ('topic-poseidon-internal', 'a', '1')]
+
+    def broken(parameters):
+        return MockConnection(parameters, fail=2)
+
+    publisher = RabbitPublisher('rabbit', connection_factory=broken)
+    with pytest.raises(pika.exceptions.AMQPConnectionError):
+        publisher.publish('a', '1')
+
+
+class MockConsumingChannel(MockChannel):
+
+    def __init__(self, connection):
+        super(MockConsumingChannel, self).__init__(connection)
+        self.acks = []
+        self.nacks = []
+
+    def queue_declare(self, queue, exclusive, durable):
+        pass
+
+    def queue_bind(self, exchange, queue, routing_key):
+        self.connection.bound.append(routing_key)
+
+    def basic_qos(self, prefetch_count):
+        self.connection.prefetch = prefetch_count
+
+    def basic_consume(self, queue, callback):
+        self.callback = callback
+
+    def start_consuming(self):
+        self.callback(self, Method('poseidon.action.ignore', 1), None, b'["foo"]')
+        self.callback(self, Method('poseidon.action.remove', 2), None, b'["bar"]')
+        self.callback(self, Method('poseidon.action.remove', 3, redelivered=True), None, b'["baz"]')
+        self.connection.consumer.stopping.set()
+
+    def basic_ack(self, delivery_tag):
+        self.acks.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue):
+        self.nacks.append((delivery_tag, requeue))
+
+
+class Method:
+
+    def __init__(self, routing_key, delivery_tag, redelivered=False):
+        self.routing_key = routing_key
+        self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+
+
+def test_consumer():
+    connections = []
+    m_queue = queue.Queue()
+
+    def factory(parameters):
+        if not connections:
+            connections.append(None)
+            raise pika.exceptions.AMQPConnectionError('refused')
+        connection = MockConnection(parameters)
+        connection.bound = []
+        connection.consumer = consumer
+        connection.channel = lambda: MockConsumingChannel(connection)
+        connection.add_callback_threadsafe = lambda callback: callback()
+        connections.append(connection)
+        return connection
+
+    consumer = RabbitConsumer('rabbit', 5672, 'topic-poseidon-internal', 'poseidon_main',
+                              'poseidon.action.#', m_queue, prefetch=10, max_backoff=0,
+                              connection_factory=factory)
+    consumer.run()
+    connection = connections[1]
+    assert connection.prefetch == 10
+    assert connection.bound == ['poseidon.action.#']
+    assert not connection.is_open
+
+    first = m_queue.get_nowait()
+    second = m_queue.get_nowait()
+    third = m_queue.get_nowait()
+    assert first == ('poseidon.action.ignore', b'["foo"]')
+    assert isinstance(first, Delivery)
+    # nothing is settled while the connection is down
+    consumer.settle([first], [second, third])
+    assert first.channel.acks == []
+    # closed channels are not acked on
+    connection.is_open = True
+    first.channel.is_open = False
+    consumer.settle([first], [second, third])
+    assert first.channel.acks == []
+    # failed deliveries are requeued, unless they were already redelivered
+    first.channel.is_open = True
+    consumer.settle([first], [second, third])
+    assert first.channel.acks == [1]
+    assert first.channel.nacks == [(2, True), (3, False)]
+
+    consumer.connection = None
+    consumer.settle([first])
+    assert first.channel.acks == [1]
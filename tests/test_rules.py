@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for compiled faucet ACL rules.
+"""
+from poseidon.controllers.faucet.rules import endpoint_features
+from poseidon.controllers.faucet.rules import RuleEngine
+from poseidon.helpers.endpoint import endpoint_factory
+
+RULES = {'rules': {
+    'printers': [{'rule': {'device_key': 'role', 'value': 'Printer', 'min_confidence': 50, 'acls': ['a']}}],
+    'mac-printers': [{'rule': {'device_key': 'os', 'value': 'Mac', 'acls': ['b']}},
+                     {'rule': {'device_key': 'role', 'value': 'Printer', 'acls': ['c']}}],
+    'abnormal': [{'rule': {'device_key': 'behavior', 'value': 'abnormal', 'acls': ['d']}}],
+    'no-key': [{'rule': {'acls': ['e']}}]}}
+
+
+def make_endpoint(name, confidence, behavior='normal'):
+    endpoint = endpoint_factory(name)
+    endpoint.metadata = {
+        'mac_addresses': {'00:00:00:00:00:01': {
+            '1551805502.0': {'labels': ['Unknown', 'Printer'], 'confidences': [0.9, 0.1],
+                             'behavior': 'abnormal'},
+            '1551805602.0': {'labels': ['Printer', 'Unknown', 'Phone'],
+                             'confidences': [confidence, 0.2, 0.1], 'behavior': behavior}}},
+        'ipv4_addresses': {'10.0.0.1': {'os': 'Mac'}},
+        'ipv6_addresses': {}}
+    return endpoint
+
+
+def test_endpoint_features():
+    features = endpoint_features(make_endpoint('foo', 0.6))
+    assert features.oses == {'Mac'}
+    assert ('Printer', 0.6) in features.roles
+    assert features.behaviors == {'normal'}
+    assert endpoint_features(endpoint_factory('bar')).roles == frozenset()
+
+
+def test_match_all():
+    engine = RuleEngine(RULES)
+    sure = make_endpoint('sure', 0.6)
+    unsure = make_endpoint('unsure', 0.4, behavior='abnormal')
+    matched = engine.match_all([sure, unsure])
+    assert matched['sure'] == {'printers', 'mac-printers'}
+    assert matched['unsure'] == {'mac-printers', 'abnormal'}
+
+    # unchanged endpoints keep their results, changed ones are re-evaluated
+    engine.evaluate = None
+    assert engine.match_all([sure])['sure'] == {'printers', 'mac-printers'}
+    engine = RuleEngine(RULES)
+    engine.match_all([sure])
+    sure.metadata['ipv4_addresses']['10.0.0.1']['os'] = 'Windows'
+    assert engine.match_all([sure])['sure'] == {'printers'}
+
+
+def test_newest_record_keys():
+    # ML timestamps are stored as integer strings, which str(float) misses
+    endpoint = endpoint_factory('int-keys')
+    endpoint.metadata = {'mac_addresses': {'00:00:00:00:00:01': {
+        '1551805502': {'labels': ['Unknown'], 'confidences': [0.9], 'behavior': 'normal'},
+        '1551805602': {'labels': ['Printer'], 'confidences': [0.6], 'behavior': 'abnormal'}}}}
+    features = endpoint_features(endpoint)
+    assert features.roles == {('Printer', 0.6)}
+    assert features.behaviors == {'abnormal'}
+
+
+def test_fewer_than_three_labels():
+    endpoint = endpoint_factory('short')
+    endpoint.metadata = {'mac_addresses': {'00:00:00:00:00:01': {
+        '1551805602.0': {'labels': ['Printer'], 'confidences': [0.6]}}}}
+    assert RuleEngine(RULES).match_all([endpoint])['short'] == {'printers'}